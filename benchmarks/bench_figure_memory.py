@@ -0,0 +1,113 @@
+"""
+Memory per figure of the Figure representation, at corpus scale.
+
+Builds --figures synthetic figures the way iter_figures does (fresh strings per element, as parsed
+from a response), once with the compact Figure and once with a replica of the previous plain class
+(per-instance __dict__, coordinates as a list of dicts, html as a str, a back-reference to its
+FigureList), and reports the traced bytes per figure of each.
+
+Usage:
+python benchmarks/bench_figure_memory.py
+python benchmarks/bench_figure_memory.py --figures 100000 --html-chars 2000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from image_extraction_pipeline import Figure, FigureList
+
+DEFAULT_FIGURES = 1_000_000
+DEFAULT_HTML_CHARS = 600
+BOOK_PAGES = 400
+FIGURES_PER_BOOK = 250
+
+
+class PlainFigure:
+    """
+    The previous Figure: a regular class holding the response's values as they are
+    """
+    def __init__(self, original_doc_filepath, image_name, image_caption, image_descriptions, page_number, image_coordinates, html, element_id, FigureListObj):
+        self.original_doc_filepath = original_doc_filepath
+        self.image_name = image_name
+        self.image_caption = image_caption
+        self.image_descriptions = [image_descriptions] if image_descriptions else []
+        self.page_number = page_number
+        self.image_coordinates = image_coordinates
+        self.html = html
+        self.element_id = element_id
+        self.FigureListObj = FigureListObj
+
+
+def synthetic_element(rng, i, html_chars, alt_text):
+    """
+    A figure element with fresh strings, like one decoded from a layout response
+    """
+    x, y = rng.randint(0, 1500), rng.randint(0, 2000)
+    offset = rng.randrange(len(alt_text) - html_chars)
+    return {
+        "id": i,
+        "page": i % BOOK_PAGES + 1,
+        "text": "" if i % 3 else f"Diagram {i} text",
+        "html": f"<figure id='{i}'><img alt=\"{alt_text[offset:offset + html_chars]}\" /></figure>",
+        "bounding_box": [{"x": x, "y": y}, {"x": x + 600, "y": y}, {"x": x + 600, "y": y + 400}, {"x": x, "y": y + 400}],
+        "caption": f"Figure {i // FIGURES_PER_BOOK}.{i % FIGURES_PER_BOOK}: The model architecture of variant {i}",
+    }
+
+
+def build(figure_class, num_figures, html_chars, seed=0):
+    rng = random.Random(seed)
+    # OCR'd words of the figure, as the layout analyzer puts them in the alt text
+    alt_text = " ".join(rng.choice(["input", "layer", "output", "weights", "x", "y", "softmax", "attention", "Q", "K", "V"]) for _ in range(max(10000, html_chars)))
+    books = []
+    figure_list = None
+    for i in range(num_figures):
+        if i % FIGURES_PER_BOOK == 0:
+            figure_list = FigureList()
+            books.append(figure_list)
+            pdf_filepath = f"corpus/book_{i // FIGURES_PER_BOOK}.pdf"
+        element = synthetic_element(rng, i, html_chars, alt_text)
+        kwargs = dict(original_doc_filepath=pdf_filepath, image_name=None, image_caption=element["caption"], image_descriptions=element["text"],
+                      page_number=element["page"], image_coordinates=element["bounding_box"], html=element["html"], element_id=element["id"])
+        if figure_class is PlainFigure:
+            figure = PlainFigure(FigureListObj=figure_list, **kwargs)
+            figure.image_name = f"Figure {i // FIGURES_PER_BOOK}-{i % FIGURES_PER_BOOK}"
+        else:
+            figure = Figure(**kwargs)
+            figure.set_figure_name(f"Figure {i // FIGURES_PER_BOOK}-{i % FIGURES_PER_BOOK}")
+        figure_list.add_figure(figure)
+    return books
+
+
+def measure(figure_class, num_figures, html_chars):
+    """
+    (traced bytes per figure, seconds to build) for num_figures figures
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        books = build(figure_class, num_figures, html_chars)
+        seconds = time.perf_counter() - start
+        current = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del books
+    return current / num_figures, seconds
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure memory per Figure at corpus scale.")
+    parser.add_argument("--figures", type=int, default=DEFAULT_FIGURES, help="Number of figures to hold in memory.")
+    parser.add_argument("--html-chars", type=int, default=DEFAULT_HTML_CHARS, help="Approximate html length per figure.")
+    args = parser.parse_args()
+
+    results = {}
+    for label, figure_class in [("plain", PlainFigure), ("compact", Figure)]:
+        per_figure, seconds = measure(figure_class, args.figures, args.html_chars)
+        results[label] = per_figure
+        print(f"{label:<8} {args.figures:>9} figures {per_figure:>8.0f} bytes/figure {per_figure * args.figures / 1e9:>7.2f} GB total  built in {seconds:6.1f}s")
+    print(f"compact uses {results['compact'] / results['plain']:.0%} of the plain representation's memory")
@@ -0,0 +1,57 @@
+"""
+What page triage saves on upload: pages and bytes sent to the layout API with and without it.
+
+For each PDF, packs the document the way get_element_json_from_layout_api would upload it, once
+whole and once with only the pages kept by page_triage.py, in chunks of --chunk-pages, and reports
+the pages kept, the bytes of each upload and the time the triage pass took. No request is sent.
+
+Usage:
+python benchmarks/bench_page_triage.py
+python benchmarks/bench_page_triage.py sample_data/DL_textbooks/*.pdf --chunk-pages 25
+"""
+import os
+import sys
+import glob
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from image_extraction_pipeline import split_pdf_into_chunks, DEFAULT_CHUNK_PAGES
+from page_triage import triage_pdf
+
+DEFAULT_PDFS_GLOB = "sample_data/*.pdf"
+
+
+def upload_bytes(pdf_filepath, chunk_pages, pages=None):
+    return sum(len(chunk_bytes) for _, chunk_bytes in split_pdf_into_chunks(pdf_filepath, chunk_pages=chunk_pages, pages=pages))
+
+
+def measure(pdf_filepath, chunk_pages):
+    start = time.perf_counter()
+    triage = triage_pdf(pdf_filepath)
+    seconds = time.perf_counter() - start
+    chunk_pages = chunk_pages or triage.num_pages
+    full_bytes = upload_bytes(pdf_filepath, chunk_pages) if triage.num_pages > chunk_pages else os.path.getsize(pdf_filepath)
+    if triage.is_complete:
+        triaged_bytes = full_bytes
+    else:
+        triaged_bytes = upload_bytes(pdf_filepath, chunk_pages, pages=triage.pages) if triage.pages else 0
+    return {"pages": triage.num_pages, "kept_pages": len(triage.pages), "bytes": full_bytes, "triaged_bytes": triaged_bytes, "triage_seconds": seconds}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the pages and bytes page triage keeps out of layout uploads.")
+    parser.add_argument("pdfs", nargs="*", help=f"PDFs to triage. Defaults to {DEFAULT_PDFS_GLOB}.")
+    parser.add_argument("--chunk-pages", type=int, default=DEFAULT_CHUNK_PAGES, help="Pages per uploaded chunk, 0 for whole documents.")
+    args = parser.parse_args()
+
+    totals = {"pages": 0, "kept_pages": 0, "bytes": 0, "triaged_bytes": 0, "triage_seconds": 0.0}
+    print(f"{'document':<32} {'pages':>6} {'kept':>6} {'MB':>8} {'kept MB':>8} {'saved':>6} {'triage s':>9}")
+    for pdf_filepath in args.pdfs or sorted(glob.glob(DEFAULT_PDFS_GLOB)):
+        stats = measure(pdf_filepath, args.chunk_pages)
+        for key in totals:
+            totals[key] += stats[key]
+        print(f"{os.path.basename(pdf_filepath)[:32]:<32} {stats['pages']:>6} {stats['kept_pages']:>6} {stats['bytes'] / 1e6:8.2f} {stats['triaged_bytes'] / 1e6:8.2f} {1 - stats['triaged_bytes'] / stats['bytes']:6.0%} {stats['triage_seconds']:9.2f}")
+    if totals["bytes"]:
+        print(f"{'total':<32} {totals['pages']:>6} {totals['kept_pages']:>6} {totals['bytes'] / 1e6:8.2f} {totals['triaged_bytes'] / 1e6:8.2f} {1 - totals['triaged_bytes'] / totals['bytes']:6.0%} {totals['triage_seconds']:9.2f}")
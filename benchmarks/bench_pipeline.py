@@ -0,0 +1,182 @@
+"""
+End-to-end pipeline benchmark against the mock layout server.
+
+Uses the recorded responses in sample_data/responses/ (see record_fixtures.py) for the sample PDFs
+they were recorded from, served by an in-process MockLayoutServer with configurable latency, so runs
+need no network access and are repeatable. For every combination of document count and worker count
+it times:
+- upload: layout analysis of all documents over `workers` concurrent uploads
+- link: process_figures on every response
+- render: render_figure_list on every document with `workers` processes
+- write_json: write_figure_list_json for every document
+- end_to_end: run_ingestion over all documents with `workers` upload threads and processes
+
+The best of --repeat runs is kept per measurement. Results are written as JSON; with --baseline, each
+measurement is compared against an earlier results file and the exit status is 1 if any got slower
+by more than --threshold.
+
+Usage:
+python benchmarks/bench_pipeline.py --documents 1 4 --workers 1 4 --latency 0.5 --output bench_results.json
+python benchmarks/bench_pipeline.py --baseline bench_results.json --threshold 0.2
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import image_extraction_pipeline as pipeline
+from mock_layout_server import MockLayoutServer, load_fixtures, DEFAULT_FIXTURES_DIR
+
+DEFAULT_PDF_DIR = "sample_data"
+DEFAULT_DOCUMENTS = [1, 4]
+DEFAULT_WORKERS = [1, 4]
+STAGES = ["upload", "link", "render", "write_json", "end_to_end"]
+
+
+def benchmark_documents(fixtures, pdf_dir, num_documents, work_dir):
+    """
+    num_documents PDFs that have a fixture, cycling through them. Repeats are copied into their
+    own subdirectory under the original file name, so the mock server still recognizes them.
+    """
+    available = [os.path.join(pdf_dir, f"{stem}.pdf") for stem in sorted(fixtures) if os.path.exists(os.path.join(pdf_dir, f"{stem}.pdf"))]
+    if not available:
+        raise SystemExit(f"No PDFs in '{pdf_dir}' have a recorded response; run benchmarks/record_fixtures.py first.")
+    documents = []
+    for i in range(num_documents):
+        pdf_filepath = available[i % len(available)]
+        if i >= len(available):
+            copy_dir = os.path.join(work_dir, "inputs", str(i))
+            os.makedirs(copy_dir, exist_ok=True)
+            pdf_filepath = shutil.copy(pdf_filepath, copy_dir)
+        documents.append(os.path.abspath(pdf_filepath))
+    return documents
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def run_stages(documents, workers, work_dir):
+    """
+    One timed run of every stage. Returns {stage: seconds}.
+    """
+    timings = {}
+    upload = lambda pdf_filepath: pipeline.get_element_json_from_pdf(pdf_filepath, cache=None, backend="remote")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        timings["upload"], responses = timed(lambda: list(executor.map(upload, documents)))
+
+    timings["link"], figure_lists = timed(lambda: [pipeline.process_figures(pdf_filepath, response_json) for pdf_filepath, response_json in zip(documents, responses)])
+
+    def render():
+        for i, figure_list in enumerate(figure_lists):
+            document_dir = os.path.join(work_dir, "render", str(i))
+            pipeline.render_figure_list(figure_list, os.path.join(document_dir, "diagrams"), max_workers=workers, thumbnail_dir=os.path.join(document_dir, "thumbnails"))
+    timings["render"], _ = timed(render)
+
+    def write_json():
+        for i, (pdf_filepath, figure_list) in enumerate(zip(documents, figure_lists)):
+            json_dir = os.path.join(work_dir, "json", str(i))
+            os.makedirs(os.path.join(json_dir, os.path.splitext(os.path.basename(pdf_filepath))[0]))
+            pipeline.write_figure_list_json(pdf_filepath, [figure.to_dict() for figure in figure_list.figures], json_dir)
+    timings["write_json"], _ = timed(write_json)
+
+    # The whole pipeline from a cold start: fresh layout cache, manifest, dedup and search index
+    pipeline.LAYOUT_CACHE.cache_dir = os.path.join(work_dir, "layout_cache")
+    timings["end_to_end"], results = timed(
+        pipeline.run_ingestion, documents, OUTPUT_DIR=os.path.join(work_dir, "output"), upload_workers=workers, cpu_workers=workers,
+        index_dir=os.path.join(work_dir, "index"), dedup_dir=os.path.join(work_dir, "dedup"), resume=False, layout_backend="remote",
+    )
+    errors = {pdf_filepath: str(error) for pdf_filepath, error in results.items() if error is not None}
+    if errors:
+        raise RuntimeError(f"Ingestion failed: {errors}")
+    return timings
+
+
+def run_benchmark(fixtures, pdf_dir, document_counts, worker_counts, repeat):
+    results = []
+    for num_documents in document_counts:
+        for workers in worker_counts:
+            best = {stage: float("inf") for stage in STAGES}
+            for _ in range(repeat):
+                work_dir = tempfile.mkdtemp(prefix="bench_pipeline_")
+                try:
+                    documents = benchmark_documents(fixtures, pdf_dir, num_documents, work_dir)
+                    for stage, seconds in run_stages(documents, workers, work_dir).items():
+                        best[stage] = min(best[stage], seconds)
+                finally:
+                    shutil.rmtree(work_dir, ignore_errors=True)
+            results.append({"documents": num_documents, "workers": workers, "seconds": best})
+            print(f"{num_documents:>4} documents {workers:>3} workers  " + "  ".join(f"{stage} {best[stage]:8.3f}s" for stage in STAGES))
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Print each measurement against the baseline. Returns the number of regressions beyond threshold.
+    """
+    baseline_by_scenario = {(result["documents"], result["workers"]): result["seconds"] for result in baseline["results"]}
+    regressions = 0
+    for result in results:
+        previous = baseline_by_scenario.get((result["documents"], result["workers"]))
+        if previous is None:
+            continue
+        for stage in STAGES:
+            if not previous.get(stage):
+                continue
+            ratio = result["seconds"][stage] / previous[stage]
+            regressed = ratio > 1 + threshold
+            regressions += regressed
+            print(f"{result['documents']:>4} documents {result['workers']:>3} workers  {stage:<11} {previous[stage]:8.3f}s -> {result['seconds'][stage]:8.3f}s  {ratio:6.2f}x{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages against a local mock layout server.")
+    parser.add_argument("--fixtures-dir", default=DEFAULT_FIXTURES_DIR, help="Directory of recorded <pdf stem>.json responses.")
+    parser.add_argument("--pdf-dir", default=DEFAULT_PDF_DIR, help="Directory holding the PDFs the fixtures were recorded from.")
+    parser.add_argument("--documents", type=int, nargs="+", default=DEFAULT_DOCUMENTS, help="Document counts to benchmark.")
+    parser.add_argument("--workers", type=int, nargs="+", default=DEFAULT_WORKERS, help="Worker counts to benchmark.")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per scenario; the best time per stage is kept.")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds the mock server waits before every response.")
+    parser.add_argument("--latency-per-page", type=float, default=0.0, help="Seconds the mock server waits per page of the response.")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Random relative variation of the mock server's delay.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of mock requests answered with a 429 or 503, retried by the client.")
+    parser.add_argument("--output", help="Write the results as JSON to this file.")
+    parser.add_argument("--baseline", help="Results JSON of an earlier run to compare against.")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Relative slowdown reported as a regression.")
+    args = parser.parse_args()
+
+    fixtures = load_fixtures(args.fixtures_dir)
+    server = MockLayoutServer(fixtures, latency=args.latency, latency_per_page=args.latency_per_page, jitter=args.jitter, seed=0, error_rate=args.error_rate, pdf_dir=args.pdf_dir).start()
+    pipeline.UPSTAGE_LAYOUT_URL = server.url
+    try:
+        results = run_benchmark(fixtures, args.pdf_dir, args.documents, args.workers, args.repeat)
+    finally:
+        server.stop()
+
+    report = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "environment": {"python": platform.python_version(), "platform": platform.platform(), "cpu_count": os.cpu_count()},
+        "config": {"fixtures": sorted(fixtures), "latency": args.latency, "latency_per_page": args.latency_per_page, "jitter": args.jitter, "error_rate": args.error_rate, "repeat": args.repeat},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            num_regressions = compare(results, json.load(f), args.threshold)
+        if num_regressions:
+            print(f"{num_regressions} measurements regressed by more than {args.threshold:.0%}")
+            sys.exit(1)
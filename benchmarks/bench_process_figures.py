@@ -0,0 +1,145 @@
+"""
+Micro-benchmark for process_figures.
+
+Times the figure/caption/reference linker on the recorded layout responses in
+sample_data/responses/ (when present) and on synthetic responses of growing size,
+to check that linking time grows linearly with the number of elements.
+
+With --memory it instead compares the peak memory of linking each response file, recorded and
+synthetic, loaded whole against reading it incrementally (see element_stream.py). The streamed peak grows only with the linked
+figures and the references to them, which are the output, not with the size of the response.
+
+Usage:
+python benchmarks/bench_process_figures.py
+python benchmarks/bench_process_figures.py --sizes 1000 10000 100000 --repeat 5
+python benchmarks/bench_process_figures.py --memory --sizes 10000 100000 300000
+"""
+import os
+import sys
+import glob
+import json
+import time
+import random
+import argparse
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from image_extraction_pipeline import process_figures, iter_figures
+
+DEFAULT_FIXTURES_GLOB = "sample_data/responses/*.json"
+DEFAULT_SIZES = [1000, 10000, 100000]
+
+
+def make_synthetic_response(num_elements, seed=0):
+    """
+    Builds a textbook-like response: ~10% figures, most followed by a "Figure N.M" caption,
+    and paragraphs that reference earlier and later figures.
+    """
+    rng = random.Random(seed)
+    elements = []
+    chapter, figure_number = 1, 0
+    for i in range(num_elements):
+        roll = rng.random()
+        if roll < 0.1:
+            category, text = "figure", ""
+        elif roll < 0.18:
+            figure_number += 1
+            category, text = "caption", f"Figure {chapter}.{figure_number}: A diagram"
+        elif roll < 0.181:
+            chapter, figure_number = chapter + 1, 0
+            category, text = "heading1", f"Chapter {chapter}"
+        else:
+            ref = rng.randint(1, figure_number + 5)
+            category, text = "paragraph", rng.choice([
+                "Plain prose without any figure reference in it at all.",
+                f"As shown in Figure {chapter}.{ref}, the result follows.",
+                f"Compare Fig. {chapter}-{ref} with Figure {chapter}.{ref + 1}.",
+            ])
+        elements.append({"category": category, "text": text, "html": f"<p id='{i}'>{text}</p>", "id": i, "page": i // 20 + 1, "bounding_box": []})
+    return {"elements": elements}
+
+
+def time_process_figures(response_json, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        figure_list = process_figures("benchmark.pdf", response_json)
+        best = min(best, time.perf_counter() - start)
+    return best, len(figure_list.figures)
+
+
+def peak_memory(function):
+    """
+    Peak traced memory in bytes while function runs
+    """
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def report_memory(label, response_path):
+    """
+    Peak memory of linking a response file, loaded whole and streamed.
+    """
+    def loaded():
+        with open(response_path, "r") as response_file:
+            process_figures("benchmark.pdf", json.load(response_file))
+
+    num_figures = 0
+    def streamed():
+        nonlocal num_figures
+        for _ in iter_figures("benchmark.pdf", response_path):
+            num_figures += 1
+
+    loaded_peak, streamed_peak = peak_memory(loaded), peak_memory(streamed)
+    print(f"{label:<40} {os.path.getsize(response_path) / 1e6:>9.1f} MB file  loaded peak {loaded_peak / 1e6:>9.1f} MB  streamed peak {streamed_peak / 1e6:>9.1f} MB  {num_figures:>7} figures")
+
+
+def report_synthetic_memory(size):
+    """
+    report_memory for a synthetic response file of size elements
+    """
+    response_json = make_synthetic_response(size)
+    for element in response_json["elements"]:
+        element["html"] *= 20  # Layout responses carry far more HTML than text per element
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+        json.dump(response_json, f)
+    del response_json
+    try:
+        report_memory(f"synthetic-{size}", f.name)
+    finally:
+        os.remove(f.name)
+
+
+def report(label, response_json, repeat):
+    num_elements = len(response_json["elements"])
+    seconds, num_figures = time_process_figures(response_json, repeat)
+    print(f"{label:<40} {num_elements:>9} elements {num_figures:>7} figures {seconds * 1000:>10.2f} ms {num_elements / seconds:>12.0f} elements/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark process_figures.")
+    parser.add_argument("--fixtures", default=DEFAULT_FIXTURES_GLOB, help="Glob of recorded layout response JSON files.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="Synthetic response sizes in elements.")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per input; the best time is reported.")
+    parser.add_argument("--memory", action="store_true", help="Compare peak memory of loaded and streamed responses instead of timing.")
+    args = parser.parse_args()
+
+    if args.memory:
+        for fixture_path in sorted(glob.glob(args.fixtures)):
+            report_memory(os.path.basename(fixture_path), fixture_path)
+        for size in args.sizes:
+            report_synthetic_memory(size)
+        sys.exit(0)
+
+    for fixture_path in sorted(glob.glob(args.fixtures)):
+        with open(fixture_path, "r") as f:
+            report(os.path.basename(fixture_path), json.load(f), args.repeat)
+
+    for size in args.sizes:
+        report(f"synthetic-{size}", make_synthetic_response(size), args.repeat)
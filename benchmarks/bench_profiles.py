@@ -0,0 +1,131 @@
+"""
+Compare the output profiles on the sample PDFs: bytes on disk, encode time and fidelity.
+
+Figures are linked from the recorded responses in sample_data/responses/ where there is one, and
+from the offline layout engine otherwise, then rendered once per profile. For each profile it
+reports the files and bytes written, the time spent rendering and encoding, and the mean and
+minimum PSNR of the full-size figures against the archival profile (each figure scaled to the
+archival size first), so the cheapest profile that is still good enough can be picked.
+
+Usage:
+python benchmarks/bench_profiles.py
+python benchmarks/bench_profiles.py sample_data/dl15.pdf --profiles archival compact --output profile_results.json
+"""
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import image_extraction_pipeline as pipeline
+from figure_encoding import OUTPUT_PROFILES
+from instrumentation import METRICS
+from local_layout import analyze_pdf
+from mock_layout_server import load_fixtures, DEFAULT_FIXTURES_DIR
+
+DEFAULT_PDFS_GLOB = "sample_data/*.pdf"
+REFERENCE_PROFILE = "archival"
+
+
+def psnr(reference_path, path):
+    """
+    Peak signal-to-noise ratio in dB of an image against a reference, on RGB at the reference's size
+    """
+    with Image.open(reference_path) as reference, Image.open(path) as image:
+        reference = np.asarray(reference.convert("RGB"), dtype=np.float64)
+        image = np.asarray(image.convert("RGB").resize((reference.shape[1], reference.shape[0]), Image.LANCZOS), dtype=np.float64)
+    mse = np.mean((reference - image) ** 2)
+    return float("inf") if mse == 0 else 10 * np.log10(255 ** 2 / mse)
+
+
+def figure_lists(pdf_filepaths, fixtures):
+    for pdf_filepath in pdf_filepaths:
+        stem = os.path.splitext(os.path.basename(pdf_filepath))[0]
+        response_json = fixtures.get(stem) or analyze_pdf(pdf_filepath)
+        yield pdf_filepath, pipeline.process_figures(pdf_filepath, response_json)
+
+
+def render_profile(documents, profile, work_dir, max_workers):
+    """
+    Render every document with one profile. Returns (stats, {(document, image_name): filepath}).
+    """
+    METRICS.reset()
+    written = {}
+    start = time.perf_counter()
+    for pdf_filepath, figure_list in documents:
+        pdf_name = os.path.splitext(os.path.basename(pdf_filepath))[0]
+        diagrams_dir = os.path.join(work_dir, profile, pdf_name, "diagrams")
+        for image_name, filepath in pipeline.render_figure_list(figure_list, diagrams_dir, max_workers=max_workers, profile=profile).items():
+            written[(pdf_name, image_name)] = filepath
+    seconds = time.perf_counter() - start
+
+    summary = METRICS.summary()
+    counters, spans = summary["counters"], summary["spans"]
+    files = [os.path.join(root, name) for root, _, names in os.walk(os.path.join(work_dir, profile)) for name in names]
+    stats = {
+        "figures": len(written),
+        "files": len(files),
+        "bytes": sum(os.path.getsize(path) for path in files),
+        "full_size_bytes": sum(os.path.getsize(path) for path in written.values()),
+        "seconds": seconds,
+        "rasterize_seconds": spans.get("rasterize_page", {}).get("total_seconds", 0.0),
+        "encode_seconds": sum(stats["total_seconds"] for name, stats in spans.items() if name.startswith("encode_")),
+        "bytes_by_format": {name[len("output_bytes_"):]: value for name, value in counters.items() if name.startswith("output_bytes_")},
+    }
+    return stats, written
+
+
+def run_benchmark(pdf_filepaths, profiles, fixtures, max_workers):
+    documents = list(figure_lists(pdf_filepaths, fixtures))
+    work_dir = tempfile.mkdtemp(prefix="bench_profiles_")
+    try:
+        results = {}
+        reference = None
+        for profile in [REFERENCE_PROFILE] + [profile for profile in profiles if profile != REFERENCE_PROFILE]:
+            stats, written = render_profile(documents, profile, work_dir, max_workers)
+            if profile == REFERENCE_PROFILE:
+                reference = written
+            scores = [psnr(reference[key], path) for key, path in written.items() if key in reference]
+            finite = [score for score in scores if score != float("inf")]
+            stats["mean_psnr"] = float(np.mean(finite)) if finite else None
+            stats["min_psnr"] = float(min(finite)) if finite else None
+            if profile in profiles:
+                results[profile] = stats
+        return results
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def print_table(results):
+    reference_bytes = results.get(REFERENCE_PROFILE, {}).get("bytes")
+    print(f"{'profile':<10} {'figures':>7} {'files':>6} {'MB':>8} {'vs ref':>7} {'total s':>8} {'raster s':>9} {'encode s':>9} {'mean PSNR':>10} {'min PSNR':>9}")
+    for profile, stats in results.items():
+        ratio = f"{stats['bytes'] / reference_bytes:6.2f}x" if reference_bytes else "      -"
+        mean_psnr = f"{stats['mean_psnr']:10.1f}" if stats["mean_psnr"] is not None else f"{'lossless':>10}"
+        min_psnr = f"{stats['min_psnr']:9.1f}" if stats["min_psnr"] is not None else f"{'lossless':>9}"
+        print(f"{profile:<10} {stats['figures']:>7} {stats['files']:>6} {stats['bytes'] / 1e6:8.2f} {ratio} {stats['seconds']:8.2f} {stats['rasterize_seconds']:9.2f} {stats['encode_seconds']:9.2f} {mean_psnr} {min_psnr}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare output size, encode time and fidelity of the output profiles.")
+    parser.add_argument("pdfs", nargs="*", help=f"PDFs to render. Defaults to {DEFAULT_PDFS_GLOB}.")
+    parser.add_argument("--profiles", nargs="+", choices=sorted(OUTPUT_PROFILES), default=list(OUTPUT_PROFILES), help="Profiles to compare.")
+    parser.add_argument("--fixtures-dir", default=DEFAULT_FIXTURES_DIR, help="Directory of recorded <pdf stem>.json responses.")
+    parser.add_argument("--max-workers", type=int, default=1, help="Render processes per document.")
+    parser.add_argument("--output", help="Write the results as JSON to this file.")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.pdfs or sorted(glob.glob(DEFAULT_PDFS_GLOB)), args.profiles, load_fixtures(args.fixtures_dir), args.max_workers)
+    print_table(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"created_at": time.strftime("%Y-%m-%dT%H:%M:%S"), "reference": REFERENCE_PROFILE, "results": results}, f, indent=2)
+        print(f"Results written to {args.output}")
@@ -0,0 +1,92 @@
+"""
+What the raster cache saves the steps that reuse rendered figures: hashing and the classifier's pre-filter.
+
+Renders the figures of the sample PDFs serially (so their pixels land in this process's raster
+cache), then runs the perceptual hash and the pre-filter statistics over every written figure twice:
+once decoding each file from disk, as before the cache, and once from the cache, reporting the
+total and the time spent getting the pixels. Raise RASTER_CACHE_BYTES to keep every figure. Figures are linked
+from the recorded responses in sample_data/responses/ where there is one, and from the offline
+layout engine otherwise.
+
+Usage:
+python benchmarks/bench_raster_cache.py
+python benchmarks/bench_raster_cache.py sample_data/dl15.pdf --profile compact
+"""
+import os
+import sys
+import glob
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import image_extraction_pipeline as pipeline
+from figure_encoding import OUTPUT_PROFILES
+from diagram_dedup import phash_image
+from openai_gpt4v import image_statistics
+from raster_cache import RasterCache, get_raster_cache, open_image
+from local_layout import analyze_pdf
+from mock_layout_server import load_fixtures, DEFAULT_FIXTURES_DIR
+
+DEFAULT_PDFS_GLOB = "sample_data/*.pdf"
+
+
+def reuse(image_paths, cache):
+    """
+    (seconds getting the pixels through cache, seconds hashing and pre-filtering them) over every image
+    """
+    load_seconds = compute_seconds = 0.0
+    for image_path in image_paths:
+        start = time.perf_counter()
+        image = open_image(image_path, cache)
+        loaded = time.perf_counter()
+        phash_image(image)
+        image_statistics(image)
+        load_seconds += loaded - start
+        compute_seconds += time.perf_counter() - loaded
+    return load_seconds, compute_seconds
+
+
+def run_benchmark(pdf_filepaths, fixtures, profile):
+    work_dir = tempfile.mkdtemp(prefix="bench_raster_cache_")
+    try:
+        image_paths = []
+        start = time.perf_counter()
+        for pdf_filepath in pdf_filepaths:
+            stem = os.path.splitext(os.path.basename(pdf_filepath))[0]
+            figure_list = pipeline.process_figures(pdf_filepath, fixtures.get(stem) or analyze_pdf(pdf_filepath))
+            diagrams_dir = os.path.join(work_dir, stem, "diagrams")
+            written = pipeline.render_figure_list(figure_list, diagrams_dir, max_workers=1, profile=profile, keep_pixels=True)
+            image_paths.extend(written.values())
+        render_seconds = time.perf_counter() - start
+
+        cache = get_raster_cache()
+        disk_load_seconds, disk_compute_seconds = reuse(image_paths, RasterCache(max_bytes=0))
+        cache_load_seconds, cache_compute_seconds = reuse(image_paths, cache)
+        return {
+            "figures": len(image_paths),
+            "render_seconds": render_seconds,
+            "disk_seconds": disk_load_seconds + disk_compute_seconds,
+            "disk_load_seconds": disk_load_seconds,
+            "cache_seconds": cache_load_seconds + cache_compute_seconds,
+            "cache_load_seconds": cache_load_seconds,
+            "cached_figures": sum(1 for key in cache._entries if key[0] == "figure"),
+            "cache_mb": cache.nbytes / 1e6,
+        }
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare hashing and pre-filtering rendered figures from disk and from the raster cache.")
+    parser.add_argument("pdfs", nargs="*", help=f"PDFs to render. Defaults to {DEFAULT_PDFS_GLOB}.")
+    parser.add_argument("--profile", choices=sorted(OUTPUT_PROFILES), default="archival", help="Output profile to render with.")
+    parser.add_argument("--fixtures-dir", default=DEFAULT_FIXTURES_DIR, help="Directory of recorded <pdf stem>.json responses.")
+    args = parser.parse_args()
+
+    stats = run_benchmark(args.pdfs or sorted(glob.glob(DEFAULT_PDFS_GLOB)), load_fixtures(args.fixtures_dir), args.profile)
+    print(f"{stats['figures']} figures rendered in {stats['render_seconds']:.2f}s, {stats['cached_figures']} kept in the raster cache ({stats['cache_mb']:.0f} MB)")
+    print(f"hash + pre-filter from disk  {stats['disk_seconds']:7.2f}s, {stats['disk_load_seconds']:6.2f}s of it decoding")
+    print(f"hash + pre-filter from cache {stats['cache_seconds']:7.2f}s, {stats['cache_load_seconds']:6.2f}s of it decoding misses")
@@ -0,0 +1,249 @@
+"""
+Local stand-in for the Upstage layout analyzer that replays recorded responses.
+
+Uploads are matched to a fixture in sample_data/responses/ by the uploaded file name: "<pdf stem>.pdf"
+gets <pdf stem>.json, and the chunk uploads "<pdf stem>_<i>.pdf" get the pages of that chunk (the chunk
+size must match the pipeline's, DEFAULT_CHUNK_PAGES by default). Uploads packed by page triage hold only
+some pages of the document; when the original PDF is in pdf_dir, the uploaded pages are matched to its
+pages (as page_triage.py would keep them) and only those pages of the fixture are served. Each response is delayed by
+latency + latency_per_page * pages, scaled by a random factor within +-jitter, so concurrency can be
+tuned against realistic round trips without network access. With error_rate, that share of requests
+is answered with a 429 (with Retry-After) or a 503 instead, to exercise the client's retries.
+
+Usage:
+python benchmarks/mock_layout_server.py --port 8765 --latency 2.0
+UPSTAGE_LAYOUT_URL=http://127.0.0.1:8765/v1/document-ai/layout-analyzer python image_extraction_pipeline.py sample_data/dl15.pdf
+"""
+import os
+import re
+import sys
+import glob
+import json
+import time
+import random
+import argparse
+import threading
+from email import policy
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fitz
+
+from image_extraction_pipeline import HTML_ID_PATTERN, DEFAULT_CHUNK_PAGES
+from page_triage import triage_pdf
+
+#################### CONFIG ####################
+
+DEFAULT_FIXTURES_DIR = "sample_data/responses"
+DEFAULT_PDF_DIR = "sample_data"
+LAYOUT_PATH = "/v1/document-ai/layout-analyzer"
+CHUNK_FILENAME_PATTERN = re.compile(r"^(?P<stem>.+)_(?P<index>\d+)\.pdf$")
+
+
+def load_fixtures(fixtures_dir=DEFAULT_FIXTURES_DIR):
+    """
+    Recorded responses by PDF stem
+    """
+    fixtures = {}
+    for path in sorted(glob.glob(os.path.join(fixtures_dir, "*.json"))):
+        with open(path, "r") as f:
+            fixtures[os.path.splitext(os.path.basename(path))[0]] = json.load(f)
+    return fixtures
+
+
+def page_signature(page):
+    """
+    What identifies a page of a PDF after it was copied into another one: its size and text
+    """
+    return (round(page.rect.width), round(page.rect.height), page.get_text("text"))
+
+
+def slice_response(response_json, pages):
+    """
+    The part of a response covering pages (1-based, in document order), renumbered as the layout
+    analyzer would number a PDF holding only those pages
+    """
+    positions = {page: position for position, page in enumerate(pages, start=1)}
+    elements = [element for element in response_json["elements"] if element["page"] in positions]
+    sliced = []
+    for element_id, element in enumerate(elements):
+        element = dict(element, page=positions[element["page"]], id=element_id)
+        if element.get("html"):
+            element["html"] = HTML_ID_PATTERN.sub(lambda m: f"{m.group(1)}{element_id}{m.group(3)}", element["html"])
+        sliced.append(element)
+    response = {key: value for key, value in response_json.items() if key != "elements"}
+    if "billed_pages" in response:
+        response["billed_pages"] = len(pages)
+    response["elements"] = sliced
+    return response
+
+
+class MockLayoutServer(ThreadingHTTPServer):
+    """
+    Example usage:
+    server = MockLayoutServer(load_fixtures(), latency=1.0)
+    server.start()
+    ... post to server.url ...
+    server.stop()
+    """
+    daemon_threads = True
+
+    def __init__(self, fixtures, host="127.0.0.1", port=0, latency=0.0, latency_per_page=0.0, jitter=0.0, chunk_pages=DEFAULT_CHUNK_PAGES, seed=None, error_rate=0.0, retry_after=1, pdf_dir=DEFAULT_PDF_DIR):
+        super().__init__((host, port), MockLayoutHandler)
+        self.fixtures = fixtures
+        self.latency = latency
+        self.latency_per_page = latency_per_page
+        self.jitter = jitter
+        self.chunk_pages = chunk_pages
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.pdf_dir = pdf_dir
+        self.random = random.Random(seed)
+        self.num_requests = 0
+        self._lock = threading.Lock()
+        self._originals = {}  # stem -> (page signatures, kept page indices) of the original PDF, or None
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}{LAYOUT_PATH}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def original(self, stem):
+        """
+        (page signatures, page indices kept by page triage) of the PDF a fixture was recorded from,
+        or None if it is not in pdf_dir
+        """
+        with self._lock:
+            if stem in self._originals:
+                return self._originals[stem]
+        pdf_filepath = os.path.join(self.pdf_dir or "", f"{stem}.pdf")
+        original = None
+        if self.pdf_dir and os.path.exists(pdf_filepath):
+            with fitz.open(pdf_filepath) as pdf_document:
+                signatures = [page_signature(page) for page in pdf_document]
+            original = (signatures, triage_pdf(pdf_filepath).pages)
+        with self._lock:
+            self._originals[stem] = original
+        return original
+
+    def uploaded_pages(self, stem, chunk_index, document):
+        """
+        The 1-based pages of the original document an upload holds: the whole document or chunk
+        chunk_index (1-based, None for a whole-document upload), with or without page triage.
+        """
+        with fitz.open(stream=document, filetype="pdf") as pdf_document:
+            signatures = [page_signature(page) for page in pdf_document]
+        first = 0 if chunk_index is None else (chunk_index - 1) * self.chunk_pages
+        all_pages = range(first, first + len(signatures))
+        original = self.original(stem)
+        if original is not None:
+            original_signatures, kept_pages = original
+            for candidate in (all_pages, kept_pages[first:first + len(signatures)]):
+                if len(candidate) == len(signatures) and all(candidate[i] < len(original_signatures) and original_signatures[candidate[i]] == signature for i, signature in enumerate(signatures)):
+                    return [index + 1 for index in candidate]
+        return [index + 1 for index in all_pages]
+
+    def response_for(self, filename, document):
+        """
+        The recorded response for an uploaded document, or None if there is no fixture for it
+        """
+        stem, chunk_index = os.path.splitext(filename)[0], None
+        match = CHUNK_FILENAME_PATTERN.match(filename)
+        if stem not in self.fixtures and match:
+            stem, chunk_index = match.group("stem"), int(match.group("index"))
+        if stem not in self.fixtures:
+            return None
+        if chunk_index is None and self.original(stem) is None:
+            return self.fixtures[stem]
+        return slice_response(self.fixtures[stem], self.uploaded_pages(stem, chunk_index, document))
+
+    def delay_for(self, response_json):
+        num_pages = max((element["page"] for element in response_json["elements"]), default=0)
+        with self._lock:
+            self.num_requests += 1
+            scale = 1 + self.random.uniform(-self.jitter, self.jitter)
+        return max(0.0, (self.latency + self.latency_per_page * num_pages) * scale)
+
+    def injected_error(self):
+        """
+        None, or the status of an error to answer this request with
+        """
+        with self._lock:
+            if self.random.random() >= self.error_rate:
+                return None
+            return self.random.choice([429, 503])
+
+
+class MockLayoutHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body, headers=None):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        if self.path != LAYOUT_PATH:
+            return self._send_json(404, {"message": f"Unknown path {self.path}"})
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        message = BytesParser(policy=policy.HTTP).parsebytes(f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + body)
+        document = next((part for part in message.iter_parts() if part.get_param("name", header="content-disposition") == "document"), None) if message.is_multipart() else None
+        if document is None:
+            return self._send_json(400, {"message": "Expected a multipart upload with a 'document' field"})
+
+        error_status = self.server.injected_error()
+        if error_status == 429:
+            return self._send_json(429, {"message": "Too many requests"}, headers={"Retry-After": str(self.server.retry_after)})
+        if error_status is not None:
+            return self._send_json(error_status, {"message": "Service unavailable"})
+
+        response_json = self.server.response_for(document.get_filename() or "", document.get_payload(decode=True))
+        if response_json is None:
+            return self._send_json(404, {"message": f"No recorded response for {document.get_filename()}"})
+        time.sleep(self.server.delay_for(response_json))
+        self._send_json(200, response_json)
+
+
+############################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve recorded layout-analyzer responses locally.")
+    parser.add_argument("--fixtures-dir", default=DEFAULT_FIXTURES_DIR, help="Directory of recorded <pdf stem>.json responses.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every response.")
+    parser.add_argument("--latency-per-page", type=float, default=0.0, help="Seconds added per page of the response.")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Random relative variation of the delay, e.g. 0.2 for +-20%%.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with a 429 or 503.")
+    parser.add_argument("--chunk-pages", type=int, default=DEFAULT_CHUNK_PAGES, help="Pages per chunk upload, as configured in the pipeline.")
+    parser.add_argument("--pdf-dir", default=DEFAULT_PDF_DIR, help="Directory holding the PDFs the fixtures were recorded from, to serve page-triaged uploads.")
+    args = parser.parse_args()
+
+    fixtures = load_fixtures(args.fixtures_dir)
+    server = MockLayoutServer(fixtures, host=args.host, port=args.port, latency=args.latency, latency_per_page=args.latency_per_page, jitter=args.jitter, chunk_pages=args.chunk_pages, error_rate=args.error_rate, pdf_dir=args.pdf_dir)
+    print(f"Replaying {len(fixtures)} recorded responses at {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,57 @@
+"""
+Record layout-analyzer responses for the sample PDFs as benchmark fixtures.
+
+Each PDF is uploaded whole (no chunking) and the response written to sample_data/responses/<pdf stem>.json,
+where bench_process_figures.py, bench_pipeline.py and the mock layout server pick it up. Needs
+UPSTAGE_API_KEY. Without network access, --backend local records the offline engine's output instead;
+such fixtures carry "model": "pymupdf-layout" and exercise the same code paths.
+
+Usage:
+python benchmarks/record_fixtures.py
+python benchmarks/record_fixtures.py sample_data/Attention.pdf sample_data/dl15.pdf --overwrite
+"""
+import os
+import sys
+import glob
+import json
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from image_extraction_pipeline import get_element_json_from_pdf
+from run_manifest import atomic_output
+
+DEFAULT_PDFS_GLOB = "sample_data/*.pdf"
+DEFAULT_FIXTURES_DIR = "sample_data/responses"
+
+
+def record_fixture(pdf_filepath, fixtures_dir=DEFAULT_FIXTURES_DIR, backend="remote", overwrite=False):
+    """
+    Returns the fixture path, or None if it already existed and overwrite is False.
+    """
+    fixture_path = os.path.join(fixtures_dir, f"{os.path.splitext(os.path.basename(pdf_filepath))[0]}.json")
+    if os.path.exists(fixture_path) and not overwrite:
+        return None
+    response_json = get_element_json_from_pdf(pdf_filepath, cache=None, chunk_pages=0, backend=backend, page_triage=False)
+    os.makedirs(fixtures_dir, exist_ok=True)
+    with atomic_output(fixture_path) as tmp_filepath:
+        with open(tmp_filepath, "w") as f:
+            json.dump(response_json, f, indent=1)
+    return fixture_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Record layout-analyzer responses as benchmark fixtures.")
+    parser.add_argument("pdfs", nargs="*", help=f"PDFs to record. Defaults to {DEFAULT_PDFS_GLOB}.")
+    parser.add_argument("--fixtures-dir", default=DEFAULT_FIXTURES_DIR, help="Directory to write <pdf stem>.json fixtures to.")
+    parser.add_argument("--backend", choices=["remote", "local"], default="remote", help="Record the layout API's responses, or the offline engine's.")
+    parser.add_argument("--overwrite", action="store_true", help="Re-record fixtures that already exist.")
+    args = parser.parse_args()
+
+    for pdf_filepath in args.pdfs or sorted(glob.glob(DEFAULT_PDFS_GLOB)):
+        try:
+            fixture_path = record_fixture(pdf_filepath, fixtures_dir=args.fixtures_dir, backend=args.backend, overwrite=args.overwrite)
+        except Exception as e:
+            print(f"Error recording {pdf_filepath}. Error: {e}")
+            continue
+        print(f"Recorded {fixture_path}" if fixture_path else f"Kept existing fixture for {pdf_filepath}")
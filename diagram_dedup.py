@@ -0,0 +1,402 @@
+"""
+Near-duplicate diagram detection across the corpus.
+
+Each rendered figure gets a 64-bit perceptual hash (pHash). Figures whose hashes are within
+DEFAULT_MAX_DISTANCE bits of each other collapse into one canonical figure that keeps a link to
+every source book, figure name and caption.
+
+Lookups go through an LSH index: the hash is cut into HASH_BANDS bands of 16 bits and
+each band is a bucket key. A query probes its exact bands plus every band one bit flip away,
+so any hash within 2 * HASH_BANDS - 1 bits shares a probed bucket. Only those candidates
+are compared, using vectorized NumPy Hamming distance.
+
+On disk the index is two append-only files, by default under <output dir>/diagram_dedup:
+- hashes.u64: one uint64 per canonical figure, the canonical id is its position
+- sources.jsonl: one line per source figure, {"canonical_id", "book", "image_name", ...}
+A write torn by a crash is cut off before the next append. Re-adding a book first drops its
+earlier source lines.
+
+A DedupIndex is kept for the whole run (see get_dedup_index) and only reads what other
+processes appended since its last look, so adding a book costs its own figures, not the corpus.
+"""
+import os
+import json
+import fcntl
+import tempfile
+import threading
+from collections import defaultdict
+
+import numpy as np
+from PIL import Image
+
+from figure_catalog import image_filename
+from raster_cache import open_image
+
+#################### CONFIG ####################
+
+DEDUP_DIRNAME = "diagram_dedup"
+DEFAULT_DEDUP_DIR = os.getenv("DIAGRAM_DEDUP_DIR")  # None: a diagram_dedup directory in each output directory
+DEFAULT_MAX_DISTANCE = 6
+
+HASH_SIZE = 8  # 8x8 DCT coefficients -> 64-bit hash
+HASH_IMAGE_SIZE = 32
+HASH_BANDS = 4
+BAND_BITS = 64 // HASH_BANDS
+BAND_MASK = (1 << BAND_BITS) - 1
+
+HASHES_FILENAME = "hashes.u64"
+SOURCES_FILENAME = "sources.jsonl"
+LOCK_FILENAME = ".lock"
+HASH_BYTES = 8
+
+
+def dedup_dir_for(output_dir):
+    """
+    The near-duplicate index of a pipeline output directory, unless DIAGRAM_DEDUP_DIR sets a shared one
+    """
+    return DEFAULT_DEDUP_DIR or os.path.join(output_dir, DEDUP_DIRNAME)
+
+
+############################################################
+### Perceptual hashing
+
+def _dct_matrix(n):
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    matrix = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+_DCT = _dct_matrix(HASH_IMAGE_SIZE)
+
+def phash_image(image):
+    """
+    Returns the 64-bit perceptual hash of a PIL image as an int.
+    """
+    pixels = np.asarray(image.convert("L").resize((HASH_IMAGE_SIZE, HASH_IMAGE_SIZE), Image.LANCZOS), dtype=np.float64)
+    coefficients = (_DCT @ pixels @ _DCT.T)[:HASH_SIZE, :HASH_SIZE].flatten()
+    # Compare against the median of the low frequencies, ignoring the DC term
+    bits = coefficients > np.median(coefficients[1:])
+    return int(np.packbits(bits).view(">u8")[0])
+
+def phash_file(image_path):
+    # Pixels rendered earlier in this process come from the raster cache instead of the file
+    return phash_image(open_image(image_path))
+
+def add_image_hashes(figure_list_dict, diagrams_dir, known_hashes=None):
+    """
+    Set "image_phash" (16 hex digits) on each figure dict whose image exists in diagrams_dir.
+
+    known_hashes maps image names to hashes already computed from the rendered pixels; only the
+    other figures are hashed from their files.
+    """
+    known_hashes = known_hashes or {}
+    for figure in figure_list_dict:
+        if figure["image_name"] in known_hashes:
+            figure["image_phash"] = known_hashes[figure["image_name"]]
+            continue
+        image_path = os.path.join(diagrams_dir, image_filename(figure))
+        if os.path.exists(image_path):
+            figure["image_phash"] = f"{phash_file(image_path):016x}"
+    return figure_list_dict
+
+def hamming_distances(hashes, value):
+    """
+    Vectorized Hamming distance between a uint64 array and one hash
+    """
+    xor = np.bitwise_xor(hashes, np.uint64(value))
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(xor)
+    return np.unpackbits(xor.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+
+############################################################
+### LSH index
+
+def _bands(value):
+    return [(value >> (band * BAND_BITS)) & BAND_MASK for band in range(HASH_BANDS)]
+
+_BIT_FLIPS = [0] + [1 << bit for bit in range(BAND_BITS)]
+
+def _whole_hashes(data):
+    return len(data) - len(data) % HASH_BYTES
+
+def _whole_lines(data):
+    return data.rfind(b"\n") + 1
+
+def _truncate_torn_tail(path, record_size=None, block_size=1 << 16):
+    """
+    Cut a file back to its last complete record, dropping what a crashed writer left half written:
+    a multiple of record_size bytes, or up to the last newline if record_size is None.
+    Only the tail of the file is read.
+    """
+    try:
+        with open(path, "r+b") as f:
+            size = f.seek(0, os.SEEK_END)
+            end = size - size % record_size if record_size else size
+            if record_size is None:
+                while end > 0:
+                    start = max(0, end - block_size)
+                    f.seek(start)
+                    newline = f.read(end - start).rfind(b"\n")
+                    if newline >= 0:
+                        end = start + newline + 1
+                        break
+                    end = start
+            if end < size:
+                f.truncate(end)
+    except FileNotFoundError:
+        pass
+
+class DedupIndex:
+    """
+    Canonical figures of the corpus, looked up by perceptual hash.
+
+    Thread-safe; writers in other processes are serialized by a file lock.
+
+    Example usage:
+    dedup = get_dedup_index("output_figures/diagram_dedup")
+    dedup.add_book("Attention", figure_list_dict)  # sets figure["canonical_id"]
+    dedup.sources(figure_list_dict[0]["canonical_id"])
+    """
+    def __init__(self, dedup_dir, max_distance=DEFAULT_MAX_DISTANCE):
+        if max_distance > 2 * HASH_BANDS - 1:
+            raise ValueError(f"max_distance must be at most {2 * HASH_BANDS - 1} for {HASH_BANDS} bands")
+        self.dedup_dir = dedup_dir
+        self.max_distance = max_distance
+        os.makedirs(dedup_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._hashes = np.empty(0, dtype=np.uint64)
+        self._num_sources = np.empty(0, dtype=np.int32)  # Source figures per canonical id
+        self._num_hashes = 0
+        self._buckets = [defaultdict(list) for _ in range(HASH_BANDS)]
+        self._book_ids = {}  # book -> canonical ids of its source figures
+        self._sources_inode = None
+        self._sources_offset = 0
+        with self._lock:
+            self._load_new()
+
+    def _path(self, filename):
+        return os.path.join(self.dedup_dir, filename)
+
+    ######## Loading ########
+
+    def _load_new(self):
+        """
+        Read what was appended to disk since the last load, including by other processes.
+
+        Sources are read before hashes: a source line is written after its hash, so every
+        canonical id it names is then loaded too. Half-written records at the end are skipped.
+        """
+        self._load_new_sources()
+        path = self._path(HASHES_FILENAME)
+        if not os.path.exists(path):
+            return
+        with open(path, "rb") as f:
+            f.seek(self._num_hashes * HASH_BYTES)
+            data = f.read()
+        self._append_hashes(np.frombuffer(data[:_whole_hashes(data)], dtype=np.uint64))
+
+    def _load_new_sources(self):
+        path = self._path(SOURCES_FILENAME)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return
+        if stat.st_ino != self._sources_inode or stat.st_size < self._sources_offset:
+            # Rewritten by another process dropping a book: count the sources again
+            self._num_sources[:] = 0
+            self._book_ids = {}
+            self._sources_inode, self._sources_offset = stat.st_ino, 0
+        with open(path, "rb") as f:
+            f.seek(self._sources_offset)
+            data = f.read()
+        end = _whole_lines(data)
+        # One JSON array decode for all new lines; json.dumps never writes a raw newline inside a line
+        new_sources = json.loads(b"[" + data[:end - 1].replace(b"\n", b",") + b"]") if end else []
+        for source in new_sources:
+            self._book_ids.setdefault(source["book"], []).append(source["canonical_id"])
+        self._count_sources([source["canonical_id"] for source in new_sources], 1)
+        self._sources_offset += end
+
+    def _reserve(self, size):
+        # Grow the arrays geometrically so adding a book stays linear in its figures
+        if size <= len(self._hashes):
+            return
+        capacity = max(1024, 2 * len(self._hashes), size)
+        hashes = np.empty(capacity, dtype=np.uint64)
+        hashes[:self._num_hashes] = self._hashes[:self._num_hashes]
+        num_sources = np.zeros(capacity, dtype=np.int32)
+        num_sources[:len(self._num_sources)] = self._num_sources
+        self._hashes, self._num_sources = hashes, num_sources
+
+    def _count_sources(self, canonical_ids, delta):
+        if canonical_ids:
+            canonical_ids = np.asarray(canonical_ids, dtype=np.int64)
+            self._reserve(int(canonical_ids.max()) + 1)
+            np.add.at(self._num_sources, canonical_ids, delta)
+
+    def _append_hashes(self, values):
+        """
+        Add canonical hashes in bulk, bucketing each band with one sort instead of per hash
+        """
+        if len(values) == 0:
+            return
+        start = self._num_hashes
+        self._reserve(start + len(values))
+        self._hashes[start:start + len(values)] = values
+        self._num_hashes += len(values)
+        canonical_ids = np.arange(start, start + len(values))
+        for band, bucket in enumerate(self._buckets):
+            band_values = (values >> np.uint64(band * BAND_BITS)) & np.uint64(BAND_MASK)
+            order = np.argsort(band_values, kind="stable")
+            keys, firsts = np.unique(band_values[order], return_index=True)
+            sorted_ids = canonical_ids[order].tolist()
+            bounds = firsts.tolist() + [len(values)]
+            for key, lo, hi in zip(keys.tolist(), bounds, bounds[1:]):
+                bucket[key].extend(sorted_ids[lo:hi])
+
+    def _append_hash(self, value):
+        self._reserve(self._num_hashes + 1)
+        canonical_id = self._num_hashes
+        self._hashes[canonical_id] = value
+        for band, band_value in enumerate(_bands(value)):
+            self._buckets[band][band_value].append(canonical_id)
+        self._num_hashes += 1
+        return canonical_id
+
+    ######## Lookup ########
+
+    def candidates(self, value):
+        """
+        Canonical ids sharing a bucket with value, probing one-bit neighbours of every band
+        """
+        found = set()
+        for band, band_value in enumerate(_bands(value)):
+            bucket = self._buckets[band]
+            for flip in _BIT_FLIPS:
+                found.update(bucket.get(band_value ^ flip, ()))
+        return np.fromiter(found, dtype=np.int64, count=len(found))
+
+    def find(self, value):
+        """
+        Returns the canonical id of the nearest figure within max_distance, or None.
+        """
+        candidate_ids = self.candidates(value)
+        if len(candidate_ids) == 0:
+            return None
+        distances = hamming_distances(self._hashes[candidate_ids], value)
+        nearest = int(np.argmin(distances))
+        if distances[nearest] > self.max_distance:
+            return None
+        return int(candidate_ids[nearest])
+
+    ######## Writing ########
+
+    def add_book(self, book, figure_list_dict):
+        """
+        Assign a "canonical_id" to every hashed figure of a book, creating canonical figures as needed.
+
+        Adding a book again replaces its earlier sources, so it is not matched against itself.
+
+        Args:
+        - book: The book name.
+        - figure_list_dict: Figure dicts with "image_phash" set (see add_image_hashes).
+
+        Returns:
+        - The number of figures that matched a canonical figure of another book or an earlier figure of this one.
+        """
+        num_duplicates = 0
+        with self._lock, open(self._path(LOCK_FILENAME), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            _truncate_torn_tail(self._path(HASHES_FILENAME), record_size=HASH_BYTES)
+            _truncate_torn_tail(self._path(SOURCES_FILENAME))
+            self._load_new()
+            if book in self._book_ids:
+                self._drop_book(book)
+
+            new_hashes, sources = [], []
+            for figure in figure_list_dict:
+                if not figure.get("image_phash"):
+                    continue
+                value = int(figure["image_phash"], 16)
+                canonical_id = self.find(value)
+                if canonical_id is None:
+                    canonical_id = self._append_hash(value)
+                    new_hashes.append(value)
+                elif self._num_sources[canonical_id] > 0:
+                    # A canonical figure left behind by an earlier version of this book is reused, not a duplicate
+                    num_duplicates += 1
+                self._num_sources[canonical_id] += 1
+                figure["canonical_id"] = canonical_id
+                sources.append({
+                    "canonical_id": canonical_id,
+                    "book": book,
+                    "image_name": figure.get("image_name"),
+                    "image_caption": figure.get("image_caption"),
+                    "original_doc_filepath": figure.get("original_doc_filepath"),
+                    "page_number": figure.get("page_number"),
+                })
+            with open(self._path(HASHES_FILENAME), "ab") as f:
+                f.write(np.asarray(new_hashes, dtype=np.uint64).tobytes())
+            with open(self._path(SOURCES_FILENAME), "ab") as f:
+                f.write("".join(json.dumps(source) + "\n" for source in sources).encode("utf-8"))
+            stat = os.stat(self._path(SOURCES_FILENAME))
+            self._sources_inode, self._sources_offset = stat.st_ino, stat.st_size
+            self._book_ids[book] = [source["canonical_id"] for source in sources]
+        return num_duplicates
+
+    def _drop_book(self, book):
+        """
+        Rewrite sources.jsonl without the book's lines. Call with the file lock held.
+        """
+        path = self._path(SOURCES_FILENAME)
+        fd, tmp_path = tempfile.mkstemp(dir=self.dedup_dir, prefix=f".{SOURCES_FILENAME}.")
+        with os.fdopen(fd, "wb") as tmp_file, open(path, "rb") as f:
+            for line in f:
+                if json.loads(line)["book"] != book:
+                    tmp_file.write(line)
+        os.replace(tmp_path, path)
+        self._count_sources(self._book_ids.pop(book), -1)
+        stat = os.stat(path)
+        self._sources_inode, self._sources_offset = stat.st_ino, stat.st_size
+
+    ######## Reading ########
+
+    def sources(self, canonical_id):
+        """
+        Every (book, figure, caption) a canonical figure appears as, latest entry per book and figure name.
+        """
+        found = {}
+        try:
+            with open(self._path(SOURCES_FILENAME), "rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break  # Half written by a crashed writer
+                    source = json.loads(line)
+                    if source["canonical_id"] == canonical_id:
+                        found[(source["book"], source["image_name"])] = source
+        except FileNotFoundError:
+            pass
+        return list(found.values())
+
+    def __len__(self):
+        return self._num_hashes
+
+
+############################################################
+### Shared index
+# One DedupIndex per directory and process, kept for the whole run; worker processes each get their own.
+_dedup_indexes = {}
+_dedup_indexes_pid = None
+_dedup_indexes_lock = threading.Lock()
+
+def get_dedup_index(dedup_dir):
+    global _dedup_indexes, _dedup_indexes_pid
+    with _dedup_indexes_lock:
+        if _dedup_indexes_pid != os.getpid():
+            _dedup_indexes, _dedup_indexes_pid = {}, os.getpid()
+        key = os.path.abspath(dedup_dir)
+        if key not in _dedup_indexes:
+            _dedup_indexes[key] = DedupIndex(dedup_dir)
+        return _dedup_indexes[key]
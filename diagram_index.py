@@ -0,0 +1,556 @@
+"""
+Diagram Retrieval API: an on-disk BM25 inverted index over figure captions and descriptions.
+
+The index is a directory of immutable segments, one per book as it is added, plus an
+index.json manifest. Each segment stores its postings, document lengths and figure records
+in flat binary files that are memory-mapped at query time (small ones are read into memory),
+so a query only touches the postings of its own terms. Re-adding a book marks its old
+documents deleted. Whenever MERGE_FACTOR segments of the same size tier pile up they are
+merged into one, so the number of segments grows with the log of the corpus size rather than
+with the number of books; `compact` merges all segments into one. Merges drop deleted documents.
+
+Usage:
+python diagram_index.py build output_figures
+python diagram_index.py query "scaled dot-product attention" -k 5
+python diagram_index.py compact
+"""
+import os
+import re
+import json
+import glob
+import mmap
+import fcntl
+import argparse
+import tempfile
+from collections import Counter, defaultdict
+
+import numpy as np
+
+from figure_catalog import FigureCatalog, catalog_path_for, image_filename
+from instrumentation import get_logger, configure_logging
+
+#################### CONFIG ####################
+
+INDEX_DIRNAME = "diagram_index"
+DEFAULT_INDEX_DIR = os.getenv("DIAGRAM_INDEX_DIR")  # None: a diagram_index directory in each output directory
+DEFAULT_OUTPUT_DIR = "output_figures"
+DEFAULT_TOP_K = 10
+
+# BM25 parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+logger = get_logger("index")
+
+MANIFEST_FILENAME = "index.json"
+MERGE_FACTOR = 10  # Segments of one size tier merged at once; a tier holds segments of MERGE_FACTOR**tier docs or more
+MMAP_MIN_BYTES = 1 << 20  # Smaller segment files are read into memory instead of mapped, so they hold no file descriptor
+LOCK_FILENAME = ".lock"
+MAX_TF = np.iinfo(np.uint16).max
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset("""
+a an and are as at be by for from has in is it its of on or that the this to was were which with
+""".split())
+
+
+def index_dir_for(output_dir):
+    """
+    The diagram index of a pipeline output directory, unless DIAGRAM_INDEX_DIR sets a shared one
+    """
+    return DEFAULT_INDEX_DIR or os.path.join(output_dir, INDEX_DIRNAME)
+
+
+def tokenize(text):
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOPWORDS]
+
+
+def figure_text(figure):
+    """
+    The indexed text of a figure: its name, caption and descriptions
+    """
+    parts = [figure.get("image_name") or "", figure.get("image_caption") or ""]
+    parts.extend(figure.get("image_descriptions") or [])
+    return " ".join(parts)
+
+
+def _write_atomic(path, data):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _map_array(path, dtype):
+    """
+    Memory-maps a flat binary file as a read-only NumPy array. Files under MMAP_MIN_BYTES are read instead.
+    """
+    size = os.path.getsize(path)
+    if size == 0:
+        return np.empty(0, dtype=dtype), None
+    with open(path, "rb") as f:
+        if size < MMAP_MIN_BYTES:
+            return np.frombuffer(f.read(), dtype=dtype), None
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return np.frombuffer(mapped, dtype=dtype), mapped
+
+
+def _live_docs(segment_info):
+    return segment_info["num_docs"] - sum(end - start for start, end in segment_info["deleted"])
+
+
+def _num_live_postings(segment_info, docids):
+    """
+    How many of a term's postings in a segment belong to live documents
+    """
+    num_postings = len(docids)
+    for start, end in segment_info["deleted"]:
+        # Postings are sorted by doc id
+        num_postings -= int(np.searchsorted(docids, end) - np.searchsorted(docids, start))
+    return num_postings
+
+
+def _live_len(segment, segment_info):
+    return segment_info["total_len"] - sum(int(segment.doclens[start:end].sum()) for start, end in segment_info["deleted"])
+
+
+def _tier(num_docs):
+    """
+    The size tier of a segment: 0 below MERGE_FACTOR docs, 1 below MERGE_FACTOR**2, ...
+    """
+    tier = 0
+    while num_docs >= MERGE_FACTOR:
+        num_docs //= MERGE_FACTOR
+        tier += 1
+    return tier
+
+
+############################################################
+### Segments
+
+class Segment:
+    """
+    A read-only, memory-mapped index segment.
+
+    Every file, the figure records included, is mapped or read when the segment is opened, so a
+    merge in another process deleting the files does not disturb searches still holding it.
+    """
+    def __init__(self, index_dir, name):
+        self.name = name
+        prefix = os.path.join(index_dir, name)
+        with open(f"{prefix}.terms.json", "r") as f:
+            self.terms = json.load(f)  # term -> [start, length] into the postings arrays
+        self._maps = []
+        self.docids = self._map(f"{prefix}.docids", np.uint32)
+        self.tfs = self._map(f"{prefix}.tfs", np.uint16)
+        self.doclens = self._map(f"{prefix}.doclens", np.uint32)
+        self.docoffsets = self._map(f"{prefix}.docoffsets", np.uint64)
+        self.docs = self._map(f"{prefix}.docs.jsonl", np.uint8)
+        self.num_docs = len(self.doclens)
+
+    def _map(self, path, dtype):
+        array, mapped = _map_array(path, dtype)
+        if mapped is not None:
+            self._maps.append(mapped)
+        return array
+
+    def postings(self, term):
+        entry = self.terms.get(term)
+        if entry is None:
+            return None, None
+        start, length = entry
+        return self.docids[start:start + length], self.tfs[start:start + length]
+
+    def document(self, doc_id):
+        start, end = int(self.docoffsets[doc_id]), int(self.docoffsets[doc_id + 1])
+        return json.loads(self.docs[start:end].tobytes())
+
+    def documents(self):
+        """
+        All figure records of the segment, in doc id order
+        """
+        return [json.loads(line) for line in self.docs.tobytes().split(b"\n")[:-1]]
+
+    def close(self):
+        # The maps are unmapped once the last array view into them is garbage collected
+        self.docids = self.tfs = self.doclens = self.docoffsets = self.docs = None
+        self._maps = []
+
+
+def write_segment(index_dir, name, records, postings, doclens):
+    """
+    Write a segment to disk.
+
+    Args:
+    - index_dir: The index directory.
+    - name: Segment name, used as the file prefix.
+    - records: List of figure record dicts, in doc id order.
+    - postings: Dict of term -> list of (doc_id, tf), doc ids ascending.
+    - doclens: List of document lengths in tokens, in doc id order.
+    """
+    prefix = os.path.join(index_dir, name)
+    terms = {}
+    docids, tfs = [], []
+    for term in sorted(postings):
+        entries = postings[term]
+        terms[term] = [len(docids), len(entries)]
+        for doc_id, tf in entries:
+            docids.append(doc_id)
+            tfs.append(min(tf, MAX_TF))
+
+    doc_bytes = [json.dumps(record).encode("utf-8") + b"\n" for record in records]
+    docoffsets = np.zeros(len(doc_bytes) + 1, dtype=np.uint64)
+    np.cumsum([len(b) for b in doc_bytes], out=docoffsets[1:])
+
+    _write_atomic(f"{prefix}.docids", np.asarray(docids, dtype=np.uint32).tobytes())
+    _write_atomic(f"{prefix}.tfs", np.asarray(tfs, dtype=np.uint16).tobytes())
+    _write_atomic(f"{prefix}.doclens", np.asarray(doclens, dtype=np.uint32).tobytes())
+    _write_atomic(f"{prefix}.docoffsets", docoffsets.tobytes())
+    _write_atomic(f"{prefix}.docs.jsonl", b"".join(doc_bytes))
+    # The terms file is written last; the manifest only references complete segments
+    _write_atomic(f"{prefix}.terms.json", json.dumps(terms).encode("utf-8"))
+
+
+def _delete_segment_files(index_dir, name):
+    for path in glob.glob(os.path.join(index_dir, f"{name}.*")):
+        os.remove(path)
+
+
+############################################################
+### Index
+
+class DiagramIndex:
+    """
+    BM25 retrieval over (diagram, caption) pairs.
+
+    Example usage:
+    index = DiagramIndex("output_figures/diagram_index")
+    index.add_book("Attention", figure_list_dict, image_dir="output_figures/Attention/diagrams")
+    index.search("multi-head attention", k=5)
+    """
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        os.makedirs(index_dir, exist_ok=True)
+        self._segments = {}
+        self._manifest = None
+        self._manifest_mtime = None
+
+    ######## Manifest ########
+    # {"segments": [{"name", "num_docs", "total_len", "books": {book: [start, end]}, "deleted": [[start, end], ...]}],
+    #  "next_segment": int}
+
+    def _manifest_path(self):
+        return os.path.join(self.index_dir, MANIFEST_FILENAME)
+
+    def _read_manifest(self):
+        try:
+            with open(self._manifest_path(), "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"segments": [], "next_segment": 0}
+
+    def _write_manifest(self, manifest):
+        _write_atomic(self._manifest_path(), json.dumps(manifest, indent=1).encode("utf-8"))
+
+    def _lock(self):
+        lock_file = open(os.path.join(self.index_dir, LOCK_FILENAME), "w")
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def _refresh(self, attempts=3):
+        """
+        Reload the manifest and open any new segments if another writer changed the index
+        """
+        try:
+            mtime = os.stat(self._manifest_path()).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if self._manifest is not None and mtime == self._manifest_mtime:
+            return
+        manifest = self._read_manifest()
+        live = {segment["name"] for segment in manifest["segments"]}
+        for name in list(self._segments):
+            if name not in live:
+                self._segments.pop(name).close()
+        try:
+            for name in live:
+                if name not in self._segments:
+                    self._segments[name] = Segment(self.index_dir, name)
+        except FileNotFoundError:
+            # A merge in another process deleted the segment after the manifest was read; the new manifest lists its successor
+            if attempts <= 1:
+                raise
+            self._manifest = None
+            return self._refresh(attempts - 1)
+        self._manifest = manifest
+        self._manifest_mtime = mtime
+
+    ######## Writing ########
+
+    def add_book(self, book, figure_list_dict, image_dir=None):
+        """
+        Index the figures of one book as a new segment, replacing any earlier version of the book.
+
+        Args:
+        - book: The book name, usually the PDF name without extension.
+        - figure_list_dict: The list of figure dicts written to <book>_figure_list.json.
+        - image_dir: Directory holding the figure images (see image_filename).
+        """
+        records, postings, doclens = [], defaultdict(list), []
+        for figure in figure_list_dict:
+            tokens = tokenize(figure_text(figure))
+            doc_id = len(records)
+            records.append({
+                "book": book,
+                "image_name": figure.get("image_name"),
+                "image_caption": figure.get("image_caption"),
+                "image_path": os.path.join(image_dir, image_filename(figure)) if image_dir else None,
+                "page_number": figure.get("page_number"),
+                "original_doc_filepath": figure.get("original_doc_filepath"),
+                "canonical_id": figure.get("canonical_id"),
+            })
+            doclens.append(len(tokens))
+            for term, tf in Counter(tokens).items():
+                postings[term].append((doc_id, tf))
+
+        with self._lock():
+            manifest = self._read_manifest()
+            name = f"seg_{manifest['next_segment']:06d}"
+            write_segment(self.index_dir, name, records, postings, doclens)
+            self._delete_book(manifest, book)
+            manifest["segments"].append({"name": name, "num_docs": len(records), "total_len": sum(doclens), "books": {book: [0, len(records)]}, "deleted": []})
+            manifest["next_segment"] += 1
+            self._write_manifest(manifest)
+            self._collect_empty_segments(manifest)
+            self._merge_tiers(manifest)
+
+    def remove_book(self, book):
+        with self._lock():
+            manifest = self._read_manifest()
+            if self._delete_book(manifest, book):
+                self._write_manifest(manifest)
+                self._collect_empty_segments(manifest)
+
+    def _delete_book(self, manifest, book):
+        deleted = False
+        for segment in manifest["segments"]:
+            doc_range = segment["books"].pop(book, None)
+            if doc_range is not None:
+                segment["deleted"].append(doc_range)
+                deleted = True
+        return deleted
+
+    def _collect_empty_segments(self, manifest):
+        """
+        Drop segments whose books have all been deleted
+        """
+        empty = [segment for segment in manifest["segments"] if not segment["books"]]
+        if not empty:
+            return
+        manifest["segments"] = [segment for segment in manifest["segments"] if segment["books"]]
+        self._write_manifest(manifest)
+        for segment in empty:
+            if segment["name"] in self._segments:
+                self._segments.pop(segment["name"]).close()
+            _delete_segment_files(self.index_dir, segment["name"])
+
+    def compact(self):
+        """
+        Merge all segments into one, dropping deleted documents
+        """
+        with self._lock():
+            manifest = self._read_manifest()
+            if len(manifest["segments"]) <= 1 and not any(s["deleted"] for s in manifest["segments"]):
+                return
+            self._merge(manifest, manifest["segments"])
+
+    def _merge_tiers(self, manifest):
+        """
+        Merge the segments of any size tier holding MERGE_FACTOR or more, until none does
+        """
+        while True:
+            tiers = defaultdict(list)
+            for segment_info in manifest["segments"]:
+                tiers[_tier(_live_docs(segment_info))].append(segment_info)
+            full = [segment_infos for _, segment_infos in sorted(tiers.items()) if len(segment_infos) >= MERGE_FACTOR]
+            if not full:
+                return
+            self._merge(manifest, full[0])
+
+    def _merge(self, manifest, segment_infos):
+        """
+        Replace segment_infos in the manifest by one segment holding their live documents. Call with the lock held.
+        """
+        records, postings, doclens, books = [], defaultdict(list), [], {}
+        for segment_info in segment_infos:
+            segment = Segment(self.index_dir, segment_info["name"])
+            segment_records = segment.documents()
+            remap = np.full(segment.num_docs, -1, dtype=np.int64)
+            for book, (start, end) in sorted(segment_info["books"].items(), key=lambda item: item[1][0]):
+                books[book] = [len(records), len(records) + end - start]
+                remap[start:end] = np.arange(len(records), len(records) + end - start)
+                records.extend(segment_records[start:end])
+                doclens.extend(segment.doclens[start:end].tolist())
+            for term, (start, length) in segment.terms.items():
+                new_ids = remap[segment.docids[start:start + length]]
+                tfs = segment.tfs[start:start + length]
+                keep = new_ids >= 0
+                postings[term].extend(zip(new_ids[keep].tolist(), tfs[keep].tolist()))
+            segment.close()
+
+        for term in postings:
+            postings[term].sort()
+        name = f"seg_{manifest['next_segment']:06d}"
+        write_segment(self.index_dir, name, records, postings, doclens)
+
+        merged_names = {segment_info["name"] for segment_info in segment_infos}
+        position = next(i for i, segment_info in enumerate(manifest["segments"]) if segment_info["name"] in merged_names)
+        segments = [segment_info for segment_info in manifest["segments"] if segment_info["name"] not in merged_names]
+        segments.insert(position, {"name": name, "num_docs": len(records), "total_len": sum(doclens), "books": books, "deleted": []})
+        manifest["segments"] = segments
+        manifest["next_segment"] += 1
+        self._write_manifest(manifest)
+        for merged_name in merged_names:
+            if merged_name in self._segments:
+                self._segments.pop(merged_name).close()
+            _delete_segment_files(self.index_dir, merged_name)
+
+    ######## Querying ########
+
+    def search(self, query, k=DEFAULT_TOP_K):
+        """
+        Returns the top k figure records for the query, best first, each with a "score" key.
+
+        Near-duplicates (same canonical_id, see diagram_dedup.py) are returned once, as their best-scoring copy.
+        """
+        self._refresh()
+        terms = list(dict.fromkeys(tokenize(query)))
+        segments = self._manifest["segments"]
+        num_docs = sum(_live_docs(s) for s in segments)
+        if not terms or num_docs == 0:
+            return []
+        avgdl = max(sum(_live_len(self._segments[s["name"]], s) for s in segments) / num_docs, 1e-9)
+
+        # Global document frequencies so scores are comparable across segments. Deleted documents not merged
+        # away yet are left out, like in num_docs, or a term's df could exceed num_docs and its idf turn negative
+        doc_freqs = {term: 0 for term in terms}
+        for segment_info in segments:
+            segment = self._segments[segment_info["name"]]
+            for term in terms:
+                docids, _ = segment.postings(term)
+                if docids is not None:
+                    doc_freqs[term] += _num_live_postings(segment_info, docids)
+        idfs = {term: np.log(1 + (num_docs - df + 0.5) / (df + 0.5)) for term, df in doc_freqs.items() if df}
+
+        candidates = []  # (score, segment name, doc id)
+        for segment_info in segments:
+            segment = self._segments[segment_info["name"]]
+            scores = None
+            for term, idf in idfs.items():
+                docids, tfs = segment.postings(term)
+                if docids is None:
+                    continue
+                if scores is None:
+                    scores = np.zeros(segment.num_docs, dtype=np.float32)
+                tfs = tfs.astype(np.float32)
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * segment.doclens[docids] / avgdl)
+                scores[docids] += idf * tfs * (BM25_K1 + 1) / (tfs + norm)
+            if scores is None:
+                continue
+            for start, end in segment_info["deleted"]:
+                scores[start:end] = 0
+            # Over-fetch so collapsing near-duplicates still leaves k results
+            top = min(2 * k, segment.num_docs)
+            top_ids = np.argpartition(-scores, top - 1)[:top]
+            candidates.extend((float(scores[doc_id]), segment_info["name"], int(doc_id)) for doc_id in top_ids if scores[doc_id] > 0)
+
+        results, seen_canonical_ids = [], set()
+        for score, segment_name, doc_id in sorted(candidates, reverse=True):
+            record = self._segments[segment_name].document(doc_id)
+            canonical_id = record.get("canonical_id")
+            if canonical_id is not None:
+                if canonical_id in seen_canonical_ids:
+                    continue
+                seen_canonical_ids.add(canonical_id)
+            record["score"] = score
+            results.append(record)
+            if len(results) == k:
+                break
+        return results
+
+    def num_docs(self):
+        self._refresh()
+        return sum(_live_docs(s) for s in self._manifest["segments"])
+
+    def close(self):
+        for segment in self._segments.values():
+            segment.close()
+        self._segments = {}
+        self._manifest = None
+
+
+def search_diagrams(query, k=DEFAULT_TOP_K, index_dir=None):
+    """
+    Returns the top k (diagram, caption) records for a concept. index_dir defaults to the default output directory's index.
+    """
+    index = DiagramIndex(index_dir or index_dir_for(DEFAULT_OUTPUT_DIR))
+    try:
+        return index.search(query, k=k)
+    finally:
+        index.close()
+
+
+def index_output_dir(output_dir, index_dir=None):
+    """
+    Index every book in a pipeline output directory's figure catalog, by default into the directory's own index
+    """
+    index_dir = index_dir or index_dir_for(output_dir)
+    index = DiagramIndex(index_dir)
+    try:
+        with FigureCatalog(catalog_path_for(output_dir)) as catalog:
+            for book, _ in catalog.books():
+                figure_list_dict = catalog.figures(books=[book])
+                for figure in figure_list_dict:
+                    figure["original_doc_filepath"] = figure["source_doc"]
+                    figure["image_file"] = os.path.basename(figure["image_path"])
+                index.add_book(book, figure_list_dict, image_dir=os.path.join(output_dir, book, "diagrams"))
+                logger.info("Indexed %s", book)
+        index.compact()
+        logger.info("%d figures in '%s'", index.num_docs(), index_dir)
+    finally:
+        index.close()
+
+
+############################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build and query the diagram retrieval index.")
+    parser.add_argument("--index-dir", help="Directory of the index. Defaults to <output-dir>/diagram_index, or DIAGRAM_INDEX_DIR if set.")
+    parser.add_argument("--output-dir", default=DEFAULT_OUTPUT_DIR, help="Pipeline output directory whose index is queried or compacted.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="Index all books in a pipeline output directory's figure catalog.")
+    build_parser.add_argument("output_dir", help="The pipeline output directory holding the figure catalog.")
+
+    query_parser = subparsers.add_parser("query", help="Print the top figures for a query.")
+    query_parser.add_argument("query", help="The concept to search for.")
+    query_parser.add_argument("-k", type=int, default=DEFAULT_TOP_K, help="Number of results.")
+    query_parser.add_argument("--json", action="store_true", help="Print results as JSON lines.")
+
+    subparsers.add_parser("compact", help="Merge all segments into one.")
+    args = parser.parse_args()
+    configure_logging()
+
+    if args.command == "build":
+        index_output_dir(args.output_dir, index_dir=args.index_dir)
+
+    elif args.command == "query":
+        for result in search_diagrams(args.query, k=args.k, index_dir=args.index_dir or index_dir_for(args.output_dir)):
+            if args.json:
+                print(json.dumps(result))
+            else:
+                print(f"{result['score']:7.3f}  {result['book']} / {result['image_name']}: {result['image_caption']}")
+
+    elif args.command == "compact":
+        index = DiagramIndex(args.index_dir or index_dir_for(args.output_dir))
+        index.compact()
+        index.close()
@@ -0,0 +1,185 @@
+"""
+Incremental reading of the elements of a layout-analysis response.
+
+A response for a long textbook holds tens of thousands of elements, each with its HTML, plus the
+whole document's HTML and text at the top level. iter_elements reads a response file in chunks and
+yields one element dict at a time; the other top-level values are skipped without being decoded.
+Memory stays bounded by the chunk size and the largest single element.
+
+Example usage:
+for element in iter_elements("sample_data/responses/dl15.json"):
+    print(element["category"], element["page"])
+"""
+import os
+import re
+import json
+
+#################### CONFIG ####################
+
+READ_CHUNK_CHARS = 1 << 16
+ELEMENTS_KEY = "elements"
+
+_WHITESPACE = " \t\n\r"
+_STRING_END = re.compile(r'["\\]')
+_STRUCTURE = re.compile(r'["\[\]{}]')
+_SCALAR_END = re.compile(r"[,}\]\s]")
+
+
+class _ChunkReader:
+    """
+    A text file read chunk by chunk, with the unconsumed rest of the last chunk in buffer[pos:]
+    """
+    def __init__(self, file, chunk_chars=READ_CHUNK_CHARS):
+        self.file = file
+        self.chunk_chars = chunk_chars
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self, num_chars=None):
+        """
+        Read one more chunk, dropping what was consumed. Returns False at end of file.
+        """
+        if self.eof:
+            return False
+        chunk = self.file.read(num_chars or self.chunk_chars)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """
+        The next non-whitespace character, not consumed, or "" at end of file
+        """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return ""
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise json.JSONDecodeError(f"Expected {char!r}, found {found or 'end of file'!r}", self.buffer, self.pos)
+        self.pos += 1
+
+    def decode(self, decoder=json.JSONDecoder()):
+        """
+        Decode the next JSON value, reading more chunks until it is complete
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                # Read at least as much again as is pending, so a large value is re-parsed only a few times
+                if self.fill(max(self.chunk_chars, len(self.buffer) - self.pos)):
+                    continue
+                raise
+            # A number cut by the end of the buffer ("0." or "12e") decodes as its prefix, so a scalar is
+            # complete only once a delimiter follows it
+            if not isinstance(value, (dict, list, str)) and not _SCALAR_END.match(self.buffer, end) and self.fill():
+                continue
+            self.pos = end
+            return value
+
+    def _find(self, pattern):
+        """
+        Advance to the next match of pattern, reading more chunks as needed. Returns the matched character.
+        """
+        while True:
+            match = pattern.search(self.buffer, self.pos)
+            if match:
+                self.pos = match.start()
+                return match.group()
+            self.pos = len(self.buffer)
+            if not self.fill():
+                raise json.JSONDecodeError("Unexpected end of file", self.buffer, self.pos)
+
+    def skip(self):
+        """
+        Skip the next JSON value without decoding it
+        """
+        char = self.peek()
+        if char not in '"[{':
+            self._find(_SCALAR_END)
+            return
+        depth = 0
+        while True:
+            char = self._find(_STRUCTURE)
+            self.pos += 1
+            if char == '"':
+                self._skip_string_rest()
+            elif char in "[{":
+                depth += 1
+            else:
+                depth -= 1
+            if depth == 0:
+                return
+
+    def _skip_string_rest(self):
+        while True:
+            if self._find(_STRING_END) == '"':
+                self.pos += 1
+                return
+            # An escape: skip the backslash and the escaped character, which may be in the next chunk
+            self.pos += 1
+            if self.pos >= len(self.buffer) and not self.fill():
+                raise json.JSONDecodeError("Unexpected end of file", self.buffer, self.pos)
+            self.pos += 1
+
+
+def _iter_array(reader):
+    reader.expect("[")
+    if reader.peek() == "]":
+        reader.pos += 1
+        return
+    while True:
+        yield reader.decode()
+        if reader.peek() == "]":
+            reader.pos += 1
+            return
+        reader.expect(",")
+
+
+def iter_file_elements(file, chunk_chars=READ_CHUNK_CHARS):
+    """
+    Yield the elements of the response JSON in a text file object, decoding one element at a time.
+    Top-level values other than "elements" are skipped, wherever they are in the object.
+    """
+    reader = _ChunkReader(file, chunk_chars)
+    reader.expect("{")
+    if reader.peek() == "}":
+        return
+    while True:
+        key = reader.decode()
+        reader.expect(":")
+        if key == ELEMENTS_KEY:
+            yield from _iter_array(reader)
+        else:
+            reader.skip()
+        if reader.peek() == "}":
+            return
+        reader.expect(",")
+
+
+def iter_elements(response):
+    """
+    Yield the elements of a layout response.
+
+    Args:
+    - response: The response JSON as a dict, a path to a response JSON file, or an open text file.
+      Files are read incrementally.
+    """
+    if isinstance(response, dict):
+        yield from response[ELEMENTS_KEY]
+    elif isinstance(response, (str, os.PathLike)):
+        with open(response, "r", encoding="utf-8") as f:
+            yield from iter_file_elements(f)
+    else:
+        yield from iter_file_elements(response)
@@ -0,0 +1,207 @@
+"""
+Figure catalog: one SQLite database (WAL mode) with a row per figure across all books.
+
+Books are written transactionally as the pipeline finishes them, replacing any earlier run of
+the same book, and rows are indexed by book and figure name. Image paths are stored relative
+to the output directory that holds the catalog.
+
+Usage:
+python figure_catalog.py export output_figures/figure_catalog.sqlite figures.jsonl
+python figure_catalog.py books output_figures/figure_catalog.sqlite
+"""
+import os
+import json
+import sqlite3
+import argparse
+
+#################### CONFIG ####################
+
+CATALOG_FILENAME = "figure_catalog.sqlite"
+BUSY_TIMEOUT_SECONDS = 30
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS figures (
+    id INTEGER PRIMARY KEY,
+    book TEXT NOT NULL,
+    source_doc TEXT,
+    page_number INTEGER,
+    bbox_x0 REAL,
+    bbox_y0 REAL,
+    bbox_x1 REAL,
+    bbox_y1 REAL,
+    element_id INTEGER,
+    image_name TEXT NOT NULL,
+    image_caption TEXT,
+    image_descriptions TEXT,
+    image_path TEXT,
+    thumbnail_path TEXT,
+    image_phash TEXT,
+    canonical_id INTEGER
+);
+CREATE INDEX IF NOT EXISTS figures_book ON figures (book, id);
+CREATE INDEX IF NOT EXISTS figures_book_name ON figures (book, image_name);
+CREATE INDEX IF NOT EXISTS figures_name ON figures (image_name);
+"""
+
+COLUMNS = ["id", "book", "source_doc", "page_number", "bbox_x0", "bbox_y0", "bbox_x1", "bbox_y1", "element_id",
+           "image_name", "image_caption", "image_descriptions", "image_path", "thumbnail_path", "image_phash", "canonical_id"]
+
+
+def catalog_path_for(output_dir):
+    return os.path.join(output_dir, CATALOG_FILENAME)
+
+
+def image_filename(figure):
+    """
+    File name of a figure's image in its book's diagrams directory: a rendered PNG, or the PDF's own
+    PNG or JPEG when the figure was copied out as an embedded image
+    """
+    return figure.get("image_file") or f"{figure['image_name']}.png"
+
+
+def _bbox(image_coordinates):
+    """
+    (x0, y0, x1, y1) of a layout bounding box, in layout-analyzer pixels
+    """
+    if not image_coordinates:
+        return None, None, None, None
+    xs = [coord["x"] for coord in image_coordinates]
+    ys = [coord["y"] for coord in image_coordinates]
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def _row_to_figure(row):
+    figure = dict(zip(COLUMNS, row))
+    figure["image_descriptions"] = json.loads(figure["image_descriptions"]) if figure["image_descriptions"] else []
+    return figure
+
+
+class FigureCatalog:
+    """
+    Example usage:
+    catalog = FigureCatalog("output_figures/figure_catalog.sqlite")
+    catalog.add_book("Attention", figure_list_dict)
+    catalog.figures(books=["Attention"], limit=20)
+    """
+    def __init__(self, path):
+        self.path = path
+        self.root_dir = os.path.dirname(os.path.abspath(path))
+        os.makedirs(self.root_dir, exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT_SECONDS)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def resolve_path(self, relative_path):
+        return os.path.join(self.root_dir, relative_path) if relative_path else None
+
+    ######## Writing ########
+
+    def add_book(self, book, figure_list_dict):
+        """
+        Replace all rows of a book with figure_list_dict in one transaction.
+
+        Figures are expected under <book>/diagrams/ (see image_filename) and <book>/thumbnails/<image_name>.jpg
+        relative to the catalog's directory.
+        """
+        rows = []
+        for figure in figure_list_dict:
+            image_name = figure["image_name"]
+            rows.append((
+                book,
+                figure.get("original_doc_filepath"),
+                figure.get("page_number"),
+                *_bbox(figure.get("image_coordinates")),
+                figure.get("element_id"),
+                image_name,
+                figure.get("image_caption"),
+                json.dumps(figure.get("image_descriptions") or []),
+                os.path.join(book, "diagrams", image_filename(figure)),
+                os.path.join(book, "thumbnails", f"{image_name}.jpg"),
+                figure.get("image_phash"),
+                figure.get("canonical_id"),
+            ))
+        with self.conn:
+            self.conn.execute("DELETE FROM figures WHERE book = ?", (book,))
+            self.conn.executemany(f"INSERT INTO figures ({', '.join(COLUMNS[1:])}) VALUES ({', '.join('?' * (len(COLUMNS) - 1))})", rows)
+
+    def remove_book(self, book):
+        with self.conn:
+            self.conn.execute("DELETE FROM figures WHERE book = ?", (book,))
+
+    ######## Reading ########
+
+    def books(self):
+        """
+        Returns a list of (book, figure count), sorted by book.
+        """
+        return self.conn.execute("SELECT book, COUNT(*) FROM figures GROUP BY book ORDER BY book").fetchall()
+
+    def _book_filter(self, books):
+        if books is None:
+            return "", []
+        return f"WHERE book IN ({', '.join('?' * len(books))})", list(books)
+
+    def count(self, books=None):
+        where, params = self._book_filter(books)
+        return self.conn.execute(f"SELECT COUNT(*) FROM figures {where}", params).fetchone()[0]
+
+    def figures(self, books=None, limit=None, offset=0):
+        """
+        Figures of the given books (all books if None), in book and insertion order.
+        """
+        where, params = self._book_filter(books)
+        query = f"SELECT {', '.join(COLUMNS)} FROM figures {where} ORDER BY book, id"
+        if limit is not None:
+            query += " LIMIT ? OFFSET ?"
+            params += [limit, offset]
+        return [_row_to_figure(row) for row in self.conn.execute(query, params)]
+
+    def get_figure(self, book, image_name):
+        row = self.conn.execute(f"SELECT {', '.join(COLUMNS)} FROM figures WHERE book = ? AND image_name = ?", (book, image_name)).fetchone()
+        return _row_to_figure(row) if row else None
+
+    def export_jsonl(self, filepath, books=None):
+        """
+        Write one JSON object per figure. Returns the number of figures written.
+        """
+        num_figures = 0
+        where, params = self._book_filter(books)
+        with open(filepath, "w") as f:
+            for row in self.conn.execute(f"SELECT {', '.join(COLUMNS)} FROM figures {where} ORDER BY book, id", params):
+                f.write(json.dumps(_row_to_figure(row)) + "\n")
+                num_figures += 1
+        return num_figures
+
+
+############################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect and export the figure catalog.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export", help="Export figures as JSON lines.")
+    export_parser.add_argument("catalog", help="Path to the catalog database.")
+    export_parser.add_argument("output", help="Path of the JSONL file to write.")
+    export_parser.add_argument("--book", action="append", help="Only export this book. May be repeated.")
+
+    books_parser = subparsers.add_parser("books", help="List books and their figure counts.")
+    books_parser.add_argument("catalog", help="Path to the catalog database.")
+    args = parser.parse_args()
+
+    with FigureCatalog(args.catalog) as catalog:
+        if args.command == "export":
+            num_figures = catalog.export_jsonl(args.output, books=args.book)
+            print(f"Exported {num_figures} figures to {args.output}")
+
+        elif args.command == "books":
+            for book, num_figures in catalog.books():
+                print(f"{num_figures:>7}  {book}")
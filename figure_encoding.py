@@ -0,0 +1,180 @@
+"""
+Output encoding profiles for figure images.
+
+A profile sets how large a figure may be and how it is encoded:
+- max_dpi: the highest resolution a figure is rendered at
+- max_side / max_pixels: a cap on the longest side and on width * height; a figure is rendered
+  at the highest DPI (up to max_dpi) that keeps it within both
+- formats: the format per figure kind, "vector" for drawn figures and "raster" for figures that
+  are mostly an embedded image. One of "png", "jpeg", "webp" (lossless), "webp-lossy" or, for
+  raster figures, "original" to copy the PDF's own PNG or JPEG stream when it can be used as is
+- quality: JPEG and lossy WebP quality
+- png_compress_level: zlib level of PNG files, trading encode time against size
+- sizes: extra copies with these longest sides, written to <sizes_dir>/<side>/
+
+Encoding runs on a per-process thread pool (Pillow releases the GIL while encoding), so the
+render thread can rasterize the next figure meanwhile. Bytes written and encode time per format
+are recorded in the run's metrics.
+
+Example usage:
+profile = get_profile("balanced")
+future = submit_encode(image, "output_figures/book/diagrams/Figure 1", "png", profile, size=(800, 600))
+future.result()  # "output_figures/book/diagrams/Figure 1.png"
+"""
+import os
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import fitz
+from PIL import Image
+
+from run_manifest import atomic_output
+from instrumentation import span, increment
+
+#################### CONFIG ####################
+
+OUTPUT_PROFILES = {
+    # Full resolution (the original 350 DPI) and lossless, embedded images copied unchanged. Not pixel-identical
+    # to cropping each figure on its own: cut from a shared page raster, a few crops differ in anti-aliased edge pixels
+    "archival": {"max_dpi": 350, "formats": {"vector": "png", "raster": "original"}},
+    # Diagrams lossless and photos as JPEG, capped at 2400 px and 4 megapixels
+    "balanced": {"max_dpi": 300, "max_side": 2400, "max_pixels": 4_000_000, "formats": {"vector": "webp", "raster": "jpeg"}, "quality": 85},
+    # Small lossy files for the viewer and the classifier, plus an 800 px copy
+    "compact": {"max_dpi": 200, "max_side": 1600, "max_pixels": 2_000_000, "formats": {"vector": "webp-lossy", "raster": "webp-lossy"}, "quality": 80, "sizes": [800]},
+}
+DEFAULT_OUTPUT_PROFILE = os.getenv("OUTPUT_PROFILE", "archival")
+
+PROFILE_DEFAULTS = {"max_dpi": 350, "max_side": None, "max_pixels": None, "formats": {"vector": "png", "raster": "original"}, "quality": 85, "png_compress_level": 3, "sizes": []}
+FORMAT_EXTENSIONS = {"png": "png", "jpeg": "jpg", "webp": "webp", "webp-lossy": "webp"}
+DEFAULT_ENCODE_WORKERS = min(4, os.cpu_count() or 1)
+
+
+def get_profile(profile):
+    """
+    A complete profile dict from a profile name or a partial profile dict.
+    """
+    if isinstance(profile, str):
+        if profile not in OUTPUT_PROFILES:
+            raise ValueError(f"Unknown output profile {profile!r}, expected one of {sorted(OUTPUT_PROFILES)}")
+        profile = OUTPUT_PROFILES[profile]
+    complete = {**PROFILE_DEFAULTS, **profile}
+    complete["formats"] = {**PROFILE_DEFAULTS["formats"], **complete["formats"]}
+    for kind, fmt in complete["formats"].items():
+        if fmt not in FORMAT_EXTENSIONS and not (kind == "raster" and fmt == "original"):
+            raise ValueError(f"Unknown format {fmt!r} for {kind} figures")
+    return complete
+
+
+def figure_dpi(rect, profile):
+    """
+    The highest DPI, up to the profile's max_dpi, at which a rect (in PDF points) fits the profile's size limits
+    """
+    dpi = profile["max_dpi"]
+    width, height = max(rect.width, 1e-3), max(rect.height, 1e-3)
+    if profile["max_side"]:
+        dpi = min(dpi, profile["max_side"] * 72 / max(width, height))
+    if profile["max_pixels"]:
+        dpi = min(dpi, 72 * math.sqrt(profile["max_pixels"] / (width * height)))
+    return dpi
+
+
+def fit_size(width, height, max_side=None, max_pixels=None):
+    """
+    (width, height) scaled down, keeping the aspect ratio, to within max_side and max_pixels
+    """
+    scale = 1.0
+    if max_side:
+        scale = min(scale, max_side / max(width, height))
+    if max_pixels:
+        scale = min(scale, math.sqrt(max_pixels / (width * height)))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def pixmap_to_image(pix):
+    """
+    A PIL image holding a copy of a fitz.Pixmap's pixels, so it outlives the pixmap
+    """
+    if pix.colorspace is None or pix.colorspace.n not in (1, 3):
+        pix = fitz.Pixmap(fitz.csRGB, pix)
+    mode = {1: "L", 3: "RGB"}[pix.colorspace.n]
+    if pix.alpha:
+        mode += "A"
+    return Image.frombytes(mode, (pix.width, pix.height), pix.samples)
+
+
+def save_image(image, filepath, fmt, quality, png_compress_level=PROFILE_DEFAULTS["png_compress_level"]):
+    """
+    Encode image to filepath atomically. Returns the number of bytes written.
+    """
+    if fmt == "jpeg" and image.mode not in ("L", "RGB"):
+        image = image.convert("RGB")
+    options = {
+        "png": {"format": "PNG", "compress_level": png_compress_level},
+        "jpeg": {"format": "JPEG", "quality": quality},
+        "webp": {"format": "WEBP", "lossless": True},
+        "webp-lossy": {"format": "WEBP", "quality": quality},
+    }[fmt]
+    with span(f"encode_{fmt}"):
+        with atomic_output(filepath) as tmp_filepath:
+            image.save(tmp_filepath, **options)
+        num_bytes = os.path.getsize(filepath)
+    increment(f"output_files_{fmt}")
+    increment(f"output_bytes_{fmt}", num_bytes)
+    return num_bytes
+
+
+def _resized(image, size):
+    return image if image.size == size else image.resize(size, Image.LANCZOS)
+
+
+def encode_figure(image, output_base, fmt, profile, size=None, size_bases=(), thumbnail=None):
+    """
+    Write one figure and its extra sizes and thumbnail.
+
+    Args:
+    - image: The figure as a PIL image, at or above its final size.
+    - output_base: Output path without extension, or None to write only the extra sizes and thumbnail.
+    - fmt: One of FORMAT_EXTENSIONS.
+    - profile: A complete profile (see get_profile).
+    - size: Final (width, height); defaults to image.size.
+    - size_bases: (max_side, output_base) pairs for the extra sizes.
+    - thumbnail: Optional (filepath, max_side, jpeg quality).
+
+    Returns:
+    - The path of the full-size file, or None without output_base.
+    """
+    image = _resized(image, size or image.size)
+    output_filepath = None
+    if output_base is not None:
+        output_filepath = f"{output_base}.{FORMAT_EXTENSIONS[fmt]}"
+        save_image(image, output_filepath, fmt, profile["quality"], profile["png_compress_level"])
+    for max_side, base in size_bases:
+        os.makedirs(os.path.dirname(base), exist_ok=True)
+        save_image(_resized(image, fit_size(*image.size, max_side=max_side)), f"{base}.{FORMAT_EXTENSIONS[fmt]}", fmt, profile["quality"], profile["png_compress_level"])
+    if thumbnail:
+        thumbnail_filepath, max_side, quality = thumbnail
+        save_image(_resized(image, fit_size(*image.size, max_side=max_side)), thumbnail_filepath, "jpeg", quality)
+    return output_filepath
+
+
+############################################################
+### Encoder pool
+# One pool per process, created on first use: a pool inherited through fork has no threads.
+_encoder_pool = None
+_encoder_pool_pid = None
+_encoder_pool_lock = threading.Lock()
+
+def encoder_pool(max_workers=DEFAULT_ENCODE_WORKERS):
+    global _encoder_pool, _encoder_pool_pid
+    with _encoder_pool_lock:
+        if _encoder_pool is None or _encoder_pool_pid != os.getpid():
+            _encoder_pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="encode")
+            _encoder_pool_pid = os.getpid()
+        return _encoder_pool
+
+def submit_encode(image, output_base, fmt, profile, size=None, size_bases=(), thumbnail=None):
+    """
+    encode_figure on the encoder pool. Returns a Future of the full-size file's path.
+    """
+    return encoder_pool().submit(encode_figure, image, output_base, fmt, profile, size, size_bases, thumbnail)
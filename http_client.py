@@ -0,0 +1,284 @@
+"""
+Shared HTTP clients for the external APIs, one per service and process.
+
+Each ServiceClient keeps a pooled keep-alive requests.Session and paces its requests with a token
+bucket. Requests that fail with a connection error, a timeout, 429 or 5xx are retried with
+exponential backoff and full jitter, waiting at least as long as the response's Retry-After. A 429,
+or a rate-limit header reporting the quota used up, pauses the whole service until it resets, so
+concurrent callers back off together instead of each burning retries.
+
+Per service, the run's metrics (see instrumentation.py) count requests, responses by status class,
+retries, throttled responses and bytes sent and received, and time the requests and the waits for
+the rate limit.
+
+Limits come from SERVICES and can be overridden per service with environment variables, e.g.
+UPSTAGE_REQUESTS_PER_SECOND=1 or OPENAI_MAX_RETRIES=8.
+
+Example usage:
+client = get_client("openai")
+response = client.post(OPENAI_CHAT_URL, json=payload, headers={"Authorization": f"Bearer {api_key}"})
+"""
+import os
+import re
+import time
+import random
+import threading
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from instrumentation import span, increment, get_logger
+
+logger = get_logger("http")
+
+#################### CONFIG ####################
+
+# requests_per_second and burst set the token bucket; timeout is (connect, read) seconds
+SERVICES = {
+    "upstage": {"requests_per_second": 2.0, "burst": 4, "max_connections": 8, "timeout": (10, 300), "max_retries": 5},
+    "openai": {"requests_per_second": 5.0, "burst": 10, "max_connections": 16, "timeout": (10, 60), "max_retries": 5},
+}
+SERVICE_DEFAULTS = {"requests_per_second": 5.0, "burst": 5, "max_connections": 8, "timeout": (10, 60), "max_retries": 5}
+
+RETRY_STATUSES = frozenset([408, 429, 500, 502, 503, 504])
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_MAX_SECONDS = 60.0
+MAX_RETRY_AFTER_SECONDS = 300.0
+
+# Headers announcing that the quota is used up, and when it resets (OpenAI style, e.g. "6m0s")
+RATE_LIMIT_REMAINING_HEADERS = ("x-ratelimit-remaining-requests", "x-ratelimit-remaining-tokens")
+RATE_LIMIT_RESET_HEADERS = {"x-ratelimit-remaining-requests": "x-ratelimit-reset-requests", "x-ratelimit-remaining-tokens": "x-ratelimit-reset-tokens"}
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def service_config(service):
+    """
+    The limits of a service: SERVICES, then <SERVICE>_<SETTING> environment variables
+    """
+    config = {**SERVICE_DEFAULTS, **SERVICES.get(service, {})}
+    for setting, value in config.items():
+        override = os.getenv(f"{service.upper()}_{setting.upper()}")
+        if override is not None:
+            config[setting] = tuple(float(part) for part in override.split(",")) if setting == "timeout" else type(value)(override)
+    return config
+
+
+def parse_retry_after(value, now=None):
+    """
+    Seconds to wait from a Retry-After header (delta seconds or an HTTP date), or None
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - (now or time.time()))
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_duration(value):
+    """
+    Seconds in a duration like "1s", "6m0s" or "20ms", or None
+    """
+    parts = _DURATION_PART.findall(value or "")
+    if not parts:
+        return None
+    return sum(float(number) * _DURATION_UNITS[unit] for number, unit in parts)
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: rate tokens per second, holding at most capacity.
+    """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def pause(self, seconds):
+        """
+        Hand out no tokens for the next seconds, and start from an empty bucket after
+        """
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0.0
+
+    def acquire(self):
+        """
+        Take one token, blocking until one is available. Returns the seconds waited.
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    delay = self.paused_until - now
+                else:
+                    if self.rate > 0:
+                        self.tokens = min(self.capacity, self.tokens + (now - max(self.updated_at, self.paused_until)) * self.rate)
+                    else:
+                        self.tokens = self.capacity
+                    self.updated_at = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return waited
+                    delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+def _rewind_files(files):
+    """
+    Seek the file objects in a requests `files` argument back to where they started, for a retry.
+    Returns a function doing so.
+    """
+    if not files:
+        return lambda: None
+    handles = []
+    for value in (files.values() if isinstance(files, dict) else (value for _, value in files)):
+        handle = value[1] if isinstance(value, tuple) else value
+        if hasattr(handle, "seek") and hasattr(handle, "tell"):
+            handles.append((handle, handle.tell()))
+    def rewind():
+        for handle, position in handles:
+            handle.seek(position)
+    return rewind
+
+
+def _request_bytes(kwargs):
+    body = kwargs.get("data")
+    if isinstance(body, (bytes, str)):
+        return len(body)
+    num_bytes = 0
+    for value in (kwargs.get("files") or {}).values():
+        handle = value[1] if isinstance(value, tuple) else value
+        if isinstance(handle, (bytes, str)):
+            num_bytes += len(handle)
+        elif hasattr(handle, "fileno"):
+            num_bytes += os.fstat(handle.fileno()).st_size - handle.tell()
+    return num_bytes
+
+
+class ServiceClient:
+    """
+    Pooled, rate-limited and retrying HTTP client for one service.
+    """
+    def __init__(self, service, requests_per_second, burst, max_connections, timeout, max_retries):
+        self.service = service
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.bucket = TokenBucket(requests_per_second, burst)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_connections)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def _metric(self, name):
+        return f"http_{self.service}_{name}"
+
+    def _backoff(self, attempt, retry_after):
+        delay = random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, MAX_RETRY_AFTER_SECONDS))
+        return delay
+
+    def _observe_quota(self, response):
+        """
+        Pause the service when a 429 or the rate-limit headers say the quota is used up
+        """
+        headers = response.headers
+        pause = parse_retry_after(headers.get("Retry-After")) if response.status_code == 429 else None
+        for remaining_header in RATE_LIMIT_REMAINING_HEADERS:
+            if headers.get(remaining_header) == "0":
+                reset = parse_duration(headers.get(RATE_LIMIT_RESET_HEADERS[remaining_header]))
+                if reset is not None:
+                    pause = max(pause or 0.0, reset)
+        if pause:
+            pause = min(pause, MAX_RETRY_AFTER_SECONDS)
+            logger.info("%s quota used up, pausing requests for %.1fs.", self.service, pause)
+            increment(self._metric("quota_pauses"))
+            self.bucket.pause(pause)
+
+    def request(self, method, url, **kwargs):
+        """
+        Send a request, retrying connection errors, timeouts and retryable statuses.
+
+        Takes the arguments of requests.Session.request; timeout defaults to the service's. File
+        objects in files are rewound for each retry. Returns the last response, whatever its status;
+        raises the last exception if every attempt failed without a response.
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        rewind = _rewind_files(kwargs.get("files"))
+        num_bytes = _request_bytes(kwargs)
+        for attempt in range(self.max_retries + 1):
+            with span(self._metric("throttle_wait")):
+                waited = self.bucket.acquire()
+            if waited:
+                increment(self._metric("throttled"))
+            if attempt:
+                rewind()
+
+            increment(self._metric("requests"))
+            increment(self._metric("bytes_sent"), num_bytes)
+            try:
+                with span(self._metric("request")):
+                    response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                increment(self._metric("connection_errors"))
+                if attempt == self.max_retries:
+                    raise
+                delay = self._backoff(attempt, None)
+                logger.warning("%s request failed (%s), retrying in %.1fs.", self.service, e, delay)
+                increment(self._metric("retries"))
+                time.sleep(delay)
+                continue
+
+            increment(self._metric(f"responses_{response.status_code // 100}xx"))
+            increment(self._metric("bytes_received"), len(response.content))
+            if response.status_code == 429:
+                increment(self._metric("rate_limited"))
+            self._observe_quota(response)
+            if response.status_code not in RETRY_STATUSES or attempt == self.max_retries:
+                return response
+            delay = self._backoff(attempt, parse_retry_after(response.headers.get("Retry-After")))
+            logger.info("%s returned %d, retrying in %.1fs.", self.service, response.status_code, delay)
+            increment(self._metric("retries"))
+            time.sleep(delay)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+############################################################
+### Shared clients
+# One client per service and process, created on first use; a session inherited through fork
+# would share its sockets with the parent.
+_clients = {}
+_clients_pid = None
+_clients_lock = threading.Lock()
+
+def get_client(service):
+    """
+    The shared ServiceClient of a service in this process
+    """
+    global _clients, _clients_pid
+    with _clients_lock:
+        if _clients_pid != os.getpid():
+            _clients, _clients_pid = {}, os.getpid()
+        if service not in _clients:
+            _clients[service] = ServiceClient(service, **service_config(service))
+        return _clients[service]
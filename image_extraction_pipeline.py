@@ -1,14 +1,35 @@
 import os
 import re
-import json
+import math
 import sys
+import json
+import zlib
+import queue
+import argparse
+import itertools
+import threading
+from array import array
 from pprint import pprint 
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from dotenv import load_dotenv
-import requests
 import fitz  # PyMuPDF
+from PIL import Image
+from http_client import get_client
+from layout_cache import LayoutCache, hash_bytes, hash_file
+from local_layout import analyze_pdf, LOCAL_LAYOUT_MODEL, LOCAL_LAYOUT_VERSION, DEFAULT_LAYOUT_WORKERS, HTML_ID_PATTERN
+from page_triage import triage_pdf, triage_config
+from diagram_index import DiagramIndex, index_dir_for
+from diagram_dedup import get_dedup_index, dedup_dir_for, add_image_hashes, phash_image
+from figure_catalog import FigureCatalog, catalog_path_for, image_filename
+from run_manifest import RunManifest, manifest_path_for, stage_fingerprint, atomic_output
+from element_stream import iter_elements
+from figure_encoding import OUTPUT_PROFILES, DEFAULT_OUTPUT_PROFILE, get_profile, figure_dpi, fit_size, pixmap_to_image, encode_figure, encoder_pool
+from raster_cache import get_raster_cache, pixmap_array, figure_key
+from instrumentation import METRICS, span, increment, instrumented, timed_iter, worker_context, init_worker, worker_log_level, get_logger, configure_logging
 
 load_dotenv()
+logger = get_logger("pipeline")
 
 #################### CONFIG ####################
 
@@ -16,15 +37,126 @@ DEFAULT_OUTPUT_DIR = "output_figures"
 
 NUM_ADDITIONAL_ELEMENTS_TO_LOOK_FOR_CAPTIONS = 7
 
-def get_element_json_from_pdf(file_filename):
-    UPSTAGE_API_KEY = os.getenv("UPSTAGE_API_KEY")
-    url = "https://api.upstage.ai/v1/document-ai/layout-analyzer"
+RENDER_DPI = 350  # Single crops (crop_and_save_image); batch rendering follows the output profile
+THUMBNAIL_MAX_SIDE = 320  # Thumbnails for the viewer are written next to the full-size diagrams
+THUMBNAIL_JPG_QUALITY = 80
+
+# Figures that are a single embedded image of one of these stream formats are copied out of the
+# PDF unchanged instead of re-rendered (stream format -> file extension)
+EMBEDDED_IMAGE_FORMATS = {"png": "png", "jpeg": "jpg"}
+EMBEDDED_IMAGE_MIN_IOU = 0.9
+# Figures at least this much covered by embedded images use the output profile's "raster" format
+RASTER_FIGURE_MIN_COVERAGE = 0.5
+DEFAULT_RENDER_WORKERS = os.cpu_count() or 1
+DEFAULT_UPLOAD_WORKERS = 4
+
+# Documents longer than this are uploaded as concurrent chunks of this many pages
+DEFAULT_CHUNK_PAGES = 25
+DEFAULT_CHUNK_UPLOAD_WORKERS = 4
+
+# Upload only the pages that may hold figures, and their neighbours (see page_triage.py)
+PAGE_TRIAGE = os.getenv("LAYOUT_PAGE_TRIAGE", "1") != "0"
+
+UPSTAGE_API_VERSION = "v1"
+UPSTAGE_LAYOUT_URL = os.getenv("UPSTAGE_LAYOUT_URL", f"https://api.upstage.ai/{UPSTAGE_API_VERSION}/document-ai/layout-analyzer")
+
+# Responses are cached on disk so re-runs don't repeat the upload (see layout_cache.py)
+LAYOUT_CACHE = LayoutCache()
+METRICS_FILENAME = "metrics.json"  # Timings and counters of the last run, see instrumentation.py
+
+# "remote" uploads to the layout API, "local" analyzes with PyMuPDF (see local_layout.py),
+# "fallback" tries local first and uploads only documents where it found no figures
+LAYOUT_BACKENDS = ("remote", "local", "fallback")
+DEFAULT_LAYOUT_BACKEND = os.getenv("LAYOUT_BACKEND", "remote")
+LOCAL_LAYOUT_ENDPOINT = f"local:{LOCAL_LAYOUT_MODEL}"
+
+@instrumented("layout")
+def get_element_json_from_pdf(file_filename, cache=LAYOUT_CACHE, chunk_pages=DEFAULT_CHUNK_PAGES, backend=DEFAULT_LAYOUT_BACKEND, layout_workers=DEFAULT_LAYOUT_WORKERS, page_triage=PAGE_TRIAGE, as_path=False):
+    """
+    Layout elements of a PDF from the chosen backend (see LAYOUT_BACKENDS).
 
-    headers = {"Authorization": f"Bearer {UPSTAGE_API_KEY}"}
-    files = {"document": open(file_filename, "rb")}
-    response = requests.post(url, headers=headers, files=files)
-    return response.json()
+    "fallback" analyzes locally and only uploads documents in which the local engine found no figures,
+    such as scans without a text layer. With page_triage, only the pages that may hold figures are uploaded.
+
+    With as_path and a cache, the path of the cached response file is returned instead of the response,
+    so it can be read incrementally (see element_stream.py) rather than held in memory whole.
+    """
+    if backend not in LAYOUT_BACKENDS:
+        raise ValueError(f"Unknown layout backend {backend!r}, expected one of {LAYOUT_BACKENDS}")
+    if backend == "remote":
+        return get_element_json_from_layout_api(file_filename, cache=cache, chunk_pages=chunk_pages, page_triage=page_triage, as_path=as_path)
+
+    response_json = get_element_json_from_local_engine(file_filename, cache=cache, max_workers=layout_workers, as_path=as_path)
+    if backend == "fallback" and not any(element["category"] == "figure" for element in iter_elements(response_json)):
+        logger.info("No figures found locally in '%s', falling back to the layout API.", file_filename)
+        return get_element_json_from_layout_api(file_filename, cache=cache, chunk_pages=chunk_pages, page_triage=page_triage, as_path=as_path)
+    return response_json
+
+def get_element_json_from_local_engine(file_filename, cache=LAYOUT_CACHE, max_workers=DEFAULT_LAYOUT_WORKERS, as_path=False):
+    fetch = lambda: analyze_pdf(file_filename, max_workers=max_workers)
+    if cache is None:
+        return fetch()
+    return cache.get_or_fetch(file_filename, LOCAL_LAYOUT_ENDPOINT, LOCAL_LAYOUT_VERSION, fetch, as_path=as_path)
+
+def get_element_json_from_layout_api(file_filename, cache=LAYOUT_CACHE, chunk_pages=DEFAULT_CHUNK_PAGES, page_triage=PAGE_TRIAGE, as_path=False):
+    with fitz.open(file_filename) as pdf_document:
+        page_count = len(pdf_document)
+    chunked = bool(chunk_pages) and page_count > chunk_pages
+    content_hash = hash_file(file_filename) if cache is not None else None
+
+    # A response for the whole document from an earlier run is as good, and already paid for
+    if page_triage and cache is not None and not chunked:
+        key = cache.make_key(file_filename, UPSTAGE_LAYOUT_URL, UPSTAGE_API_VERSION, content_hash=content_hash)
+        response_json = cache.get_path(key) if as_path else cache.get(key)
+        if response_json is not None:
+            return response_json
+
+    if as_path and cache is not None and (page_triage or chunked):
+        # Responses put together from several uploads are cached as one entry too, to be read as a file
+        assembled_endpoint = f"{UPSTAGE_LAYOUT_URL}#" + json.dumps({"chunk_pages": chunk_pages, "page_triage": triage_config() if page_triage else None}, sort_keys=True)
+        fetch = lambda: get_element_json_from_layout_api(file_filename, cache=cache, chunk_pages=chunk_pages, page_triage=page_triage)
+        return cache.get_or_fetch(file_filename, assembled_endpoint, UPSTAGE_API_VERSION, fetch, content_hash=content_hash, as_path=True)
+
+    triage = None
+    if page_triage:
+        with span("page_triage"):
+            triage = triage_pdf(file_filename)
+        increment("triage_pages_skipped", page_count - len(triage.pages))
+        if triage.is_complete:
+            triage = None
+        else:
+            logger.info("Uploading %d of %d pages of '%s' for layout analysis.", len(triage.pages), page_count, file_filename)
+            if not triage.pages:
+                return triage.restore({"elements": []})
+            page_count = len(triage.pages)
+
+    pages = triage.pages if triage else None
+    if chunk_pages and page_count > chunk_pages:
+        response_json = get_element_json_from_pdf_chunks(file_filename, cache=cache, chunk_pages=chunk_pages, pages=pages)
+    elif triage:
+        # The kept pages, packed into one document in memory
+        [(_, document_bytes)] = split_pdf_into_chunks(file_filename, chunk_pages=page_count, pages=pages)
+        fetch = lambda: post_document_to_layout_api(document_bytes, filename=os.path.basename(file_filename))
+        response_json = fetch() if cache is None else cache.get_or_fetch(file_filename, UPSTAGE_LAYOUT_URL, UPSTAGE_API_VERSION, fetch, content_hash=hash_bytes(document_bytes))
+    else:
+        def fetch():
+            with open(file_filename, "rb") as document:
+                return post_document_to_layout_api(document, filename=os.path.basename(file_filename))
+
+        response_json = fetch() if cache is None else cache.get_or_fetch(file_filename, UPSTAGE_LAYOUT_URL, UPSTAGE_API_VERSION, fetch, content_hash=content_hash, as_path=as_path)
+    # Page numbers back to the original document, and the skipped pages' text in between
+    return triage.restore(response_json) if triage else response_json
 
+def bounding_box_to_rect(coords):
+    """
+    Convert an Upstage bounding box (list of {'x', 'y'} points) into a fitz.Rect in PDF points
+    """
+    # Calculate the rectangle area to crop using the provided coordinates
+    x_values = [0.24 * coord['x'] for coord in coords]
+    y_values = [0.24 * coord['y'] for coord in coords]
+    return fitz.Rect(min(x_values), min(y_values), max(x_values), max(y_values))
+
+@instrumented("crop")
 def crop_and_save_image(input_pdf, output_filepath, page, coords):
     """
     # Example usage
@@ -34,45 +166,355 @@ def crop_and_save_image(input_pdf, output_filepath, page, coords):
     pdf_document = fitz.open(input_pdf)
     page = pdf_document[page - 1]  # Adjusted to use 0-based index
 
-    # Calculate the rectangle area to crop using the provided coordinates
-    x_values = [0.24 * coord['x'] for coord in coords]
-    y_values = [0.24 * coord['y'] for coord in coords]
-    x0 = min(x_values)
-    x1 = max(x_values)
-    y0 = min(y_values)
-    y1 = max(y_values)
-
     # Define the rectangle area to crop
-    rect = fitz.Rect(x0, y0, x1, y1)
+    rect = bounding_box_to_rect(coords)
 
     # Crop the page to the defined rectangle
-    pix = page.get_pixmap(clip=rect, dpi=350)
+    pix = page.get_pixmap(clip=rect, dpi=RENDER_DPI)
+    increment("pixels_rendered", pix.width * pix.height)
 
-    # Save the cropped image
+    # Save the cropped image, and keep its pixels for hashing and classification later in the run
     pix.save(output_filepath)
+    get_raster_cache().put(figure_key(output_filepath), pix)
     pdf_document.close()
     return output_filepath
 
+############################################################
+### Batch rendering
+# Each worker process opens the PDF once and keeps it open for every page it is handed.
+_render_worker_document = None
+
+def _init_render_worker(input_pdf, log_level):
+    global _render_worker_document
+    _render_worker_document = fitz.open(input_pdf)
+    init_worker(log_level)
+
+def find_embedded_image(pdf_document, page, rect, image_infos, drawings=None):
+    """
+    Find an embedded raster image whose placement matches rect and can be written out unchanged.
+
+    The figure must be exactly one unrotated image, covering the same area as rect (IoU of at least
+    EMBEDDED_IMAGE_MIN_IOU), with no text or vector drawings on top of it, stored as a PNG or JPEG
+    stream in gray or RGB without a soft mask.
+
+    Args:
+    - pdf_document: The open fitz.Document.
+    - page: The fitz.Page the figure is on.
+    - rect: The figure's fitz.Rect.
+    - image_infos: page.get_image_info(xrefs=True), computed once per page.
+    - drawings: page.get_drawings(), computed once per page on first use. A one-item list is used as a lazy holder.
+
+    Returns:
+    - The dict from pdf_document.extract_image, or None if the figure has to be rendered.
+    """
+    overlapping = [info for info in image_infos if fitz.Rect(info["bbox"]).intersects(rect)]
+    if len(overlapping) != 1:
+        return None
+    info = overlapping[0]
+    image_rect = fitz.Rect(info["bbox"])
+    a, b, c, d, _, _ = info["transform"]
+    if not info["xref"] or abs(b) > 1e-3 or abs(c) > 1e-3 or a <= 0 or d <= 0:
+        return None
+    intersection = (image_rect & rect).get_area()
+    if intersection / (image_rect.get_area() + rect.get_area() - intersection) < EMBEDDED_IMAGE_MIN_IOU:
+        return None
+
+    # Labels or arrows drawn over the image make it a composite figure
+    if page.get_text("words", clip=image_rect):
+        return None
+    if drawings is not None:
+        if not drawings:
+            drawings.append(page.get_drawings())
+        for drawing in drawings[0]:
+            drawing_rect = drawing["rect"]
+            if drawing_rect.intersects(image_rect) and not drawing_rect.contains(image_rect):
+                return None
+
+    image = pdf_document.extract_image(info["xref"])
+    if not image or image["ext"] not in EMBEDDED_IMAGE_FORMATS or image["colorspace"] not in (1, 3) or image.get("smask"):
+        return None
+    return image
+
+def raster_coverage(rect, image_infos):
+    """
+    Fraction of rect covered by embedded raster images
+    """
+    area = rect.get_area()
+    if not area:
+        return 0.0
+    covered = sum((fitz.Rect(info["bbox"]) & rect).get_area() for info in image_infos)
+    return min(1.0, covered / area)
+
+def _encode_and_hash(image, output_base, fmt, profile, size, size_bases, thumbnail, image_filepath=None, keep_pixels=False):
+    """
+    encode_figure, then the perceptual hash of the written pixels, computed while they are still in memory.
+
+    With keep_pixels, the figure at its written size is also kept in the raster cache under its path
+    (or under image_filepath for a figure copied from the PDF), for later steps in this process.
+
+    Returns:
+    - (path of the full-size file, 16 hex digit perceptual hash)
+    """
+    if size is not None and image.size != size:
+        image = image.resize(size, Image.LANCZOS)
+    output_filepath = encode_figure(image, output_base, fmt, profile, size_bases=size_bases, thumbnail=thumbnail) or image_filepath
+    if keep_pixels:
+        get_raster_cache().put(figure_key(output_filepath), image)
+    with span("phash"):
+        phash = f"{phash_image(image):016x}"
+    return output_filepath, phash
+
+def render_page_figures(pdf_document, page_number, jobs, profile=DEFAULT_OUTPUT_PROFILE, keep_pixels=False):
+    """
+    Render every figure on one page from a single shared raster and encode it per the output profile.
+
+    Figures mostly covered by embedded images are "raster" figures, the rest "vector" figures; the
+    profile picks a format for each (see figure_encoding.py). A raster figure that is a single
+    embedded PNG or JPEG is taken straight from the PDF's image stream: copied unchanged with the
+    "original" format, otherwise decoded and re-encoded. The remaining figures are cut out of one
+    raster of the page at the highest DPI any of them needs, and downscaled to their own size budget.
+    Crops are views into the page raster. Encoding and hashing run on the encoder thread pool while the next figure is cut out.
+
+    Args:
+    - pdf_document: An open fitz.Document.
+    - page_number: 1-based page number.
+    - jobs: List of (coords, output_base, thumbnail_filepath, size_bases) tuples for the figures on
+      this page. output_base is the output path without extension; thumbnail_filepath may be None;
+      size_bases are (max_side, output_base) pairs for the profile's extra sizes.
+    - profile: An output profile name or dict.
+    - keep_pixels: Keep the page raster and each written figure's pixels in the raster cache, for
+      consumers in this process. The page raster is then also taken from the cache if this process
+      rendered it before.
+
+    Returns:
+    - A list of (output_base, output_filepath, method, phash) tuples, method being "embedded" or
+      "rendered" and phash the figure's perceptual hash as 16 hex digits.
+    """
+    profile = get_profile(profile)
+    page = pdf_document[page_number - 1]
+
+    pending = []  # (output_base, future, method)
+    to_render = []
+    image_infos = page.get_image_info(xrefs=True)
+    drawings = []
+    for coords, output_base, thumbnail_filepath, size_bases in jobs:
+        rect = bounding_box_to_rect(coords)
+        thumbnail = (thumbnail_filepath, THUMBNAIL_MAX_SIDE, THUMBNAIL_JPG_QUALITY) if thumbnail_filepath else None
+        kind = "raster" if raster_coverage(rect, image_infos) >= RASTER_FIGURE_MIN_COVERAGE else "vector"
+        fmt = profile["formats"][kind]
+        image = find_embedded_image(pdf_document, page, rect, image_infos, drawings) if kind == "raster" else None
+        if image is None:
+            to_render.append((rect, output_base, "png" if fmt == "original" else fmt, thumbnail, size_bases))
+            continue
+
+        with span("decode_embedded"):
+            decoded = pixmap_to_image(fitz.Pixmap(image["image"]))
+        if fmt == "original":
+            output_filepath = f"{output_base}.{EMBEDDED_IMAGE_FORMATS[image['ext']]}"
+            with span("copy_embedded"):
+                with atomic_output(output_filepath) as tmp_filepath:
+                    with open(tmp_filepath, "wb") as f:
+                        f.write(image["image"])
+            # The copy is kept at full resolution; only the thumbnail and extra sizes are encoded
+            future = encoder_pool().submit(_encode_and_hash, decoded, None, image["ext"], profile, None, size_bases, thumbnail, output_filepath, keep_pixels)
+        else:
+            size = fit_size(*decoded.size, max_side=profile["max_side"], max_pixels=profile["max_pixels"])
+            future = encoder_pool().submit(_encode_and_hash, decoded, output_base, fmt, profile, size, size_bases, thumbnail, None, keep_pixels)
+        pending.append((output_base, future, "embedded"))
+        increment("figures_embedded")
+
+    if to_render:
+        # Rasterize the union of all remaining figure boxes once, at the highest DPI any of them needs,
+        # then cut each figure out of it
+        union_rect = fitz.Rect(to_render[0][0])
+        for rect, *_ in to_render[1:]:
+            union_rect |= rect
+        dpi = math.ceil(max(figure_dpi(rect, profile) for rect, *_ in to_render))
+
+        def rasterize():
+            with span("rasterize_page"):
+                pix = page.get_pixmap(clip=union_rect, dpi=dpi)
+            increment("pixels_rendered", pix.width * pix.height)
+            return pix
+        if keep_pixels:
+            page_pix = get_raster_cache().get_or_create(("page", pdf_document.name, page_number, tuple(union_rect), dpi), rasterize)
+        else:
+            page_pix = rasterize()
+        if page_pix.colorspace.n not in (1, 3):
+            page_pix = fitz.Pixmap(fitz.csRGB, page_pix)
+        page_pixels = pixmap_array(page_pix)
+
+        zoom = dpi / 72
+        for rect, output_base, fmt, thumbnail, size_bases in to_render:
+            irect = (rect * fitz.Matrix(zoom, zoom)).irect & page_pix.irect
+            if irect.is_empty:
+                continue
+            with span("crop"):
+                # A view into the page raster; PIL makes the one copy the figure needs
+                image = Image.fromarray(page_pixels[irect.y0 - page_pix.y:irect.y1 - page_pix.y, irect.x0 - page_pix.x:irect.x1 - page_pix.x])
+            # Figures needing less than the shared DPI are scaled down to their own budget
+            scale = figure_dpi(rect, profile) / dpi
+            size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+            pending.append((output_base, encoder_pool().submit(_encode_and_hash, image, output_base, fmt, profile, size, size_bases, thumbnail, None, keep_pixels), "rendered"))
+            increment("figures_rendered")
+
+    # Files are written under a temporary name and moved into place, so an interrupted run never leaves a partial image
+    written = []
+    for output_base, future, method in pending:
+        output_filepath, phash = future.result()
+        written.append((output_base, output_filepath, method, phash))
+    return written
+
+def _render_page_worker(page_number, jobs, profile):
+    # Metrics collected in the worker travel back with its result; the pixels stay in the worker
+    return render_page_figures(_render_worker_document, page_number, jobs, profile), METRICS.drain()
+
+@instrumented("render_figure_list")
+def render_figure_list(figure_list, output_dir, max_workers=DEFAULT_RENDER_WORKERS, thumbnail_dir=None, profile=DEFAULT_OUTPUT_PROFILE, sizes_dir=None, image_hashes=None, keep_pixels=False):
+    """
+    Render all figures of a FigureList, grouped by page, over a process pool.
+
+    Figures may also arrive from a generator such as iter_figures: each run of figures on the same
+    page is handed to the pool as soon as a figure on another page arrives, so rendering overlaps
+    with reading the rest of the response.
+
+    Args:
+    - figure_list: The FigureList or iterable of Figures to render. All figures must come from the same PDF.
+    - output_dir: Directory the images are written to, one per figure named after image_name,
+      encoded as the output profile sets.
+    - max_workers: Number of worker processes. 1 renders serially in this process.
+    - thumbnail_dir: If set, a <image_name>.jpg thumbnail of each figure is written there too.
+    - profile: An output profile name or dict (see figure_encoding.py).
+    - sizes_dir: Where the profile's extra sizes are written, as <sizes_dir>/<side>/<image_name>.<ext>.
+      Defaults to a "sizes" directory next to output_dir.
+    - image_hashes: If given, a dict that is filled with each written figure's image_name and its
+      perceptual hash (16 hex digits), computed from the rendered pixels.
+    - keep_pixels: Keep the page rasters and written figures' pixels in this process's raster cache (see
+      raster_cache.py), so hashing or classifying them later in this process does not decode them from
+      disk. Only set it for such a caller; it applies when rendering serially.
+
+    Returns:
+    - A dict mapping each written figure's image_name to its output filepath.
+    """
+    figures = figure_list.figures if isinstance(figure_list, FigureList) else figure_list
+    if isinstance(figures, list):
+        max_workers = min(max_workers, len({figure.page_number for figure in figures}))
+
+    os.makedirs(output_dir, exist_ok=True)
+    if thumbnail_dir:
+        os.makedirs(thumbnail_dir, exist_ok=True)
+    extra_sizes = get_profile(profile)["sizes"]
+    sizes_dir = sizes_dir or os.path.join(os.path.dirname(os.path.normpath(output_dir)), "sizes")
+
+    written = []
+    names_by_base = {}
+    input_pdf = None
+    pdf_document = None
+    executor = None
+    futures = []
+    try:
+        for page_number, page_figures in itertools.groupby(figures, key=lambda figure: figure.page_number):
+            jobs = []
+            for figure in page_figures:
+                input_pdf = figure.original_doc_filepath
+                output_base = os.path.join(output_dir, figure.image_name)
+                names_by_base[output_base] = figure.image_name
+                thumbnail_filepath = os.path.join(thumbnail_dir, f"{figure.image_name}.jpg") if thumbnail_dir else None
+                size_bases = [(side, os.path.join(sizes_dir, str(side), figure.image_name)) for side in extra_sizes]
+                jobs.append((figure.image_coordinates, output_base, thumbnail_filepath, size_bases))
+
+            if max_workers <= 1:
+                pdf_document = pdf_document or fitz.open(input_pdf)
+                written.extend(render_page_figures(pdf_document, page_number, jobs, profile, keep_pixels=keep_pixels))
+            else:
+                # Not forked: encoder threads, or the service's request and job threads, may hold locks at the moment of a fork
+                executor = executor or ProcessPoolExecutor(max_workers=max_workers, mp_context=worker_context(), initializer=_init_render_worker, initargs=(input_pdf, worker_log_level()))
+                futures.append(executor.submit(_render_page_worker, page_number, jobs, profile))
+
+        for future in futures:
+            page_written, worker_metrics = future.result()
+            written.extend(page_written)
+            METRICS.merge(worker_metrics)
+    finally:
+        if pdf_document is not None:
+            pdf_document.close()
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    if input_pdf is None:
+        return {}
+    num_embedded = sum(1 for _, _, method, _ in written if method == "embedded")
+    logger.info("Wrote %d figures from '%s': %d embedded images copied, %d rendered.", len(written), input_pdf, num_embedded, len(written) - num_embedded)
+    if image_hashes is not None:
+        image_hashes.update((names_by_base[output_base], phash) for output_base, _, _, phash in written)
+    return {names_by_base[output_base]: output_filepath for output_base, output_filepath, _, _ in written}
+
 ############################################################
 ### Base classes 
+# Corpus-scale catalogs hold millions of figures, so a Figure is kept small: no per-instance
+# __dict__, coordinates packed into one array, repeated strings interned, and large html kept
+# zlib-compressed until it is read.
+HTML_COMPRESS_MIN_CHARS = 256
+
+def pack_coordinates(image_coordinates):
+    """
+    A layout bounding box (list of {'x', 'y'} points) as a flat array of x, y values
+    """
+    if not image_coordinates:
+        return None
+    values = [value for coord in image_coordinates for value in (coord["x"], coord["y"])]
+    return array("i" if all(isinstance(value, int) for value in values) else "d", values)
+
+def unpack_coordinates(packed):
+    if packed is None:
+        return None
+    return [{"x": packed[i], "y": packed[i + 1]} for i in range(0, len(packed), 2)]
+
 class Figure:
-    def __init__(self, original_doc_filepath, image_name, image_caption, image_descriptions, page_number, image_coordinates, html, element_id, FigureListObj):
+    __slots__ = ("original_doc_filepath", "image_name", "image_caption", "_image_descriptions", "page_number", "_coordinates", "_html", "element_id")
+
+    def __init__(self, original_doc_filepath, image_name, image_caption, image_descriptions, page_number, image_coordinates, html, element_id):
+        if original_doc_filepath is not None:
+            original_doc_filepath = sys.intern(os.fspath(original_doc_filepath))
         self.original_doc_filepath = original_doc_filepath
         self.image_name = image_name
         self.image_caption = image_caption
-        self.image_descriptions = [image_descriptions] if image_descriptions else []
+        self._image_descriptions = [image_descriptions] if image_descriptions else None
         self.page_number = page_number
-        self.image_coordinates = image_coordinates
+        self._coordinates = pack_coordinates(image_coordinates)
         self.html = html
         self.element_id = element_id
-        self.FigureListObj = FigureListObj
 
-    def __dict__(self):
+    @property
+    def image_descriptions(self):
+        # Created on first access, so appending to the returned list is kept
+        if self._image_descriptions is None:
+            self._image_descriptions = []
+        return self._image_descriptions
+
+    @property
+    def image_coordinates(self):
+        return unpack_coordinates(self._coordinates)
+
+    @property
+    def html(self):
+        if isinstance(self._html, bytes):
+            return zlib.decompress(self._html).decode("utf-8")
+        return self._html
+
+    @html.setter
+    def html(self, html):
+        if html and len(html) >= HTML_COMPRESS_MIN_CHARS:
+            self._html = zlib.compress(html.encode("utf-8"), 1)
+        else:
+            self._html = html
+
+    def to_dict(self):
         return {
             "original_doc_filepath": self.original_doc_filepath,
             "image_name": self.image_name,
             "image_caption": self.image_caption,
-            "image_descriptions": self.image_descriptions,
+            "image_descriptions": list(self.image_descriptions),
             "page_number": self.page_number,
             "image_coordinates": self.image_coordinates,
             "html": self.html,
@@ -85,10 +527,12 @@ class Figure:
     def set_figure_name(self, name):
         # Replace periods with hyphens in the figure name
         name = name.replace(".", "-")
-        self.image_name = name
+        self.image_name = sys.intern(name)
 
     def add_image_descriptions(self, description):
-        self.image_descriptions.append(description)
+        if self._image_descriptions is None:
+            self._image_descriptions = []
+        self._image_descriptions.append(description)
 
     def save_image_from_page_coordinates(self, output_filepath):
         success = crop_and_save_image(self.original_doc_filepath, output_filepath, self.page_number, self.image_coordinates)
@@ -98,72 +542,109 @@ class FigureList:
     def __init__(self):
         self.figures = []
         self.figure_names = defaultdict(int)  # Tracks the count of each figure name
+        self.figures_by_name = {}  # Index of unique figure name -> Figure
 
     def add_figure(self, figure):
-        # print(figure.image_name)
         base_name = figure.image_name
-        # print(self.figure_names[base_name])
         if self.figure_names[base_name] > 0:
-            print(f"Figure name {base_name} already exists")
             # If the figure name already exists, append a number to make it unique 
             figure.set_figure_name(f"{base_name} ({self.figure_names[base_name]})")
         self.figures.append(figure)
+        self.figures_by_name.setdefault(figure.image_name, figure)
         # Increment the count for this base name
         self.figure_names[base_name] += 1
 
     def get_figure_by_name(self, name):
-        for figure in self.figures:
-            if figure.image_name == name:
-                return figure
-        return None
+        return self.figures_by_name.get(name)
 
 ############################################################
-### 
+### Linking figures to captions and references
 
-def process_figures(pdf_filepath, response_json):
+# Matches "Figure 3", "Fig. 3.2", "fig 3-2-1" etc. Used for both captions and in-text references
+FIGURE_REFERENCE_PATTERN = re.compile(r'(?i)\b(Figure|Fig\.?)\s*(\d+(?:[.-]\d+)*)')
+CAPTION_CATEGORIES = frozenset(["caption", "paragraph"])
+
+def normalize_figure_name(number):
     """
-    Process the figures from the response JSON and return a FigureList object 
+    Canonical figure name for a figure number, so "Figure 3.2" and "Fig. 3-2" both become "Figure 3-2"
     """
-    OUTPUT_DIR = "output_figures"
-    figure_list = FigureList()
+    return f"Figure {number}".replace(".", "-")
+
+def iter_figures(pdf_filepath, response, figure_list=None):
+    """
+    Yield the figures of a layout response as soon as their captions are resolved.
+
+    Runs in a single pass over the elements: each figure waits in a pending window until the next
+    caption or paragraph within NUM_ADDITIONAL_ELEMENTS_TO_LOOK_FOR_CAPTIONS elements resolves it,
+    and is yielded with its final name then. Only that window is kept, so a response file (see
+    element_stream.py) is never held in memory whole. In-text references are collected by figure name
+    and attached to the already yielded figures once all elements are read.
+
+    Args:
+    - pdf_filepath: The PDF the response is for.
+    - response: The response JSON as a dict, or a path to or open text file of a response JSON file.
+    - figure_list: FigureList the figures are added to, for unique names. A new one by default.
+    """
+    figure_list = FigureList() if figure_list is None else figure_list
+    pending_figures = deque()  # (element index, Figure) still looking for a caption, in element order
+    references = defaultdict(list)  # figure name -> texts that mention it
+
+    def resolve(figure, caption_text=None, figure_name=None):
+        if caption_text is not None:
+            figure.create_image_caption(caption_text)
+        if figure_name:
+            figure.set_figure_name(figure_name)
+        if not figure.image_name:  # Ensure we have a valid figure name before adding
+            figure.set_figure_name(f"Element {figure.element_id}")
+        figure_list.add_figure(figure)
+        return figure
+
+    num_elements = 0
+    for i, element in enumerate(iter_elements(response)):
+        num_elements += 1
+        # Figures whose look-ahead window ended without a caption keep their element name
+        while pending_figures and i - pending_figures[0][0] >= NUM_ADDITIONAL_ELEMENTS_TO_LOOK_FOR_CAPTIONS:
+            yield resolve(pending_figures.popleft()[1])
+
+        text = element["text"]
+        figure_names = [normalize_figure_name(match.group(2)) for match in FIGURE_REFERENCE_PATTERN.finditer(text)] if text else []
+        for figure_name in dict.fromkeys(figure_names):
+            references[figure_name].append(text)
 
-    for i, element in enumerate(response_json["elements"]):
         if element["category"] == "figure":
-            this_figure = Figure(original_doc_filepath=pdf_filepath, image_name=None, image_caption=None, image_descriptions=element["text"], page_number=element["page"], image_coordinates=element.get("bounding_box"), html=element["html"], element_id=element["id"], FigureListObj=figure_list)
-
-            print("\n=================================")
-            print(response_json["elements"][i]["id"])
-
-            # Look for the next caption or paragraph after all 'figure' elements
-            for j in range(i+1, min(i+NUM_ADDITIONAL_ELEMENTS_TO_LOOK_FOR_CAPTIONS, len(response_json["elements"]))):
-                next_element = response_json["elements"][j]
-                print(f'\n next element {j} \n {next_element["text"]}\n')
-
-                if next_element["category"] in ["caption", "paragraph"] and next_element["text"] not in ["", " ", None]:
-                    this_figure.create_image_caption(next_element["text"])
-                    match = re.search(r'(?i)(Figure|Fig\.?)\s*(\d+(?:[.-]\d+)*)', next_element["text"])
-                    if match:
-                        this_figure.set_figure_name(f"{match.group(1)} {match.group(2)}")
-                        print("set figure name to", f"{match.group(1)} {match.group(2)}")
-                    break  # Stop after finding the first caption or paragraph
-
-            if not this_figure.image_name:  # Ensure we have a valid figure name before adding
-                this_figure.set_figure_name(f"Element {element['id']}")
-            figure_list.add_figure(this_figure)
-            
-            # Now save the image with the potentially updated unique name # nvm we save it later in process_pdf 
-            # this_figure.save_image_from_page_coordinates(output_filepath=f"{OUTPUT_DIR}/{this_figure.image_name}.png")
-
-    # Process descriptions for all figures by going through the rest of the text
-    for element in response_json["elements"]:
-        if "Figure" in element["text"] or "Fig" in element["text"]:
-            match = re.search(r'(Figure|Fig)\s?(\d+(\.\d+)?)', element["text"])
-            if match:
-                figure_name = f"{match.group(1)} {match.group(2)}"
-                existing_figure = next((fig for fig in figure_list.figures if fig.image_name == figure_name), None)
-                if existing_figure:
-                    existing_figure.add_image_descriptions(element["text"])
+            this_figure = Figure(original_doc_filepath=pdf_filepath, image_name=None, image_caption=None, image_descriptions=text, page_number=element["page"], image_coordinates=element.get("bounding_box"), html=element["html"], element_id=element["id"])
+            pending_figures.append((i, this_figure))
+
+        # The first caption or paragraph after a figure is its caption
+        elif pending_figures and element["category"] in CAPTION_CATEGORIES and text not in ["", " ", None]:
+            figure_name = figure_names[0] if figure_names else None
+            while pending_figures:
+                yield resolve(pending_figures.popleft()[1], caption_text=text, figure_name=figure_name)
+
+    while pending_figures:
+        yield resolve(pending_figures.popleft()[1])
+
+    # Attach descriptions for all figures from the references found in the rest of the text
+    for figure_name, texts in references.items():
+        existing_figure = figure_list.get_figure_by_name(figure_name)
+        if existing_figure:
+            for text in texts:
+                existing_figure.add_image_descriptions(text)
+
+    increment("elements_processed", num_elements)
+    increment("figures_found", len(figure_list.figures))
+    increment("captions_linked", sum(1 for figure in figure_list.figures if figure.image_caption))
+
+@instrumented("process_figures")
+def process_figures(pdf_filepath, response_json):
+    """
+    Process the figures from the response JSON and return a FigureList object 
 
+    response_json may also be the path of a response JSON file, which is then read incrementally.
+    """
+    figure_list = FigureList()
+    for _ in iter_figures(pdf_filepath, response_json, figure_list):
+        pass
     return figure_list
 
 
@@ -239,53 +720,115 @@ def process_figures(pdf_filepath, response_json):
 #     print(f"Figure Name: {figure.image_name}, Caption: {figure.image_caption}")
 
 
-from PyPDF2 import PdfFileReader, PdfFileWriter
+############################################################
+## Chunked upload
+# Large documents are split in memory and the chunks are analyzed concurrently, so the
+# time to a full response is bounded by the slowest chunk rather than the sum of all of them.
 
-def split_pdf_into_chunks(pdf_name, pdf_filepath, OUTPUT_DIR):
+def split_pdf_into_chunks(pdf_filepath, chunk_pages=DEFAULT_CHUNK_PAGES, pages=None):
     """
-    Splits the given PDF into chunks of 25 pages each and saves those chunks into the specified output directory.
+    Splits the given PDF into chunks of chunk_pages pages each, in memory.
+
+    Args:
+    - pages: 0-based indices of the pages to keep, in order; all pages by default.
+
+    Returns:
+    - A list of (page_offset, pdf_bytes) tuples, where page_offset is the number of kept pages before the chunk.
     """
+    chunks = []
+    with fitz.open(pdf_filepath) as pdf_document:
+        if pages is not None:
+            pdf_document.select(pages)
+        total_pages = len(pdf_document)
+        for start_page in range(0, total_pages, chunk_pages):
+            end_page = min(start_page + chunk_pages, total_pages)
+            with fitz.open() as chunk_document:
+                chunk_document.insert_pdf(pdf_document, from_page=start_page, to_page=end_page - 1)
+                chunks.append((start_page, chunk_document.tobytes(garbage=3, deflate=True, no_new_id=True)))
+    return chunks
+
+def merge_chunk_responses(chunk_responses):
+    """
+    Merge per-chunk layout responses into one, rebasing page numbers and element ids.
 
-    pdf_split_dir = os.path.join(pdf_name, "pdf_split")
-    os.makedirs(os.path.join(OUTPUT_DIR, pdf_split_dir), exist_ok=True) 
+    Args:
+    - chunk_responses: List of (page_offset, response_json) tuples in document order.
 
-    # Open the PDF file
-    with open(pdf_filepath, 'rb') as infile:
-        reader = PdfFileReader(infile)
-        total_pages = reader.numPages
-        
-        # Calculate the number of chunks
-        num_chunks = total_pages // 25 + (1 if total_pages % 25 else 0)
-        
-        # Split and save each chunk
-        for i in range(num_chunks):
-            writer = PdfFileWriter()
-            start_page = i * 25
-            end_page = min(start_page + 25, total_pages)
-            
-            # Add pages to each chunk
-            for page_num in range(start_page, end_page):
-                writer.addPage(reader.getPage(page_num))
-            
-            # Save the chunk to a file
-            chunk_filename = os.path.join(OUTPUT_DIR, f"{pdf_name}_{i+1}.pdf")
-            with open(chunk_filename, 'wb') as outfile:
-                writer.write(outfile)
-            
-            print(f"Saved {chunk_filename}")
+    Returns:
+    - A single response JSON whose elements read as if the whole document had been uploaded at once.
+    """
+    merged = {"elements": []}
+    id_offset = 0
+    for page_offset, response_json in chunk_responses:
+        for key, value in response_json.items():
+            if key == "elements":
+                continue
+            if key == "billed_pages" and key in merged:
+                merged[key] += value
+            else:
+                merged.setdefault(key, value)
+
+        max_id = -1
+        for element in response_json["elements"]:
+            element = dict(element)
+            element["page"] += page_offset
+            max_id = max(max_id, element["id"])
+            element["id"] += id_offset
+            if element.get("html"):
+                element["html"] = HTML_ID_PATTERN.sub(lambda m: f"{m.group(1)}{int(m.group(2)) + id_offset}{m.group(3)}", element["html"])
+            merged["elements"].append(element)
+        id_offset += max_id + 1
+    return merged
+
+def post_document_to_layout_api(document, filename="document.pdf"):
+    UPSTAGE_API_KEY = os.getenv("UPSTAGE_API_KEY")
+    headers = {"Authorization": f"Bearer {UPSTAGE_API_KEY}"}
+    increment("upload_requests")
+    increment("upload_bytes", len(document) if isinstance(document, bytes) else os.fstat(document.fileno()).st_size)
+    with span("upload"):
+        # Pooled, rate limited and retried on 429 and 5xx (see http_client.py)
+        response = get_client("upstage").post(UPSTAGE_LAYOUT_URL, headers=headers, files={"document": (filename, document, "application/pdf")})
+    try:
+        response_json = response.json()
+    except ValueError:
+        response_json = None
+    if not isinstance(response_json, dict) or "elements" not in response_json:
+        raise ValueError(f"Layout analysis failed for {filename} with status {response.status_code}: {response_json if response_json is not None else response.text[:500]}")
+    return response_json
+
+def get_element_json_from_pdf_chunks(file_filename, cache=LAYOUT_CACHE, chunk_pages=DEFAULT_CHUNK_PAGES, max_workers=DEFAULT_CHUNK_UPLOAD_WORKERS, pages=None):
+    """
+    Upload the PDF in chunks of chunk_pages pages concurrently and merge the results into one response
+
+    With pages, only those pages are uploaded and the response's page numbers count the kept pages.
+    """
+    pdf_name = os.path.splitext(os.path.basename(file_filename))[0]
+    chunks = split_pdf_into_chunks(file_filename, chunk_pages=chunk_pages, pages=pages)
 
+    def analyze_chunk(chunk_index, chunk_bytes):
+        chunk_filename = f"{pdf_name}_{chunk_index + 1}.pdf"
+        fetch = lambda: post_document_to_layout_api(chunk_bytes, filename=chunk_filename)
+        if cache is None:
+            return fetch()
+        return cache.get_or_fetch(chunk_filename, UPSTAGE_LAYOUT_URL, UPSTAGE_API_VERSION, fetch, content_hash=hash_bytes(chunk_bytes))
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(chunks)))) as executor:
+        futures = [executor.submit(analyze_chunk, i, chunk_bytes) for i, (_, chunk_bytes) in enumerate(chunks)]
+        chunk_responses = [(page_offset, future.result()) for (page_offset, _), future in zip(chunks, futures)]
+
+    return merge_chunk_responses(chunk_responses)
 
 
 
 ############################################################
 ## Process the PDF and save the figures
-def process_json_from_pdf(pdf_filepath, response_json, OUTPUT_DIR="output_figures"):
+@instrumented("extract_figures")
+def extract_figures_from_response(pdf_filepath, response_json, OUTPUT_DIR="output_figures", max_workers=DEFAULT_RENDER_WORKERS, profile=DEFAULT_OUTPUT_PROFILE):
     """
-    Process the PDF and save the figures in the output directory
+    Link figures to their captions, render them into the output directory and return the figure list as dicts
+
+    response_json may also be the path of a response JSON file, which is then read incrementally.
     """
-    # Assuming `process_figures` function is defined elsewhere in your code
-    # and it returns a FigureList object after processing the PDF file.
-    
     # Extract PDF name without extension
     pdf_name = os.path.splitext(os.path.basename(pdf_filepath))[0]
     
@@ -293,118 +836,358 @@ def process_json_from_pdf(pdf_filepath, response_json, OUTPUT_DIR="output_figure
     diagrams_dir = os.path.join(pdf_name, "diagrams")
     os.makedirs(os.path.join(OUTPUT_DIR, diagrams_dir), exist_ok=True) 
 
-    # Call the function to split the PDF
-    # pdf_chunk_filepath = split_pdf_into_chunks(pdf_name, pdf_filepath, OUTPUT_DIR)
-
-    figure_list = process_figures(pdf_filepath, response_json)
+    # Save each figure image, one raster per page, spread over max_workers processes. Figures are
+    # linked to their captions as the elements are read and rendered while the rest are still linked.
+    figure_list = FigureList()
+    image_hashes = {}
+    figures = timed_iter("process_figures", iter_figures(pdf_filepath, response_json, figure_list))
+    written = render_figure_list(figures, os.path.join(OUTPUT_DIR, diagrams_dir), max_workers=max_workers, thumbnail_dir=os.path.join(OUTPUT_DIR, pdf_name, "thumbnails"), profile=profile, sizes_dir=os.path.join(OUTPUT_DIR, pdf_name, "sizes"), image_hashes=image_hashes)
 
+    figure_list_dict = [figure.to_dict() for figure in figure_list.figures]
+    for figure in figure_list_dict:
+        if figure["image_name"] in written:
+            figure["image_file"] = os.path.basename(written[figure["image_name"]])
 
-    # Save each figure image
-    for figure in figure_list.figures:
-        output_filepath = os.path.join(OUTPUT_DIR, diagrams_dir, f"{figure.image_name}.png")
-        figure.save_image_from_page_coordinates(output_filepath)
+    # Perceptual hashes for near-duplicate detection were computed by the render workers from the rendered pixels
+    return add_image_hashes(figure_list_dict, os.path.join(OUTPUT_DIR, diagrams_dir), known_hashes=image_hashes)
 
-    # Save the figure list as a JSON file
-    figure_list_dict = [figure.__dict__() for figure in figure_list.figures]
+@instrumented("write_json")
+def write_figure_list_json(pdf_filepath, figure_list_dict, OUTPUT_DIR="output_figures"):
+    """
+    Save the figure list as a JSON file next to the diagrams directory
+    """
+    pdf_name = os.path.splitext(os.path.basename(pdf_filepath))[0]
     json_filepath = os.path.join(OUTPUT_DIR, pdf_name, f"{pdf_name}_figure_list.json") 
-    with open(json_filepath, "w") as json_file:
-        json.dump(figure_list_dict, json_file, indent=4)
+    with atomic_output(json_filepath) as tmp_filepath:
+        with open(tmp_filepath, "w") as json_file:
+            json.dump(figure_list_dict, json_file, indent=4)
+    return json_filepath
 
-    print(f"Processed PDF '{pdf_filepath}'. Results saved in '{OUTPUT_DIR}/{pdf_name}/' directory.")
+@instrumented("save_figure_list")
+def save_figure_list(pdf_filepath, figure_list_dict, OUTPUT_DIR="output_figures", index_dir=None, dedup_dir=None, write_json=False):
+    """
+    Record a finished book: link near-duplicates, append it to the figure catalog and add it to the diagram index
+
+    The catalog (OUTPUT_DIR/figure_catalog.sqlite) is the store of record; the per-book JSON file is only
+    written when write_json is set. index_dir and dedup_dir default to OUTPUT_DIR's diagram and near-duplicate
+    indexes; False disables them.
+    """
+    pdf_name = os.path.splitext(os.path.basename(pdf_filepath))[0]
+
+    # Link each figure to its canonical near-duplicate across the corpus before it is written.
+    # The index is kept for the whole run, so only this book's figures are looked up.
+    dedup_dir = resolve_dedup_dir(dedup_dir, OUTPUT_DIR)
+    if dedup_dir:
+        num_duplicates = get_dedup_index(dedup_dir).add_book(pdf_name, figure_list_dict)
+        if num_duplicates:
+            logger.info("%d figures in '%s' are near-duplicates of figures already in the corpus.", num_duplicates, pdf_filepath)
+        increment("near_duplicates", num_duplicates)
+
+    with FigureCatalog(catalog_path_for(OUTPUT_DIR)) as catalog:
+        catalog.add_book(pdf_name, figure_list_dict)
+
+    if write_json:
+        write_figure_list_json(pdf_filepath, figure_list_dict, OUTPUT_DIR=OUTPUT_DIR)
+
+    index_dir = resolve_index_dir(index_dir, OUTPUT_DIR)
+    if index_dir:
+        index = DiagramIndex(index_dir)
+        index.add_book(pdf_name, figure_list_dict, image_dir=os.path.join(OUTPUT_DIR, pdf_name, "diagrams"))
+        index.close()
+
+def process_json_from_pdf(pdf_filepath, response_json, OUTPUT_DIR="output_figures", max_workers=DEFAULT_RENDER_WORKERS, index_dir=None, write_json=False, profile=DEFAULT_OUTPUT_PROFILE, dedup_dir=None):
+    """
+    Process the PDF and save the figures in the output directory
+    """
+    figure_list_dict = extract_figures_from_response(pdf_filepath, response_json, OUTPUT_DIR=OUTPUT_DIR, max_workers=max_workers, profile=profile)
+    save_figure_list(pdf_filepath, figure_list_dict, OUTPUT_DIR=OUTPUT_DIR, index_dir=index_dir, dedup_dir=dedup_dir, write_json=write_json)
+
+    pdf_name = os.path.splitext(os.path.basename(pdf_filepath))[0]
+    logger.info("Processed PDF '%s'. Results saved in '%s/%s/' directory.", pdf_filepath, OUTPUT_DIR, pdf_name)
+
+############################################################
+## Run manifest
+# Completed stages are recorded per document in OUTPUT_DIR/run_manifest.sqlite (see run_manifest.py).
+# Bump a stage's version when a code change alters its outputs; that stage and the ones after it
+# are then redone on the next run.
+STAGE_VERSIONS = {"layout": 1, "extract": 3, "save": 1}
+
+def resolve_index_dir(index_dir, OUTPUT_DIR):
+    """
+    index_dir, or the output directory's diagram index if it is None (see index_dir_for). False disables indexing.
+    """
+    return index_dir_for(OUTPUT_DIR) if index_dir is None else index_dir
+
+def resolve_dedup_dir(dedup_dir, OUTPUT_DIR):
+    """
+    dedup_dir, or the output directory's near-duplicate index if it is None (see dedup_dir_for). False disables deduplication.
+    """
+    return dedup_dir_for(OUTPUT_DIR) if dedup_dir is None else dedup_dir
+
+def stage_fingerprints(index_dir=None, dedup_dir=None, write_json=False, layout_backend=DEFAULT_LAYOUT_BACKEND, profile=DEFAULT_OUTPUT_PROFILE):
+    layout_config = {"backend": layout_backend, "url": UPSTAGE_LAYOUT_URL, "chunk_pages": DEFAULT_CHUNK_PAGES, "page_triage": triage_config() if PAGE_TRIAGE else None}
+    if layout_backend != "remote":
+        layout_config.update({"local_model": LOCAL_LAYOUT_MODEL, "local_version": LOCAL_LAYOUT_VERSION})
+    layout = stage_fingerprint("layout", STAGE_VERSIONS["layout"], layout_config)
+    extract = stage_fingerprint("extract", STAGE_VERSIONS["extract"], {
+        "caption_lookahead": NUM_ADDITIONAL_ELEMENTS_TO_LOOK_FOR_CAPTIONS,
+        "output_profile": get_profile(profile),
+        "raster_figure_min_coverage": RASTER_FIGURE_MIN_COVERAGE,
+        "thumbnail_max_side": THUMBNAIL_MAX_SIDE,
+        "thumbnail_jpg_quality": THUMBNAIL_JPG_QUALITY,
+    }, layout)
+    save = stage_fingerprint("save", STAGE_VERSIONS["save"], {"index_dir": index_dir, "dedup_dir": dedup_dir, "write_json": write_json}, extract)
+    return {"layout": layout, "extract": extract, "save": save}
+
+def document_key(manifest, pdf_filepath):
+    """
+    (content hash, book name) a PDF's stages are recorded under in the run manifest
+    """
+    return manifest.content_hash(pdf_filepath), os.path.splitext(os.path.basename(pdf_filepath))[0]
+
+def completed_extraction(manifest, key, fingerprints, OUTPUT_DIR):
+    """
+    The figure list of a finished, current extract stage whose images are all still on disk, or None
+    """
+    figure_list_dict = manifest.outputs(*key, "extract", fingerprints["extract"])
+    if figure_list_dict is None:
+        return None
+    for figure in figure_list_dict:
+        pdf_name = os.path.splitext(os.path.basename(figure["original_doc_filepath"]))[0]
+        if not os.path.exists(os.path.join(OUTPUT_DIR, pdf_name, "diagrams", image_filename(figure))):
+            return None
+    return figure_list_dict
 
 ############################################################
 ## Main function
 
-def process_full_pdf(pdf_filepath, OUTPUT_DIR="output_figures"):
+def process_full_pdf(pdf_filepath, OUTPUT_DIR="output_figures", max_workers=DEFAULT_RENDER_WORKERS, index_dir=None, write_json=False, resume=True, layout_backend=DEFAULT_LAYOUT_BACKEND, profile=DEFAULT_OUTPUT_PROFILE, dedup_dir=None):
     """
     Process the full PDF and save the figures in the output directory
+
+    With resume, stages already completed for this PDF's contents with the current versions and config are skipped.
+    index_dir and dedup_dir default to OUTPUT_DIR's diagram and near-duplicate indexes; False disables them.
+    """
+    index_dir = resolve_index_dir(index_dir, OUTPUT_DIR)
+    dedup_dir = resolve_dedup_dir(dedup_dir, OUTPUT_DIR)
+    if not resume:
+        # Extract the images and texts from the PDF 
+        response_json = get_element_json_from_pdf(pdf_filepath, backend=layout_backend, layout_workers=max_workers, as_path=True)
+        return process_json_from_pdf(pdf_filepath, response_json, OUTPUT_DIR=OUTPUT_DIR, max_workers=max_workers, index_dir=index_dir, write_json=write_json, profile=profile, dedup_dir=dedup_dir)
+
+    fingerprints = stage_fingerprints(index_dir=index_dir, dedup_dir=dedup_dir, write_json=write_json, layout_backend=layout_backend, profile=profile)
+    with RunManifest(manifest_path_for(OUTPUT_DIR)) as manifest:
+        key = document_key(manifest, pdf_filepath)
+        if manifest.is_done(*key, "save", fingerprints["save"]):
+            logger.info("Skipping '%s', already processed.", pdf_filepath)
+            increment("documents_skipped")
+            return
+
+        figure_list_dict = completed_extraction(manifest, key, fingerprints, OUTPUT_DIR)
+        if figure_list_dict is None:
+            response_json = get_element_json_from_pdf(pdf_filepath, backend=layout_backend, layout_workers=max_workers, as_path=True)
+            manifest.mark_done(*key, "layout", fingerprints["layout"])
+            figure_list_dict = extract_figures_from_response(pdf_filepath, response_json, OUTPUT_DIR=OUTPUT_DIR, max_workers=max_workers, profile=profile)
+            manifest.mark_done(*key, "extract", fingerprints["extract"], outputs=figure_list_dict)
+
+        save_figure_list(pdf_filepath, figure_list_dict, OUTPUT_DIR=OUTPUT_DIR, index_dir=index_dir, dedup_dir=dedup_dir, write_json=write_json)
+        manifest.mark_done(*key, "save", fingerprints["save"])
+    increment("documents_processed")
+
+    pdf_name = os.path.splitext(os.path.basename(pdf_filepath))[0]
+    logger.info("Processed PDF '%s'. Results saved in '%s/%s/' directory.", pdf_filepath, OUTPUT_DIR, pdf_name)
+
+############################################################
+## Directory ingestion
+# Three stages connected by bounded queues:
+#   1. upload threads call the layout API (network bound)
+#   2. a process pool links figures and renders them (CPU bound)
+#   3. a writer thread records each book in the catalog and diagram index
+# A full queue blocks the stage feeding it, so a slow API never piles up work
+# and a fast API never runs further ahead than the CPUs can follow.
+# Each completed stage is recorded in the run manifest, so a re-run resumes where the last one stopped.
+
+_STAGE_DONE = object()
+
+def _extract_figures_worker(pdf_filepath, response_json, OUTPUT_DIR, profile):
+    # The engine already spreads documents over processes, so each document renders serially.
+    # Metrics collected in the worker travel back with its result.
+    return extract_figures_from_response(pdf_filepath, response_json, OUTPUT_DIR=OUTPUT_DIR, max_workers=1, profile=profile), METRICS.drain()
+
+def run_ingestion(pdf_filepaths, OUTPUT_DIR="output_figures", upload_workers=DEFAULT_UPLOAD_WORKERS, cpu_workers=DEFAULT_RENDER_WORKERS, queue_size=None, index_dir=None, write_json=False, resume=True, layout_backend=DEFAULT_LAYOUT_BACKEND, dedup_dir=None, profile=DEFAULT_OUTPUT_PROFILE):
     """
-    # Extract the images and texts from the PDF 
-    response_json = get_element_json_from_pdf(pdf_filepath)
-    results = process_json_from_pdf(pdf_filepath, response_json, OUTPUT_DIR=OUTPUT_DIR)
+    Process many PDFs through the upload, figure-extraction and writer stages concurrently.
+
+    Args:
+    - pdf_filepaths: The PDFs to process.
+    - OUTPUT_DIR: The output directory.
+    - upload_workers: Number of concurrent layout-analysis uploads.
+    - cpu_workers: Number of processes linking and rendering figures.
+    - queue_size: Capacity of the queues between stages. Defaults to cpu_workers.
+    - index_dir: Diagram index updated as each book is written. Defaults to OUTPUT_DIR's (see index_dir_for);
+      False disables indexing.
+    - write_json: Also write the per-book <book>_figure_list.json.
+    - resume: Skip stages the run manifest records as complete and current.
+    - layout_backend: One of LAYOUT_BACKENDS.
+    - dedup_dir: Near-duplicate index each book is matched against. Defaults to OUTPUT_DIR's (see
+      dedup_dir_for); False disables deduplication.
+    - profile: Output profile name or dict the figures are encoded with (see figure_encoding.py).
+
+    Returns:
+    - A dict mapping each PDF path to None on success or the exception that stopped it.
+    """
+    queue_size = queue_size or cpu_workers
+    pending_uploads = queue.Queue()
+    analyzed = queue.Queue(maxsize=queue_size)
+    to_write = queue.Queue(maxsize=queue_size)
+    results = {}
+
+    index_dir = resolve_index_dir(index_dir, OUTPUT_DIR)
+    dedup_dir = resolve_dedup_dir(dedup_dir, OUTPUT_DIR)
+    manifest = RunManifest(manifest_path_for(OUTPUT_DIR))
+    fingerprints = stage_fingerprints(index_dir=index_dir, dedup_dir=dedup_dir, write_json=write_json, layout_backend=layout_backend, profile=profile)
+    document_keys = {}
+    already_extracted = []
+
+    for pdf_filepath in pdf_filepaths:
+        key = document_keys[pdf_filepath] = document_key(manifest, pdf_filepath)
+        if resume and manifest.is_done(*key, "save", fingerprints["save"]):
+            logger.info("Skipping '%s', already processed.", pdf_filepath)
+            increment("documents_skipped")
+            results[pdf_filepath] = None
+            continue
+        figure_list_dict = completed_extraction(manifest, key, fingerprints, OUTPUT_DIR) if resume else None
+        if figure_list_dict is not None:
+            already_extracted.append((pdf_filepath, figure_list_dict))
+        else:
+            pending_uploads.put(pdf_filepath)
+    num_to_extract = pending_uploads.qsize()
+
+    # Local layout analysis runs on the upload threads; share the CPUs between them
+    layout_workers = max(1, cpu_workers // max(1, upload_workers))
+
+    def upload_stage():
+        while True:
+            try:
+                pdf_filepath = pending_uploads.get_nowait()
+            except queue.Empty:
+                return
+            logger.info("Processing %s...", pdf_filepath)
+            try:
+                # The path of the cached response: workers stream it from disk instead of receiving it pickled
+                response_json = get_element_json_from_pdf(pdf_filepath, backend=layout_backend, layout_workers=layout_workers, as_path=True)
+                manifest.mark_done(*document_keys[pdf_filepath], "layout", fingerprints["layout"])
+                analyzed.put((pdf_filepath, response_json, None))
+            except Exception as e:
+                analyzed.put((pdf_filepath, None, e))
+
+    def writer_stage():
+        while True:
+            item = to_write.get()
+            if item is _STAGE_DONE:
+                return
+            pdf_filepath, figure_list_dict, error = item
+            if error is None:
+                try:
+                    save_figure_list(pdf_filepath, figure_list_dict, OUTPUT_DIR=OUTPUT_DIR, index_dir=index_dir, dedup_dir=dedup_dir, write_json=write_json)
+                    manifest.mark_done(*document_keys[pdf_filepath], "save", fingerprints["save"])
+                    pdf_name = os.path.splitext(os.path.basename(pdf_filepath))[0]
+                    logger.info("Processed PDF '%s'. Results saved in '%s/%s/' directory.", pdf_filepath, OUTPUT_DIR, pdf_name)
+                except Exception as e:
+                    error = e
+            if error is not None:
+                logger.error("Error processing %s. Error: %s", pdf_filepath, error)
+                increment("documents_failed")
+            else:
+                increment("documents_processed")
+            results[pdf_filepath] = error
+
+    uploaders = [threading.Thread(target=upload_stage, daemon=True) for _ in range(max(1, min(upload_workers, num_to_extract)))]
+    writer = threading.Thread(target=writer_stage, daemon=True)
+    for thread in uploaders:
+        thread.start()
+    writer.start()
+
+    # Documents whose figures were already rendered by an interrupted run only need writing
+    for pdf_filepath, figure_list_dict in already_extracted:
+        to_write.put((pdf_filepath, figure_list_dict, None))
+
+    # Bound the documents in flight in the process pool; the callback frees a slot
+    cpu_slots = threading.Semaphore(cpu_workers + queue_size)
+
+    def on_extracted(pdf_filepath, future):
+        try:
+            figure_list_dict, worker_metrics = future.result()
+            METRICS.merge(worker_metrics)
+            manifest.mark_done(*document_keys[pdf_filepath], "extract", fingerprints["extract"], outputs=figure_list_dict)
+            to_write.put((pdf_filepath, figure_list_dict, None))
+        except Exception as e:
+            to_write.put((pdf_filepath, None, e))
+        finally:
+            cpu_slots.release()
+
+    if num_to_extract:
+        # Not forked: the uploader and writer threads started above may hold locks at the moment of a fork
+        with ProcessPoolExecutor(max_workers=cpu_workers, mp_context=worker_context(), initializer=init_worker, initargs=(worker_log_level(),)) as executor:
+            for _ in range(num_to_extract):
+                pdf_filepath, response_json, error = analyzed.get()
+                if error is not None:
+                    to_write.put((pdf_filepath, None, error))
+                    continue
+                cpu_slots.acquire()
+                future = executor.submit(_extract_figures_worker, pdf_filepath, response_json, OUTPUT_DIR, profile)
+                future.add_done_callback(lambda f, pdf_filepath=pdf_filepath: on_extracted(pdf_filepath, f))
+
+    to_write.put(_STAGE_DONE)
+    writer.join()
+    manifest.close()
     return results
 
+def list_pdfs(directory_path):
+    return sorted(os.path.join(directory_path, f) for f in os.listdir(directory_path) if f.endswith(".pdf"))
 
 ############################################################
 if __name__ == "__main__":
-    input_path = sys.argv[1]
-    OUTPUT_DIR = sys.argv[2] if len(sys.argv) > 2 else DEFAULT_OUTPUT_DIR
+    parser = argparse.ArgumentParser(description="Process PDF files to extract images.")
+    parser.add_argument("input_path", help="Path to the PDF file or directory containing PDF files.")
+    parser.add_argument("--output-dir", default=DEFAULT_OUTPUT_DIR, help="Output directory for the extracted images.")
+    parser.add_argument("--max-workers", type=int, default=DEFAULT_RENDER_WORKERS, help="Maximum number of worker processes for figure extraction and rendering.")
+    parser.add_argument("--upload-workers", type=int, default=DEFAULT_UPLOAD_WORKERS, help="Maximum number of concurrent layout-analysis uploads when processing a directory.")
+    parser.add_argument("--layout-backend", choices=LAYOUT_BACKENDS, default=DEFAULT_LAYOUT_BACKEND, help="Where layout analysis runs: the remote API, locally, or locally with the API as fallback.")
+    parser.add_argument("--output-profile", choices=sorted(OUTPUT_PROFILES), default=DEFAULT_OUTPUT_PROFILE, help="Resolution limits and image formats of the written figures (see figure_encoding.py).")
+    parser.add_argument("--index-dir", help="Diagram retrieval index to add each book to. Defaults to <output-dir>/diagram_index, or DIAGRAM_INDEX_DIR if set.")
+    parser.add_argument("--dedup-dir", help="Near-duplicate index each book is matched against. Defaults to <output-dir>/diagram_dedup, or DIAGRAM_DEDUP_DIR if set.")
+    parser.add_argument("--write-json", action="store_true", help="Also write a <book>_figure_list.json per book.")
+    parser.add_argument("--no-resume", dest="resume", action="store_false", help="Redo every stage even if the run manifest records it as complete.")
+    parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"], help="Minimum level of log messages to show.")
+    parser.add_argument("--metrics-json", help=f"Where to write the run's timings and counters as JSON. Defaults to <output-dir>/{METRICS_FILENAME}.")
+    parser.add_argument("--metrics-prom", help="Also write the run's metrics as a Prometheus textfile to this path.")
+    args = parser.parse_args()
+    configure_logging(args.log_level)
+
+    input_path = args.input_path
+    OUTPUT_DIR = args.output_dir
 
     ## Directory 
     if os.path.isdir(input_path):
-        for filename in os.listdir(input_path):
-            if filename.endswith(".pdf"):
-                pdf_filepath = os.path.join(input_path, filename)
-                print(f"Processing {pdf_filepath}...")
-                try: 
-                    process_full_pdf(pdf_filepath, OUTPUT_DIR=OUTPUT_DIR)
-                except Exception as e:
-                    print(f"Error processing {pdf_filepath}. Error: {e}")
+        run_ingestion(list_pdfs(input_path), OUTPUT_DIR=OUTPUT_DIR, upload_workers=args.upload_workers, cpu_workers=args.max_workers, index_dir=args.index_dir, write_json=args.write_json, resume=args.resume, layout_backend=args.layout_backend, dedup_dir=args.dedup_dir, profile=args.output_profile)
 
     ## Single file
     elif os.path.isfile(input_path) and input_path.endswith(".pdf"):
-        process_full_pdf(input_path, OUTPUT_DIR=OUTPUT_DIR)
+        process_full_pdf(input_path, OUTPUT_DIR=OUTPUT_DIR, max_workers=args.max_workers, index_dir=args.index_dir, write_json=args.write_json, resume=args.resume, layout_backend=args.layout_backend, profile=args.output_profile, dedup_dir=args.dedup_dir)
 
     ## Invalid 
     else:
-        print("The provided path is not a PDF file or a directory containing PDF files.")
+        logger.error("The provided path is not a PDF file or a directory containing PDF files.")
         sys.exit(1)
 
-
-############################################################
-# from concurrent.futures import ThreadPoolExecutor, as_completed
-# import os
-# import sys
-# import argparse 
-
-# DEFAULT_MAX_WORKERS = 2
-
-# def process_pdf_wrapper(args):
-#     """
-#     Wrapper function to pass multiple arguments to process_full_pdf function.
-#     """
-#     pdf_filepath, OUTPUT_DIR = args
-#     try:
-#         process_full_pdf(pdf_filepath, OUTPUT_DIR=OUTPUT_DIR)
-#         print(f"Successfully processed {pdf_filepath}")
-#     except Exception as e:
-#         print(f"Error processing {pdf_filepath}. Error: {e}")
-
-# if __name__ == "__main__":
-#     # Parse command line arguments
-#     parser = argparse.ArgumentParser(description="Process PDF files to extract images.")
-#     parser.add_argument("input_path", help="Path to the PDF file or directory containing PDF files.")
-#     parser.add_argument("--output-dir", default="output_figures", help="Output directory for the extracted images.")
-#     parser.add_argument("--max-workers", type=int, default=8, help="Maximum number of worker threads.")
-#     args = parser.parse_args()
-
-#     input_path = args.input_path
-#     OUTPUT_DIR = args.output_dir if args.output_dir else DEFAULT_OUTPUT_DIR
-#     max_workers = args.max_workers if args.max_workers else DEFAULT_MAX_WORKERS
-#     pdf_filepaths = []
-
-#     ## Directory
-#     if os.path.isdir(input_path):
-#         for filename in os.listdir(input_path):
-#             if filename.endswith(".pdf"):
-#                 pdf_filepath = os.path.join(input_path, filename)
-#                 pdf_filepaths.append((pdf_filepath, OUTPUT_DIR))
-
-#     ## Single file
-#     elif os.path.isfile(input_path) and input_path.endswith(".pdf"):
-#         pdf_filepaths.append((input_path, OUTPUT_DIR))
-
-#     ## Invalid
-#     else:
-#         print("The provided path is not a PDF file or a directory containing PDF files.")
-#         sys.exit(1)
-
-#     # Process PDFs in parallel using ThreadPoolExecutor
-#     with ThreadPoolExecutor(max_workers=min(max_workers, len(pdf_filepaths))) as executor:
-#         future_to_pdf = {executor.submit(process_pdf_wrapper, pdf_filepath): pdf_filepath for pdf_filepath in pdf_filepaths}
-#         for future in as_completed(future_to_pdf):
-#             pdf = future_to_pdf[future]
-#             try:
-#                 future.result()
-#             except Exception as exc:
-#                 print(f"{pdf[0]} generated an exception: {exc}")
+    metrics_json = args.metrics_json or os.path.join(OUTPUT_DIR, METRICS_FILENAME)
+    counters = METRICS.summary()["counters"]
+    if counters.get("documents_skipped") and not counters.get("documents_processed") and not counters.get("documents_failed"):
+        # A resumed run with nothing left to do; its all-zero metrics would hide the last run's
+        logger.info("All %d documents were already processed; keeping the metrics of the last run in '%s'.", counters["documents_skipped"], metrics_json)
+    else:
+        os.makedirs(OUTPUT_DIR, exist_ok=True)
+        METRICS.write_json(metrics_json)
+        if args.metrics_prom:
+            METRICS.write_prometheus(args.metrics_prom)
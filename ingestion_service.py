@@ -0,0 +1,604 @@
+"""
+HTTP ingestion service: upload PDFs, get a job id back at once, and collect the figures later.
+
+Uploads are saved under <output-dir>/uploads/<job id>/, until the job is done or failed, and queued
+for a bounded pool of worker threads, each running process_full_pdf on one job at a time. When the
+queue is full new uploads are refused with 503 and a Retry-After header. Jobs are recorded in
+<output-dir>/jobs.sqlite, so after a restart the jobs that were queued or running are queued again;
+finished stages are skipped through the run manifest. On SIGTERM or SIGINT the service stops
+accepting uploads, lets the running jobs finish and leaves the queued ones for the next start.
+
+Endpoints:
+- POST /jobs  upload a PDF, as the raw body (Content-Type: application/pdf, file name in ?filename=)
+  or as the "document" field of a multipart form. Returns 202 with the job.
+- GET /jobs  recent jobs, optionally ?status=queued|running|done|failed and ?limit=
+- GET /jobs/<id>  the job's status
+- GET /jobs/<id>/results  the job's figures from the figure catalog, once done
+- GET /files/<path>  a file of the output directory, e.g. a figure's image_path
+- GET /health, GET /metrics  queue state, and the run's metrics as a Prometheus text
+
+A book is named after the uploaded file, so uploading a file of the same name again replaces it.
+The diagram index and the near-duplicate index are kept in <output-dir>/diagram_index and
+<output-dir>/diagram_dedup unless other directories are given, so services with different output
+directories do not share them.
+For local testing, point UPSTAGE_LAYOUT_URL at benchmarks/mock_layout_server.py or use
+--layout-backend local.
+
+Usage:
+python start.py --port 8000 --workers 2 --queue-size 16
+curl -X POST --data-binary @sample_data/dl15.pdf -H "Content-Type: application/pdf" "localhost:8000/jobs?filename=dl15.pdf"
+curl localhost:8000/jobs/<job id>/results
+"""
+import os
+import re
+import json
+import time
+import uuid
+import queue
+import shutil
+import signal
+import sqlite3
+import argparse
+import mimetypes
+import threading
+from email import policy
+from email.parser import BytesParser
+from urllib.parse import urlsplit, parse_qs, unquote
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from image_extraction_pipeline import process_full_pdf, DEFAULT_OUTPUT_DIR, DEFAULT_RENDER_WORKERS, LAYOUT_BACKENDS, DEFAULT_LAYOUT_BACKEND
+from figure_encoding import OUTPUT_PROFILES, DEFAULT_OUTPUT_PROFILE
+from figure_catalog import FigureCatalog, catalog_path_for
+from raster_cache import get_raster_cache
+from diagram_index import INDEX_DIRNAME, DEFAULT_INDEX_DIR
+from diagram_dedup import DEDUP_DIRNAME, DEFAULT_DEDUP_DIR
+from instrumentation import METRICS, increment, get_logger, configure_logging
+
+logger = get_logger("service")
+
+#################### CONFIG ####################
+
+DEFAULT_PORT = int(os.getenv("PORT", 8000))
+DEFAULT_INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", 1))
+DEFAULT_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", 16))
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", 200 * 1024 ** 2))
+RETRY_AFTER_SECONDS = 30
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+
+JOBS_FILENAME = "jobs.sqlite"
+UPLOADS_DIRNAME = "uploads"
+JOB_STATUSES = ("queued", "running", "done", "failed")
+BUSY_TIMEOUT_SECONDS = 30
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    book TEXT NOT NULL,
+    pdf_path TEXT NOT NULL,
+    status TEXT NOT NULL,
+    error TEXT,
+    num_figures INTEGER,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_by_status ON jobs (status, created_at);
+"""
+JOB_COLUMNS = ["id", "book", "pdf_path", "status", "error", "num_figures", "created_at", "started_at", "finished_at"]
+
+_UNSAFE_FILENAME_CHARS = re.compile(r"[^\w .()-]")
+_JOB_PATH = re.compile(r"^/jobs/(?P<job_id>[0-9a-f]{32})(?P<results>/results)?$")
+
+
+class QueueFull(Exception):
+    """
+    Raised when a job is submitted while the queue is at capacity.
+    """
+
+
+def safe_pdf_filename(filename):
+    """
+    The base name of an uploaded file, stripped of path parts and unusual characters, ending in .pdf
+    """
+    stem = os.path.splitext(os.path.basename((filename or "").replace("\\", "/")))[0]
+    stem = _UNSAFE_FILENAME_CHARS.sub("_", stem).strip(" .") or "document"
+    return f"{stem}.pdf"
+
+
+class MultipartReader:
+    """
+    Reads a multipart/form-data body part by part from a stream of chunks, without holding it in memory.
+    """
+    def __init__(self, chunks, boundary):
+        self._chunks = iter(chunks)
+        # The body may start right at the first delimiter, so a leading CRLF makes it look like the others
+        self._buf = b"\r\n"
+        self._delimiter = b"\r\n--" + boundary.encode("latin-1")
+
+    def _fill(self):
+        chunk = next(self._chunks, b"")
+        self._buf += chunk
+        return bool(chunk)
+
+    def _read_until(self, marker):
+        """
+        Yield the bytes up to marker and consume the marker. Raises ValueError if the body ends first.
+        """
+        while True:
+            i = self._buf.find(marker)
+            if i >= 0:
+                if i:
+                    yield self._buf[:i]
+                self._buf = self._buf[i + len(marker):]
+                return
+            # Keep a tail that may hold the start of the marker
+            keep = len(marker) - 1
+            if len(self._buf) > keep:
+                yield self._buf[:-keep]
+                self._buf = self._buf[-keep:]
+            if not self._fill():
+                raise ValueError("The multipart upload ended early")
+
+    def parts(self):
+        """
+        Yield (headers, data) for each part, data being an iterator of byte chunks. Data not read is skipped
+        when the next part is requested.
+        """
+        for _ in self._read_until(self._delimiter):
+            pass
+        while True:
+            while len(self._buf) < 2 and self._fill():
+                pass
+            if self._buf.startswith(b"--"):
+                return
+            # The rest of the delimiter line, then the headers up to the blank line
+            for _ in self._read_until(b"\r\n"):
+                pass
+            self._buf = b"\r\n" + self._buf
+            header_bytes = b"".join(self._read_until(b"\r\n\r\n"))[2:]
+            headers = BytesParser(policy=policy.HTTP).parsebytes(header_bytes + b"\r\n\r\n", headersonly=True)
+            data = self._read_until(self._delimiter)
+            yield headers, data
+            for _ in data:
+                pass
+
+
+class JobStore:
+    """
+    Jobs and their status in SQLite, shared by the request and worker threads.
+    """
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT_SECONDS, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def add(self, job_id, book, pdf_path):
+        with self._lock, self.conn:
+            self.conn.execute("INSERT INTO jobs (id, book, pdf_path, status, created_at) VALUES (?, ?, ?, 'queued', ?)", (job_id, book, pdf_path, time.time()))
+
+    def update(self, job_id, **fields):
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock, self.conn:
+            self.conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+    def remove(self, job_id):
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def get(self, job_id):
+        with self._lock:
+            row = self.conn.execute(f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(zip(JOB_COLUMNS, row)) if row else None
+
+    def list(self, status=None, limit=100):
+        query = f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs"
+        params = []
+        if status:
+            query += " WHERE status = ?"
+            params.append(status)
+        query += " ORDER BY created_at DESC LIMIT ?"
+        with self._lock:
+            rows = self.conn.execute(query, params + [limit]).fetchall()
+        return [dict(zip(JOB_COLUMNS, row)) for row in rows]
+
+    def unfinished(self):
+        """
+        Jobs left queued or running by an earlier process, oldest first
+        """
+        with self._lock:
+            rows = self.conn.execute(f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs WHERE status IN ('queued', 'running') ORDER BY created_at").fetchall()
+        return [dict(zip(JOB_COLUMNS, row)) for row in rows]
+
+
+class IngestionService:
+    """
+    The job queue and its worker threads.
+
+    Example usage:
+    service = IngestionService("output_figures", num_workers=2).start()
+    job = service.submit_file("sample_data/dl15.pdf")
+    ...
+    service.stop()
+    """
+    def __init__(self, output_dir=DEFAULT_OUTPUT_DIR, num_workers=DEFAULT_INGEST_WORKERS, queue_size=DEFAULT_QUEUE_SIZE, render_workers=DEFAULT_RENDER_WORKERS,
+                 index_dir=None, layout_backend=DEFAULT_LAYOUT_BACKEND, profile=DEFAULT_OUTPUT_PROFILE, dedup_dir=None):
+        self.output_dir = output_dir
+        self.num_workers = num_workers
+        # The render (and local layout) processes are shared by the jobs running at once, so the CPUs are not oversubscribed
+        self.render_workers = render_workers
+        self.job_render_workers = max(1, render_workers // max(1, num_workers))
+        # Kept with the output unless given, so services with different output directories stay apart
+        self.index_dir = index_dir or os.path.join(output_dir, INDEX_DIRNAME)
+        self.dedup_dir = dedup_dir or os.path.join(output_dir, DEDUP_DIRNAME)
+        self.layout_backend = layout_backend
+        self.profile = profile
+        self.jobs = JobStore(os.path.join(output_dir, JOBS_FILENAME))
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stopping = threading.Event()
+        self.num_running = 0
+        self._running_lock = threading.Lock()
+        self._book_locks = {}
+        self._workers = []
+
+    @property
+    def uploads_dir(self):
+        return os.path.join(self.output_dir, UPLOADS_DIRNAME)
+
+    def start(self):
+        for i in range(self.num_workers):
+            worker = threading.Thread(target=self._work, name=f"ingest-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+        # Jobs an earlier process did not finish are queued again, in the background since there may be more than fit
+        unfinished = self.jobs.unfinished()
+        if unfinished:
+            logger.info("Resuming %d unfinished jobs.", len(unfinished))
+            threading.Thread(target=self._requeue, args=(unfinished,), daemon=True).start()
+        return self
+
+    def _requeue(self, unfinished):
+        for job in unfinished:
+            self.jobs.update(job["id"], status="queued", started_at=None)
+            while not self.stopping.is_set():
+                try:
+                    self.queue.put(job["id"], timeout=1)
+                    break
+                except queue.Full:
+                    continue
+
+    def stop(self, timeout=None):
+        """
+        Stop taking jobs from the queue and wait for the running ones. Queued jobs stay queued.
+        """
+        self.stopping.set()
+        for worker in self._workers:
+            worker.join(timeout)
+        self.jobs.close()
+
+    ######## Submitting ########
+
+    def new_job(self):
+        """
+        A job id and the directory its upload is written to
+        """
+        job_id = uuid.uuid4().hex
+        upload_dir = os.path.join(self.uploads_dir, job_id)
+        os.makedirs(upload_dir, exist_ok=True)
+        return job_id, upload_dir
+
+    def enqueue(self, job_id, pdf_path):
+        """
+        Queue an uploaded PDF. Raises QueueFull, after removing the upload, if the queue is at capacity.
+        """
+        book = os.path.splitext(os.path.basename(pdf_path))[0]
+        self.jobs.add(job_id, book, pdf_path)
+        try:
+            if self.stopping.is_set():
+                raise queue.Full
+            self.queue.put_nowait(job_id)
+        except queue.Full:
+            self.jobs.remove(job_id)
+            shutil.rmtree(os.path.dirname(pdf_path), ignore_errors=True)
+            increment("jobs_rejected")
+            raise QueueFull(f"The queue holds {self.queue.maxsize} jobs already")
+        increment("jobs_accepted")
+        logger.info("Queued job %s for '%s'.", job_id, book)
+        return self.jobs.get(job_id)
+
+    def submit_file(self, pdf_filepath):
+        """
+        Queue a copy of a PDF on disk. Returns the job.
+        """
+        job_id, upload_dir = self.new_job()
+        pdf_path = shutil.copy(pdf_filepath, os.path.join(upload_dir, safe_pdf_filename(pdf_filepath)))
+        return self.enqueue(job_id, pdf_path)
+
+    def is_full(self):
+        return self.queue.full()
+
+    ######## Processing ########
+
+    def _book_lock(self, book):
+        # Jobs for the same book write the same output directory, so they run one at a time
+        with self._running_lock:
+            return self._book_locks.setdefault(book, threading.Lock())
+
+    def _work(self):
+        while not self.stopping.is_set():
+            try:
+                job_id = self.queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if self.stopping.is_set():
+                # Taken as the service began to stop; the job store still has it queued for the next start
+                return
+            job = self.jobs.get(job_id)
+            if job is None or job["status"] != "queued":
+                continue
+            with self._running_lock:
+                self.num_running += 1
+            try:
+                self._run(job)
+            finally:
+                with self._running_lock:
+                    self.num_running -= 1
+
+    def _run(self, job):
+        with self._book_lock(job["book"]):
+            self.jobs.update(job["id"], status="running", started_at=time.time())
+            logger.info("Running job %s for '%s'.", job["id"], job["book"])
+            try:
+                process_full_pdf(job["pdf_path"], OUTPUT_DIR=self.output_dir, max_workers=self.job_render_workers, index_dir=self.index_dir, layout_backend=self.layout_backend, profile=self.profile, dedup_dir=self.dedup_dir)
+                with FigureCatalog(catalog_path_for(self.output_dir)) as catalog:
+                    num_figures = catalog.count(books=[job["book"]])
+            except Exception as e:
+                logger.error("Job %s for '%s' failed: %s", job["id"], job["book"], e)
+                self.jobs.update(job["id"], status="failed", error=str(e), finished_at=time.time())
+                increment("jobs_failed")
+                self._remove_upload(job)
+                return
+            finally:
+                # Rasters some step of the job cached are of no use to the next book
+                get_raster_cache().clear()
+        self.jobs.update(job["id"], status="done", num_figures=num_figures, finished_at=time.time())
+        self._remove_upload(job)
+        increment("jobs_done")
+        logger.info("Finished job %s for '%s': %d figures.", job["id"], job["book"], num_figures)
+
+    def _remove_upload(self, job):
+        # Finished jobs are not run again, so their upload is no longer needed
+        shutil.rmtree(os.path.dirname(job["pdf_path"]), ignore_errors=True)
+
+    ######## Reading ########
+
+    def results(self, job):
+        with FigureCatalog(catalog_path_for(self.output_dir)) as catalog:
+            return catalog.figures(books=[job["book"]])
+
+    def health(self):
+        return {
+            "status": "stopping" if self.stopping.is_set() else "ok",
+            "queued": self.queue.qsize(),
+            "queue_size": self.queue.maxsize,
+            "running": self.num_running,
+            "workers": self.num_workers,
+        }
+
+
+class IngestionHandler(BaseHTTPRequestHandler):
+    server_version = "DiagrammaticIngest/1.0"
+
+    @property
+    def service(self):
+        return self.server.service
+
+    def log_message(self, format, *args):
+        logger.debug("%s %s", self.address_string(), format % args)
+
+    def _send(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status, body, headers=None):
+        self._send(status, json.dumps(body).encode("utf-8"), "application/json", headers)
+
+    def _error(self, status, message, headers=None):
+        self._send_json(status, {"error": message}, headers)
+
+    def _job_urls(self, job):
+        # The upload's path on the server is not part of the API
+        job = {name: value for name, value in job.items() if name != "pdf_path"}
+        return {**job, "status_url": f"/jobs/{job['id']}", "results_url": f"/jobs/{job['id']}/results"}
+
+    ######## GET ########
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        path, params = unquote(url.path), parse_qs(url.query)
+        if path == "/health":
+            return self._send_json(200, self.service.health())
+        if path == "/metrics":
+            return self._send(200, METRICS.prometheus_text().encode("utf-8"), "text/plain; version=0.0.4")
+        if path == "/jobs":
+            status = params.get("status", [None])[0]
+            if status is not None and status not in JOB_STATUSES:
+                return self._error(400, f"Unknown status {status!r}, expected one of {list(JOB_STATUSES)}")
+            try:
+                limit = int(params.get("limit", [100])[0])
+            except ValueError:
+                return self._error(400, "limit must be an integer")
+            return self._send_json(200, {"jobs": [self._job_urls(job) for job in self.service.jobs.list(status=status, limit=limit)]})
+        if path.startswith("/files/"):
+            return self._send_file(path[len("/files/"):])
+
+        match = _JOB_PATH.match(path)
+        job = self.service.jobs.get(match.group("job_id")) if match else None
+        if job is None:
+            return self._error(404, f"Not found: {path}")
+        if not match.group("results"):
+            return self._send_json(200, self._job_urls(job))
+        if job["status"] != "done":
+            return self._error(409, f"Job {job['id']} is {job['status']}", headers={"Retry-After": str(RETRY_AFTER_SECONDS)} if job["status"] != "failed" else None)
+        return self._send_json(200, {"job": self._job_urls(job), "figures": self.service.results(job)})
+
+    def _send_file(self, relative_path):
+        # Only files inside the output directory, and not the uploads, indexes or databases. The checks run on
+        # the resolved path, so "./" or "../" parts cannot get around them
+        root = os.path.realpath(self.service.output_dir)
+        file_path = os.path.realpath(os.path.join(root, relative_path))
+        private_dirs = [os.path.realpath(path) for path in (self.service.uploads_dir, self.service.index_dir, self.service.dedup_dir)]
+        if (os.path.commonpath([root, file_path]) != root
+                or any(os.path.commonpath([private_dir, file_path]) == private_dir for private_dir in private_dirs)
+                or file_path.endswith((".sqlite", ".sqlite-wal", ".sqlite-shm"))):
+            return self._error(404, f"Not found: {relative_path}")
+        if not os.path.isfile(file_path):
+            return self._error(404, f"Not found: {relative_path}")
+        with open(file_path, "rb") as f:
+            body = f.read()
+        self._send(200, body, mimetypes.guess_type(file_path)[0] or "application/octet-stream")
+
+    ######## POST ########
+
+    def do_POST(self):
+        if urlsplit(self.path).path != "/jobs":
+            return self._error(404, f"Not found: {self.path}")
+        if self.service.stopping.is_set():
+            return self._error(503, "The service is shutting down", headers={"Retry-After": str(RETRY_AFTER_SECONDS)})
+        if self.service.is_full():
+            increment("jobs_rejected")
+            return self._error(503, "The job queue is full", headers={"Retry-After": str(RETRY_AFTER_SECONDS), "Connection": "close"})
+        try:
+            content_length = int(self.headers.get("Content-Length", ""))
+        except ValueError:
+            return self._error(411, "Content-Length is required")
+        if content_length > MAX_UPLOAD_BYTES:
+            return self._error(413, f"Uploads are limited to {MAX_UPLOAD_BYTES} bytes", headers={"Connection": "close"})
+
+        job_id, upload_dir = self.service.new_job()
+        try:
+            pdf_path = self._save_upload(upload_dir, content_length)
+        except ValueError as e:
+            shutil.rmtree(upload_dir, ignore_errors=True)
+            return self._error(400, str(e))
+        try:
+            job = self.service.enqueue(job_id, pdf_path)
+        except QueueFull as e:
+            return self._error(503, str(e), headers={"Retry-After": str(RETRY_AFTER_SECONDS)})
+        self._send_json(202, self._job_urls(job), headers={"Location": f"/jobs/{job_id}"})
+
+    def _save_upload(self, upload_dir, content_length):
+        """
+        Write the uploaded PDF into upload_dir. Raises ValueError if the request holds no PDF.
+        """
+        content_type = self.headers.get("Content-Type", "")
+        body = self._read_body(content_length)
+        if content_type.startswith("multipart/form-data"):
+            boundary = BytesParser(policy=policy.HTTP).parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode()).get_boundary()
+            if not boundary:
+                raise ValueError("The multipart upload has no boundary")
+            parts = MultipartReader(body, boundary).parts()
+            document = next(((headers, data) for headers, data in parts if headers.get_param("name", header="content-disposition") == "document"), None)
+            if document is None:
+                raise ValueError("Expected a multipart upload with a 'document' field")
+            headers, chunks = document
+            filename = headers.get_filename()
+        else:
+            filename = parse_qs(urlsplit(self.path).query).get("filename", [None])[0]
+            chunks = body
+
+        pdf_path = os.path.join(upload_dir, safe_pdf_filename(filename))
+        with open(pdf_path, "wb") as f:
+            head = b""
+            for chunk in chunks:
+                # Chunks can be shorter than the signature at part boundaries
+                if len(head) < 5:
+                    head += chunk[:5 - len(head)]
+                    if not b"%PDF-".startswith(head):
+                        raise ValueError("The upload is not a PDF")
+                f.write(chunk)
+        if not head:
+            raise ValueError("The upload is empty")
+        if head != b"%PDF-":
+            raise ValueError("The upload is not a PDF")
+        # Read the rest of the request, e.g. the parts after the document
+        for _ in body:
+            pass
+        return pdf_path
+
+    def _read_body(self, content_length):
+        remaining = content_length
+        while remaining > 0:
+            chunk = self.rfile.read(min(UPLOAD_CHUNK_BYTES, remaining))
+            if not chunk:
+                raise ValueError("The upload ended early")
+            remaining -= len(chunk)
+            yield chunk
+
+
+class IngestionServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, service, host="0.0.0.0", port=DEFAULT_PORT):
+        super().__init__((host, port), IngestionHandler)
+        self.service = service
+
+
+def serve(service, host="0.0.0.0", port=DEFAULT_PORT):
+    """
+    Run the service until SIGTERM or SIGINT, then shut down gracefully
+    """
+    server = IngestionServer(service, host=host, port=port)
+
+    def shut_down(signum, frame):
+        logger.info("Received signal %d, shutting down after the running jobs.", signum)
+        service.stopping.set()
+        # shutdown() waits for serve_forever, which runs in this thread
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, shut_down)
+    signal.signal(signal.SIGINT, shut_down)
+    service.start()
+    logger.info("Accepting PDFs at http://%s:%d/jobs with %d workers.", host, server.server_address[1], service.num_workers)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        service.stop()
+        logger.info("Stopped; %d jobs remain queued for the next start.", service.queue.qsize())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the figure extraction pipeline as an HTTP job queue.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="Port to listen on. Defaults to $PORT or 8000.")
+    parser.add_argument("--output-dir", default=DEFAULT_OUTPUT_DIR, help="Output directory for the extracted images, catalog and jobs.")
+    parser.add_argument("--workers", type=int, default=DEFAULT_INGEST_WORKERS, help="Jobs processed at the same time.")
+    parser.add_argument("--queue-size", type=int, default=DEFAULT_QUEUE_SIZE, help="Jobs waiting at most; further uploads get 503.")
+    parser.add_argument("--render-workers", type=int, default=DEFAULT_RENDER_WORKERS, help="Worker processes for rendering figures, divided among the jobs running at once.")
+    parser.add_argument("--index-dir", default=DEFAULT_INDEX_DIR, help="Diagram retrieval index to add each book to. Defaults to <output-dir>/diagram_index.")
+    parser.add_argument("--dedup-dir", default=DEFAULT_DEDUP_DIR, help="Near-duplicate index shared by the books. Defaults to <output-dir>/diagram_dedup.")
+    parser.add_argument("--layout-backend", choices=LAYOUT_BACKENDS, default=DEFAULT_LAYOUT_BACKEND, help="Where layout analysis runs.")
+    parser.add_argument("--output-profile", choices=sorted(OUTPUT_PROFILES), default=DEFAULT_OUTPUT_PROFILE, help="Resolution limits and image formats of the written figures.")
+    parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"], help="Minimum level of log messages to show.")
+    args = parser.parse_args(argv)
+    configure_logging(args.log_level)
+
+    service = IngestionService(args.output_dir, num_workers=args.workers, queue_size=args.queue_size, render_workers=args.render_workers,
+                               index_dir=args.index_dir, layout_backend=args.layout_backend, profile=args.output_profile, dedup_dir=args.dedup_dir)
+    serve(service, host=args.host, port=args.port)
+
+
+############################################################
+if __name__ == "__main__":
+    main()
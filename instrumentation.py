@@ -0,0 +1,219 @@
+"""
+Lightweight instrumentation: timing spans, counters and leveled logging.
+
+Spans and counters are accumulated in a process-wide Metrics object (METRICS). Worker processes
+collect their own and hand them back with drain(); the parent merge()s them, so a run's summary
+covers all processes. At the end of a run the summary can be written as JSON or as a Prometheus
+textfile (for node_exporter's textfile collector).
+
+Example usage:
+@instrumented("process_figures")
+def process_figures(...): ...
+
+with span("render_page"):
+    ...
+increment("figures_found", len(figure_list.figures))
+METRICS.write_json("output_figures/metrics.json")
+METRICS.write_prometheus("/var/lib/node_exporter/diagrammatic.prom")
+"""
+import os
+import re
+import json
+import time
+import logging
+import functools
+import threading
+import multiprocessing
+from contextlib import contextmanager
+
+from run_manifest import atomic_output
+
+#################### CONFIG ####################
+
+LOGGER_NAME = "diagrammatic"
+LOG_FORMAT = "%(asctime)s %(levelname)-7s %(name)s: %(message)s"
+PROMETHEUS_PREFIX = "diagrammatic"
+# Imported once by the fork server that starts worker processes, so a new worker does not import them again
+WORKER_PRELOAD_MODULES = ["image_extraction_pipeline"]
+
+
+def get_logger(module_name):
+    """
+    The logger of a module, below the package-wide "diagrammatic" logger
+    """
+    return logging.getLogger(f"{LOGGER_NAME}.{module_name}")
+
+
+def configure_logging(level="INFO"):
+    logging.basicConfig(level=level if isinstance(level, int) else getattr(logging, str(level).upper()), format=LOG_FORMAT)
+
+
+def _metric_name(name):
+    return re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+class Metrics:
+    """
+    Thread-safe counters and span timings of one process.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started_at = time.time()
+            self.counters = {}
+            self.spans = {}  # name -> [count, total seconds, max seconds]
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, seconds, count=1, max_seconds=None):
+        with self._lock:
+            stats = self.spans.setdefault(name, [0, 0.0, 0.0])
+            stats[0] += count
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds if max_seconds is None else max_seconds)
+
+    @contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    ######## Collecting across processes ########
+
+    def drain(self):
+        """
+        Returns the counters and spans collected since the last drain, and clears them.
+        """
+        with self._lock:
+            snapshot = {"counters": self.counters, "spans": self.spans}
+            self.counters, self.spans = {}, {}
+        return snapshot
+
+    def merge(self, snapshot):
+        for name, value in snapshot["counters"].items():
+            self.increment(name, value)
+        for name, (count, total, max_seconds) in snapshot["spans"].items():
+            self.observe(name, total, count=count, max_seconds=max_seconds)
+
+    ######## Export ########
+
+    def summary(self):
+        with self._lock:
+            return {
+                "started_at": self.started_at,
+                "duration_seconds": time.time() - self.started_at,
+                "counters": dict(sorted(self.counters.items())),
+                "spans": {
+                    name: {"count": count, "total_seconds": total, "mean_seconds": total / count if count else 0.0, "max_seconds": max_seconds}
+                    for name, (count, total, max_seconds) in sorted(self.spans.items())
+                },
+            }
+
+    def write_json(self, path):
+        with atomic_output(path) as tmp_path:
+            with open(tmp_path, "w") as f:
+                json.dump(self.summary(), f, indent=2)
+
+    def prometheus_text(self):
+        summary = self.summary()
+        lines = [
+            f"# TYPE {PROMETHEUS_PREFIX}_run_duration_seconds gauge",
+            f"{PROMETHEUS_PREFIX}_run_duration_seconds {summary['duration_seconds']:.6f}",
+        ]
+        for name, value in summary["counters"].items():
+            metric = f"{PROMETHEUS_PREFIX}_{_metric_name(name)}_total"
+            lines += [f"# TYPE {metric} counter", f"{metric} {value}"]
+        if summary["spans"]:
+            metric = f"{PROMETHEUS_PREFIX}_span_seconds"
+            lines.append(f"# TYPE {metric} summary")
+            for name, stats in summary["spans"].items():
+                lines.append(f'{metric}_sum{{span="{name}"}} {stats["total_seconds"]:.6f}')
+                lines.append(f'{metric}_count{{span="{name}"}} {stats["count"]}')
+            lines.append(f"# TYPE {metric}_max gauge")
+            for name, stats in summary["spans"].items():
+                lines.append(f'{metric}_max{{span="{name}"}} {stats["max_seconds"]:.6f}')
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        # The textfile collector reads every *.prom file at any time, so write under another
+        # extension and move the finished file into place
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.prometheus_text())
+        os.replace(tmp_path, path)
+
+
+METRICS = Metrics()
+
+def span(name):
+    return METRICS.span(name)
+
+def instrumented(name):
+    """
+    Decorator recording every call of a function as a span
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with METRICS.span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def timed_iter(name, iterable):
+    """
+    Yield from iterable, recording the time spent producing its items, not consuming them, as one span.
+    For generators whose work is interleaved with their consumer's.
+    """
+    iterator = iter(iterable)
+    seconds = 0.0
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                seconds += time.perf_counter() - start
+            yield item
+    finally:
+        METRICS.observe(name, seconds)
+
+def increment(name, value=1):
+    METRICS.increment(name, value)
+
+def worker_context():
+    """
+    The multiprocessing context of worker process pools.
+
+    Workers are started by a fork server instead of by forking the calling process: another thread
+    of the caller (a pipeline stage, an HTTP handler, an encoder pool) may hold a lock, of METRICS,
+    a cache or an HTTP client, at the moment of the fork, and the child would wait on it forever.
+    """
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload(WORKER_PRELOAD_MODULES)
+    return context
+
+
+def worker_log_level():
+    """
+    The log level to pass to init_worker, as configured in this process
+    """
+    return logging.getLogger(LOGGER_NAME).getEffectiveLevel()
+
+
+def init_worker(log_level=logging.WARNING):
+    """
+    Process pool initializer: workers do not inherit the parent's logging setup, and their metrics
+    start from zero since the parent merges what they drain()
+    """
+    configure_logging(log_level)
+    METRICS.reset()
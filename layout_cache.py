@@ -0,0 +1,187 @@
+import os
+import json
+import hashlib
+import tempfile
+import threading
+
+#################### CONFIG ####################
+
+DEFAULT_CACHE_DIR = os.getenv("LAYOUT_CACHE_DIR", ".layout_cache")
+DEFAULT_MAX_CACHE_BYTES = int(os.getenv("LAYOUT_CACHE_MAX_BYTES", 2 * 1024 ** 3))  # 2 GB
+DEFAULT_OFFLINE = os.getenv("LAYOUT_CACHE_OFFLINE", "0").lower() in ("1", "true", "yes")
+
+HASH_BLOCK_SIZE = 1024 * 1024
+EVICT_TO_FRACTION = 0.9  # Eviction frees room below max_bytes, so a full cache is not walked on every put
+
+
+class LayoutCacheMiss(KeyError):
+    """
+    Raised in offline mode when a response is not in the cache.
+    """
+
+
+def hash_file(filepath):
+    """
+    Returns the sha256 hex digest of the file's contents.
+    """
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def hash_bytes(data):
+    """
+    Returns the sha256 hex digest of an in-memory document.
+    """
+    return hashlib.sha256(data).hexdigest()
+
+
+class LayoutCache:
+    """
+    On-disk cache of layout-analysis responses keyed by PDF content hash, endpoint and API version.
+
+    Entries are JSON files in cache_dir. Every hit touches the file's mtime, and once the cache
+    grows past max_bytes the least recently used entries are deleted first, down to
+    EVICT_TO_FRACTION of it. The cache's size is
+    read from disk once and then tracked in memory; the directory is only walked again to evict,
+    which also counts entries other processes have written since.
+    """
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_CACHE_BYTES, offline=DEFAULT_OFFLINE):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._total_bytes = None  # Read from disk on the first put
+
+    def make_key(self, pdf_filepath, endpoint, api_version, content_hash=None):
+        content_hash = content_hash or hash_file(pdf_filepath)
+        return hashlib.sha256(f"{content_hash}|{endpoint}|{api_version}".encode("utf-8")).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def get_path(self, key):
+        """
+        Returns the path of the cached response file for key, or None on a miss.
+
+        The file can be read incrementally (see element_stream.py) instead of decoded whole.
+        """
+        entry_path = self._entry_path(key)
+        try:
+            os.utime(entry_path)  # Mark as most recently used
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return entry_path
+
+    def get(self, key):
+        """
+        Returns the cached response for key, or None on a miss.
+        """
+        entry_path = self._entry_path(key)
+        try:
+            with open(entry_path, "r") as f:
+                response_json = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            with self._lock:
+                self.misses += 1
+            return None
+        os.utime(entry_path)  # Mark as most recently used
+        with self._lock:
+            self.hits += 1
+        return response_json
+
+    def put(self, key, response_json):
+        entry_path = self._entry_path(key)
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        # Write to a temp file first so readers never see a half-written entry
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(entry_path), suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(response_json, f)
+        size = os.path.getsize(tmp_path)
+        with self._lock:
+            if self._total_bytes is None:
+                self._total_bytes = self.size_bytes()
+            try:
+                self._total_bytes -= os.path.getsize(entry_path)
+            except FileNotFoundError:
+                pass
+            os.replace(tmp_path, entry_path)
+            self._total_bytes += size
+            over_budget = self._total_bytes > self.max_bytes
+        if over_budget:
+            # The caller may be about to read the new entry from disk, so it is never the one evicted
+            self.evict(keep=entry_path)
+        return entry_path
+
+    def get_or_fetch(self, pdf_filepath, endpoint, api_version, fetch, content_hash=None, as_path=False):
+        """
+        Returns the cached response for the PDF, calling fetch() and storing its result on a miss.
+
+        Args:
+        - pdf_filepath: The PDF whose contents key the entry.
+        - endpoint: The API endpoint URL.
+        - api_version: The API version string.
+        - fetch: Zero-argument callable that performs the real request.
+        - content_hash: Precomputed content hash, for documents that only exist in memory.
+        - as_path: Return the path of the cached response file instead of the response.
+
+        Returns:
+        - The response JSON, or with as_path the path of its cache entry.
+        """
+        key = self.make_key(pdf_filepath, endpoint, api_version, content_hash=content_hash)
+        cached = self.get_path(key) if as_path else self.get(key)
+        if cached is not None:
+            return cached
+        if self.offline:
+            raise LayoutCacheMiss(f"No cached layout response for {pdf_filepath} (offline mode)")
+        response_json = fetch()
+        entry_path = self.put(key, response_json)
+        return entry_path if as_path else response_json
+
+    def _entries(self):
+        entries = []
+        if not os.path.isdir(self.cache_dir):
+            return entries
+        for root, _, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                if filename.endswith(".json"):
+                    path = os.path.join(root, filename)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def size_bytes(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self, keep=None):
+        """
+        Deletes least recently used entries, other than keep, until the cache fits in EVICT_TO_FRACTION of max_bytes.
+        """
+        with self._lock:
+            entries = self._entries()
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes * EVICT_TO_FRACTION:
+                    break
+                if path == keep:
+                    continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+            self._total_bytes = total
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
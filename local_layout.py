@@ -0,0 +1,226 @@
+"""
+Local layout analysis with PyMuPDF, producing the same response schema as the Upstage layout analyzer.
+
+Each page is analyzed on its own, over a process pool:
+- text blocks become "paragraph" elements, or "caption" when they start like "Figure 3:" or "Fig. 2."
+- embedded images and clusters of vector drawings become "figure" elements; nearby regions are
+  merged, and text blocks inside or touching a figure (axis labels, legends) are folded into it
+- elements are emitted top to bottom, then left to right, with ids counting up across the document
+
+Bounding boxes are in layout-analyzer pixels (PDF points / 0.24), as bounding_box_to_rect expects.
+No network access is needed, but scanned pages (one full-page image, no text layer) yield no
+figures; the pipeline's "fallback" layout backend sends such documents to the remote analyzer.
+
+Usage:
+python local_layout.py sample_data/Attention3pg.pdf > attention3pg_layout.json
+"""
+import os
+import re
+import sys
+import json
+import html
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import fitz
+
+from instrumentation import worker_context
+
+#################### CONFIG ####################
+
+LOCAL_LAYOUT_MODEL = "pymupdf-layout"
+LOCAL_LAYOUT_VERSION = "1"
+LAYOUT_PIXELS_PER_POINT = 1 / 0.24
+DEFAULT_LAYOUT_WORKERS = os.cpu_count() or 1
+
+CAPTION_PATTERN = re.compile(r'^\s*(?i:Figure|Fig\.?)\s*\d+(?:[.-]\d+)*(?:\s*[:.|]|\s+[A-Z(])')
+MIN_FIGURE_SIDE = 36            # points; smaller regions are icons, bullets or rules
+MAX_BACKGROUND_FRACTION = 0.85  # images or drawings covering more of the page are backgrounds
+DRAWING_MERGE_GAP = 12          # points; drawings closer than this belong to the same figure
+MIN_DRAWINGS_PER_FIGURE = 3
+THIN_LINE_WIDTH = 1.5           # points; clusters made only of thin lines are tables or rules
+MAX_LABEL_WORDS = 12            # short text blocks touching a figure are its axis labels and legends
+
+# The element id in an element's html, as in <figure id='12'>
+HTML_ID_PATTERN = re.compile(r"""(\bid=['"])(\d+)(['"])""")
+
+
+def rect_to_bounding_box(rect):
+    """
+    The four corners of a fitz.Rect in layout-analyzer pixels, clockwise from the top left
+    """
+    x0, y0, x1, y1 = (round(value * LAYOUT_PIXELS_PER_POINT) for value in rect)
+    return [{"x": x0, "y": y0}, {"x": x1, "y": y0}, {"x": x1, "y": y1}, {"x": x0, "y": y1}]
+
+
+def merge_rects(rects, gap):
+    """
+    Union rects that overlap or lie within gap of each other, until no two remain close.
+
+    Returns:
+    - A list of (merged fitz.Rect, list of indices of the input rects it covers).
+    """
+    groups = [(fitz.Rect(rect), [i]) for i, rect in enumerate(rects)]
+    merged = True
+    while merged:
+        merged = False
+        result = []
+        for rect, members in groups:
+            grown = rect + (-gap, -gap, gap, gap)
+            for j, (other, other_members) in enumerate(result):
+                if grown.intersects(other):
+                    result[j] = (other | rect, other_members + members)
+                    merged = True
+                    break
+            else:
+                result.append((rect, members))
+        groups = result
+    return groups
+
+
+def _is_invisible(drawing):
+    # Unstroked white fills are page backgrounds or knock-outs behind text, not figure content
+    return drawing.get("color") is None and drawing.get("fill") in (None, (1.0, 1.0, 1.0))
+
+
+def _is_thin_line(rect):
+    return rect.width < THIN_LINE_WIDTH or rect.height < THIN_LINE_WIDTH
+
+
+def find_figure_regions(page):
+    """
+    Regions of a page holding an embedded image or a cluster of vector drawings.
+
+    Returns:
+    - A list of fitz.Rect, in no particular order.
+    """
+    page_rect = page.rect
+    max_area = MAX_BACKGROUND_FRACTION * page_rect.get_area()
+
+    def usable(rect):
+        return not rect.is_empty and rect.get_area() < max_area
+
+    image_rects = []
+    for info in page.get_image_info():
+        rect = fitz.Rect(info["bbox"]) & page_rect
+        if usable(rect) and rect.width >= MIN_FIGURE_SIDE and rect.height >= MIN_FIGURE_SIDE:
+            image_rects.append(rect)
+
+    drawing_rects = []
+    for drawing in page.get_drawings():
+        if _is_invisible(drawing):
+            continue
+        # Give horizontal and vertical lines some thickness so they can be merged like any other shape
+        rect = drawing["rect"] + (-0.5, -0.5, 0.5, 0.5)
+        rect &= page_rect
+        if usable(rect):
+            drawing_rects.append(rect)
+
+    regions = []
+    for rect, members in merge_rects(drawing_rects, DRAWING_MERGE_GAP):
+        if len(members) < MIN_DRAWINGS_PER_FIGURE or rect.width < MIN_FIGURE_SIDE or rect.height < MIN_FIGURE_SIDE:
+            continue
+        if not usable(rect) or all(_is_thin_line(drawing_rects[i]) for i in members):
+            continue
+        regions.append(rect)
+
+    # An image with drawings on or around it is one figure
+    return [rect for rect, _ in merge_rects(image_rects + regions, DRAWING_MERGE_GAP)]
+
+
+def analyze_page(page):
+    """
+    Layout elements of one page, without ids, in reading order.
+    """
+    figures = [{"rect": rect, "labels": []} for rect in find_figure_regions(page)]
+
+    texts = []
+    for x0, y0, x1, y1, text, _, block_type in page.get_text("blocks", sort=True):
+        text = " ".join(text.split())
+        if block_type != 0 or not text:
+            continue
+        rect = fitz.Rect(x0, y0, x1, y1)
+        if CAPTION_PATTERN.match(text):
+            texts.append({"rect": rect, "category": "caption", "text": text})
+            continue
+        container = next((figure for figure in figures if figure["rect"].contains((rect.tl + rect.br) / 2)), None)
+        if container is None and len(text.split()) <= MAX_LABEL_WORDS:
+            container = next((figure for figure in figures if (figure["rect"] + (-DRAWING_MERGE_GAP, -DRAWING_MERGE_GAP, DRAWING_MERGE_GAP, DRAWING_MERGE_GAP)).intersects(rect)), None)
+            if container is not None:
+                container["rect"] |= rect
+        if container is not None:
+            container["labels"].append(text)
+            continue
+        texts.append({"rect": rect, "category": "paragraph", "text": text})
+
+    elements = [{"rect": figure["rect"], "category": "figure", "text": " ".join(figure["labels"])} for figure in figures] + texts
+    elements.sort(key=lambda element: (round(element["rect"].y0), element["rect"].x0))
+    return elements
+
+
+def element_html(element_id, category, text):
+    if category == "figure":
+        return f"<figure id='{element_id}'><img alt=\"{html.escape(text)}\" /></figure>"
+    return f"<p id='{element_id}' data-category='{category}'>{html.escape(text)}</p>"
+
+
+############################################################
+### Document analysis
+
+_worker_document = None
+
+def _init_layout_worker(pdf_filepath):
+    # Each worker process opens the document once and analyzes many pages from it
+    global _worker_document
+    _worker_document = fitz.open(pdf_filepath)
+
+def _analyze_page_worker(page_index):
+    return analyze_page(_worker_document[page_index])
+
+
+def analyze_pdf(pdf_filepath, max_workers=DEFAULT_LAYOUT_WORKERS):
+    """
+    Analyze a PDF's layout locally.
+
+    Args:
+    - pdf_filepath: The PDF to analyze.
+    - max_workers: Number of worker processes, one page at a time each. 1 analyzes serially in this process.
+
+    Returns:
+    - A response JSON with the Upstage layout analyzer's "elements" schema (id, page, category,
+      bounding_box, text, html).
+    """
+    with fitz.open(pdf_filepath) as pdf_document:
+        num_pages = len(pdf_document)
+        max_workers = min(max_workers, num_pages)
+        if max_workers <= 1:
+            pages = [analyze_page(page) for page in pdf_document]
+
+    if max_workers > 1:
+        # Runs on the pipeline's upload threads, so the workers are not forked from this process (see worker_context)
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=worker_context(), initializer=_init_layout_worker, initargs=(pdf_filepath,)) as executor:
+            pages = list(executor.map(_analyze_page_worker, range(num_pages), chunksize=max(1, num_pages // (4 * max_workers))))
+
+    elements = []
+    for page_index, page_elements in enumerate(pages):
+        for element in page_elements:
+            element_id = len(elements)
+            elements.append({
+                "bounding_box": rect_to_bounding_box(element["rect"]),
+                "category": element["category"],
+                "html": element_html(element_id, element["category"], element["text"]),
+                "id": element_id,
+                "page": page_index + 1,
+                "text": element["text"],
+            })
+    return {"api": LOCAL_LAYOUT_VERSION, "model": LOCAL_LAYOUT_MODEL, "billed_pages": 0, "elements": elements}
+
+
+############################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Analyze a PDF's layout locally and print the layout-analyzer JSON.")
+    parser.add_argument("pdf", help="Path to the PDF file.")
+    parser.add_argument("--max-workers", type=int, default=DEFAULT_LAYOUT_WORKERS, help="Maximum number of worker processes.")
+    args = parser.parse_args()
+
+    json.dump(analyze_pdf(args.pdf, max_workers=args.max_workers), sys.stdout, indent=2)
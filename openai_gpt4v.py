@@ -1,80 +1,233 @@
-import base64
-import requests
 import os
+import base64
+import asyncio
+import hashlib
+import mimetypes
+import numpy as np
 from dotenv import load_dotenv
 
+from http_client import get_client
+from layout_cache import LayoutCache
+from raster_cache import open_image
+from instrumentation import get_logger, increment
+
 load_dotenv()
+logger = get_logger("classifier")
 # Set your OpenAI API key here
 api_key = os.getenv("OPENAI_API_KEY")
 
+#################### CONFIG ####################
+
+OPENAI_CHAT_URL = "https://api.openai.com/v1/chat/completions"
+CLASSIFIER_MODEL = "gpt-4-vision-preview"
+CLASSIFIER_PROMPT = "Is this a diagram? Please respond 'yes' or 'no'."
+DEFAULT_MAX_CONCURRENCY = 8  # Timeouts, retries and the request rate are set in http_client.SERVICES["openai"]
+
+# Results are cached by image content hash, so reclassifying a corpus only pays for new images
+DEFAULT_CLASSIFICATION_CACHE_DIR = os.getenv("CLASSIFICATION_CACHE_DIR", ".classification_cache")
+
+# Local pre-filter thresholds, measured on a copy downscaled to PREFILTER_SIZE
+PREFILTER_SIZE = 256
+MIN_SIDE_PX = 48                    # smaller crops are rules, bullets or specks
+MAX_ASPECT_RATIO = 8.0              # thinner crops are lines or text strips
+MIN_PIXEL_STD = 4.0                 # flatter crops are blank
+PHOTO_MIN_COLOURS = 4096            # distinct 5-bit-per-channel colours in a photograph ...
+PHOTO_MAX_BACKGROUND = 0.2          # ... which has no dominant background colour
+DIAGRAM_MIN_BACKGROUND = 0.5        # flat-colour drawings on a dominant background ...
+DIAGRAM_MAX_COLOURS = 512           # ... with a small palette ...
+DIAGRAM_MIN_COLOURFUL = 0.02        # ... some saturated fills or strokes (plain black text has none) ...
+DIAGRAM_MIN_EDGE_DENSITY = 0.01     # ... and sharp edges, but not everywhere
+DIAGRAM_MAX_EDGE_DENSITY = 0.3
+EDGE_THRESHOLD = 48
+
+
 def encode_image(image_path):
     """
     Encodes the given image to base64.
-    
+
     Args:
     - image_path: The path to the image file.
-    
+
     Returns:
     - The base64 encoded string of the image.
     """
     with open(image_path, "rb") as image_file:
         return base64.b64encode(image_file.read()).decode('utf-8')
 
-def is_diagram_check_gpt4v(image_path):
+def image_mime_type(image_path):
+    return mimetypes.guess_type(image_path)[0] or "image/png"
+
+############################################################
+### Local pre-filter
+
+def image_statistics(image):
+    """
+    Cheap statistics of a PIL image used by prefilter_diagram.
+    """
+    width, height = image.size
+    small = image.convert("RGB")
+    small.thumbnail((PREFILTER_SIZE, PREFILTER_SIZE))
+    pixels = np.asarray(small, dtype=np.int16)
+
+    # Distinct colours at 5 bits per channel, and the share of the most common one
+    quantized = (pixels >> 3).reshape(-1, 3)
+    codes = (quantized[:, 0] << 10) | (quantized[:, 1] << 5) | quantized[:, 2]
+    counts = np.bincount(codes, minlength=1 << 15)
+
+    gray = pixels.mean(axis=2)
+    gradient = np.abs(np.diff(gray, axis=0))[:, :-1] + np.abs(np.diff(gray, axis=1))[:-1, :]
+    saturation = pixels.max(axis=2) - pixels.min(axis=2)
+
+    return {
+        "width": width,
+        "height": height,
+        "aspect_ratio": max(width, height) / max(min(width, height), 1),
+        "pixel_std": float(gray.std()),
+        "num_colours": int(np.count_nonzero(counts)),
+        "background_fraction": float(counts.max() / len(codes)),
+        "colourful_fraction": float(np.mean(saturation > 64)),
+        "edge_density": float(np.mean(gradient > EDGE_THRESHOLD)) if gradient.size else 0.0,
+    }
+
+def prefilter_diagram(image_path):
+    """
+    Decides obvious cases locally.
+
+    The pixels come from the raster cache when this process rendered or read the image before.
+
+    Returns:
+    - True or False when the image statistics are conclusive, None when the API should decide.
+    """
+    stats = image_statistics(open_image(image_path))
+
+    if min(stats["width"], stats["height"]) < MIN_SIDE_PX or stats["aspect_ratio"] > MAX_ASPECT_RATIO:
+        return False
+    if stats["pixel_std"] < MIN_PIXEL_STD:
+        return False
+    if stats["num_colours"] >= PHOTO_MIN_COLOURS and stats["background_fraction"] < PHOTO_MAX_BACKGROUND:
+        return False
+    if (stats["background_fraction"] >= DIAGRAM_MIN_BACKGROUND
+            and stats["num_colours"] <= DIAGRAM_MAX_COLOURS
+            and stats["colourful_fraction"] >= DIAGRAM_MIN_COLOURFUL
+            and DIAGRAM_MIN_EDGE_DENSITY <= stats["edge_density"] <= DIAGRAM_MAX_EDGE_DENSITY):
+        return True
+    return None
+
+############################################################
+### GPT-4V client
+
+def classification_cache_key(image_bytes):
+    return hashlib.sha256(b"|".join([image_bytes, CLASSIFIER_MODEL.encode(), CLASSIFIER_PROMPT.encode()])).hexdigest()
+
+def request_diagram_check(client, image_bytes, mime_type):
+    """
+    Asks GPT-4-vision whether the image is a diagram. Raises on HTTP or response errors.
+
+    The client retries rate limits and server errors itself (see http_client.py).
+    """
+    payload = {
+        "model": CLASSIFIER_MODEL,
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": CLASSIFIER_PROMPT
+                    },
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": f"data:{mime_type};base64,{base64.b64encode(image_bytes).decode('utf-8')}"
+                        }
+                    }
+                ]
+            }
+        ],
+        "max_tokens": 300
+    }
+    response = client.post(OPENAI_CHAT_URL, json=payload, headers={"Authorization": f"Bearer {api_key}"})
+    response.raise_for_status()
+    answer = response.json()['choices'][0]['message']['content'].lower()
+    return "yes" in answer
+
+def classify_image(image_path, client=None, cache=None, use_prefilter=True):
+    """
+    Classifies one image: local pre-filter first, then the cache, then the API.
+
+    Returns:
+    - A dict with "is_diagram" (True, False, or None if classification failed) and "source"
+      ("prefilter", "cache", "api" or "error").
+    """
+    if use_prefilter:
+        decision = prefilter_diagram(image_path)
+        if decision is not None:
+            return {"is_diagram": decision, "source": "prefilter"}
+
+    with open(image_path, "rb") as image_file:
+        image_bytes = image_file.read()
+    key = classification_cache_key(image_bytes)
+    if cache is not None:
+        cached = cache.get(key)
+        if cached is not None:
+            return {"is_diagram": cached["is_diagram"], "source": "cache"}
+
+    try:
+        is_diagram = request_diagram_check(client or get_client("openai"), image_bytes, image_mime_type(image_path))
+    except Exception as e:
+        logger.warning("An error occurred classifying %s: %s", image_path, e)
+        increment("classifications_failed")
+        return {"is_diagram": None, "source": "error"}
+
+    if cache is not None:
+        cache.put(key, {"is_diagram": is_diagram})
+    return {"is_diagram": is_diagram, "source": "api"}
+
+def is_diagram_check_gpt4v(image_path, cache=None):
     """
     Checks if the given image is a diagram or not using GPT-4-vision.
-    
+
     Args:
     - image_path: The path to the image file.
-    
+    - cache: Optional LayoutCache holding earlier classifications.
+
     Returns:
-    - True if the image is a diagram, False otherwise.
+    - True if the image is a diagram, False if not, None if the request failed.
     """
-    try:
-        base64_image = encode_image(image_path)
-        
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {api_key}"
-        }
-        
-        payload = {
-            "model": "gpt-4-vision-preview",
-            "messages": [
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": "Is this a diagram? Please respond 'yes' or 'no'."
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{base64_image}"
-                            }
-                        }
-                    ]
-                }
-            ],
-            "max_tokens": 300
-        }
-        
-        response = requests.post("https://api.openai.com/v1/chat/completions", headers=headers, json=payload)
-        response_data = response.json()
-        
-        # Assuming the response structure allows direct access to the answer
-        # This might need adjustment based on actual API response
-        answer = response_data['choices'][0]['message']['content'].lower()
-        print(f"Answer: {answer}")
-        return "yes" in answer
-    except Exception as e:
-        print(f"An error occurred: {e}")
-        return False
+    return classify_image(image_path, cache=cache)["is_diagram"]
+
+async def _classify_images_async(image_paths, max_concurrency, cache, use_prefilter):
+    client = get_client("openai")
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def classify(image_path):
+        async with semaphore:
+            return image_path, await asyncio.to_thread(classify_image, image_path, client, cache, use_prefilter)
+
+    return dict(await asyncio.gather(*(classify(image_path) for image_path in image_paths)))
+
+def classify_images(image_paths, max_concurrency=DEFAULT_MAX_CONCURRENCY, cache_dir=DEFAULT_CLASSIFICATION_CACHE_DIR, use_prefilter=True):
+    """
+    Classifies many images, at most max_concurrency API requests at a time over the shared, rate-limited client.
+
+    Args:
+    - image_paths: The image files to classify.
+    - max_concurrency: Maximum number of requests in flight.
+    - cache_dir: Directory of the result cache. None disables caching.
+    - use_prefilter: Decide obvious cases locally without calling the API.
+
+    Returns:
+    - A dict mapping each image path to the result of classify_image.
+    """
+    cache = LayoutCache(cache_dir=cache_dir) if cache_dir else None
+    return asyncio.run(_classify_images_async(list(dict.fromkeys(image_paths)), max_concurrency, cache, use_prefilter))
 
 # Example usage
 # image_path = 'output_figures/dl15/diagrams/Element 158.png'
 # if is_diagram_check_gpt4v(image_path):
 #     print("The image is a diagram.")
 # else:
-#     print("The image is not a diagram.")
\ No newline at end of file
+#     print("The image is not a diagram.")
+
+# results = classify_images(glob.glob('output_figures/dl15/diagrams/*.png'))
+# print(sum(r["is_diagram"] is True for r in results.values()), "diagrams")
@@ -0,0 +1,155 @@
+"""
+Pre-flight page triage: find the pages of a PDF worth sending to the layout API.
+
+Most pages of a textbook are prose. A quick local pass with PyMuPDF keeps a page when it has
+- an embedded image of figure size (scanned pages too, as one full-page image)
+- MIN_DRAWINGS_PER_FIGURE or more visible vector drawings that are not thin rules
+- a text line starting like a caption ("Figure 3:", "Fig. 2.1")
+and adds the neighbours the pipeline needs to link captions: the page after a figure page, where
+its caption may continue, and the page before a caption page, where its figure may be.
+
+Only the kept pages are packed into the document that is uploaded. PageTriage.restore maps the
+page numbers of the returned elements back to the original document, and fills in the skipped
+pages with their text blocks as paragraph elements, so in-text references to figures still reach
+the figures' descriptions.
+
+Usage:
+python page_triage.py sample_data/dl15.pdf
+"""
+import os
+import sys
+import json
+import argparse
+
+import fitz
+
+from local_layout import CAPTION_PATTERN, HTML_ID_PATTERN, MIN_FIGURE_SIDE, MIN_DRAWINGS_PER_FIGURE, rect_to_bounding_box, element_html, _is_invisible, _is_thin_line
+
+#################### CONFIG ####################
+
+PAGE_TRIAGE_VERSION = "1"
+PAGES_AFTER_FIGURE = 1   # following pages kept for a figure's caption
+PAGES_BEFORE_CAPTION = 1  # preceding pages kept for a caption's figure
+
+
+def page_signals(page):
+    """
+    Why a page may hold a figure: a set of "image", "drawings" and "caption", empty for prose
+    """
+    signals = set()
+    for info in page.get_image_info():
+        rect = fitz.Rect(info["bbox"]) & page.rect
+        if rect.width >= MIN_FIGURE_SIDE and rect.height >= MIN_FIGURE_SIDE:
+            signals.add("image")
+            break
+
+    num_drawings = 0
+    for drawing in page.get_cdrawings():
+        if _is_invisible(drawing) or _is_thin_line(fitz.Rect(drawing["rect"])):
+            continue
+        num_drawings += 1
+        if num_drawings >= MIN_DRAWINGS_PER_FIGURE:
+            signals.add("drawings")
+            break
+
+    for block in page.get_text("blocks"):
+        if block[6] == 0 and any(CAPTION_PATTERN.match(line) for line in block[4].splitlines()):
+            signals.add("caption")
+            break
+    return signals
+
+
+def text_elements(page):
+    """
+    The text blocks of a page as paragraph elements, without ids, in reading order
+    """
+    elements = []
+    for x0, y0, x1, y1, text, _, block_type in page.get_text("blocks", sort=True):
+        text = " ".join(text.split())
+        if block_type == 0 and text:
+            elements.append({"page": page.number + 1, "category": "paragraph", "bounding_box": rect_to_bounding_box(fitz.Rect(x0, y0, x1, y1)), "text": text})
+    return elements
+
+
+class PageTriage:
+    """
+    The pages of a document kept for layout analysis, and the text of the skipped ones.
+
+    Attributes:
+    - num_pages: Pages in the original document.
+    - pages: 0-based indices of the kept pages, in document order. Page k (1-based) of the
+      uploaded document is page pages[k - 1] + 1 of the original.
+    - skipped_elements: Paragraph elements (without ids) of the skipped pages, in document order.
+    """
+    def __init__(self, num_pages, pages, skipped_elements):
+        self.num_pages = num_pages
+        self.pages = pages
+        self.skipped_elements = skipped_elements
+
+    @property
+    def is_complete(self):
+        return len(self.pages) == self.num_pages
+
+    def restore(self, response_json):
+        """
+        The response of the uploaded pages as if the whole document had been analyzed: page numbers
+        mapped back to the original, the skipped pages' text added as paragraph elements, and the ids
+        counted up in reading order again.
+        """
+        restored = {key: value for key, value in response_json.items() if key != "elements"}
+        elements = [dict(element, page=self.pages[element["page"] - 1] + 1) for element in response_json["elements"]]
+        elements.extend(dict(element) for element in self.skipped_elements)
+        # Stable: each page keeps the analyzer's reading order
+        elements.sort(key=lambda element: element["page"])
+        for element_id, element in enumerate(elements):
+            if "id" not in element:
+                element["html"] = element_html(element_id, "paragraph", element["text"])
+            elif element.get("html"):
+                element["html"] = HTML_ID_PATTERN.sub(lambda m: f"{m.group(1)}{element_id}{m.group(3)}", element["html"])
+            element["id"] = element_id
+        restored["elements"] = elements
+        return restored
+
+
+def triage_pdf(pdf_filepath):
+    """
+    Decide which pages of a PDF go to the layout API. Returns a PageTriage.
+    """
+    with fitz.open(pdf_filepath) as pdf_document:
+        num_pages = len(pdf_document)
+        signals = [page_signals(page) for page in pdf_document]
+
+        keep = set()
+        for index, found in enumerate(signals):
+            if found & {"image", "drawings"}:
+                keep.update(range(index, min(num_pages, index + PAGES_AFTER_FIGURE + 1)))
+            if "caption" in found:
+                keep.update(range(max(0, index - PAGES_BEFORE_CAPTION), index + 1))
+        pages = sorted(keep)
+
+        skipped_elements = []
+        if len(pages) < num_pages:
+            for index in range(num_pages):
+                if index not in keep:
+                    skipped_elements.extend(text_elements(pdf_document[index]))
+    return PageTriage(num_pages, pages, skipped_elements)
+
+
+def triage_config():
+    """
+    The settings that decide the kept pages, for the layout stage's fingerprint
+    """
+    return {"version": PAGE_TRIAGE_VERSION, "pages_after_figure": PAGES_AFTER_FIGURE, "pages_before_caption": PAGES_BEFORE_CAPTION,
+            "min_figure_side": MIN_FIGURE_SIDE, "min_drawings": MIN_DRAWINGS_PER_FIGURE}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show which pages of a PDF would be uploaded for layout analysis.")
+    parser.add_argument("pdf_filepath", help="PDF to triage.")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.pdf_filepath):
+        sys.exit(f"No such file: {args.pdf_filepath}")
+    triage = triage_pdf(args.pdf_filepath)
+    json.dump({"num_pages": triage.num_pages, "kept_pages": [index + 1 for index in triage.pages]}, sys.stdout)
+    print()
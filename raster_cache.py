@@ -0,0 +1,167 @@
+"""
+In-process cache of decoded page and figure rasters, bounded by memory.
+
+Rendering produces pixels that later steps of the same run need again: the figure's perceptual
+hash for dedup, the classifier's pre-filter statistics, a second crop from the same page. Instead
+of writing a PNG and decoding it again, the pixels are kept here, least recently used first out
+once the cache holds more than max_bytes.
+
+Values are fitz.Pixmaps (page rasters) or PIL images (figures at their written size). Pixmaps are
+read through pixmap_array, a NumPy view over the pixmap's samples that copies nothing; a crop is a
+slice of that view. Entries are only dropped from the cache on eviction, so a consumer still holding
+a pixmap or image keeps it valid.
+
+The budget is per process and can be set with RASTER_CACHE_BYTES (0 disables the cache).
+
+Example usage:
+cache = get_raster_cache()
+page_pix = cache.get_or_create(("page", pdf_filepath, page_number, dpi), lambda: page.get_pixmap(dpi=dpi))
+pixels = pixmap_array(page_pix)  # (height, width, channels) uint8, no copy
+image = open_image("output_figures/dl15/diagrams/Figure 1-1.png")  # decoded once per run
+"""
+import os
+import threading
+from collections import OrderedDict
+
+import fitz
+import numpy as np
+from PIL import Image
+
+from figure_encoding import pixmap_to_image
+from instrumentation import increment
+
+#################### CONFIG ####################
+
+DEFAULT_RASTER_CACHE_BYTES = int(os.getenv("RASTER_CACHE_BYTES", 256 * 1024 ** 2))
+
+
+def raster_nbytes(value):
+    """
+    Memory held by a cached raster
+    """
+    if isinstance(value, fitz.Pixmap):
+        return len(value.samples_mv)
+    if isinstance(value, Image.Image):
+        # PIL keeps RGB and other 3-band modes as 4 bytes per pixel
+        return value.width * value.height * (4 if len(value.getbands()) == 3 else len(value.getbands()))
+    return value.nbytes
+
+
+def pixmap_array(pix):
+    """
+    The pixels of a fitz.Pixmap as a (height, width) or (height, width, channels) uint8 array, without copying.
+
+    The array is a view over the pixmap's samples and is only valid while the pixmap is alive.
+    """
+    array = np.frombuffer(pix.samples_mv, dtype=np.uint8).reshape(pix.height, pix.stride)[:, :pix.width * pix.n]
+    return array.reshape(pix.height, pix.width) if pix.n == 1 else array.reshape(pix.height, pix.width, pix.n)
+
+
+def figure_key(image_path):
+    """
+    The cache key of a figure image written to image_path
+    """
+    return ("figure", os.path.abspath(image_path))
+
+
+class RasterCache:
+    """
+    Thread-safe LRU of rasters, bounded by the bytes they hold.
+    """
+    def __init__(self, max_bytes=DEFAULT_RASTER_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._entries = OrderedDict()  # key -> (value, nbytes), least recently used first
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        The cached raster for key, or None on a miss.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        increment("raster_cache_hits" if entry is not None else "raster_cache_misses")
+        return entry[0] if entry is not None else None
+
+    def put(self, key, value):
+        """
+        Cache value under key, evicting the least recently used entries to stay within max_bytes.
+        Values larger than the whole budget are not cached.
+        """
+        nbytes = raster_nbytes(value)
+        if nbytes > self.max_bytes:
+            return value
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.nbytes -= previous[1]
+            self._entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+            num_evicted = 0
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted_nbytes) = self._entries.popitem(last=False)
+                self.nbytes -= evicted_nbytes
+                num_evicted += 1
+        if num_evicted:
+            increment("raster_cache_evictions", num_evicted)
+        return value
+
+    def get_or_create(self, key, create):
+        """
+        The cached raster for key, calling create() and caching its result on a miss
+        """
+        value = self.get(key)
+        if value is None:
+            value = self.put(key, create())
+        return value
+
+    def discard(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.nbytes -= entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+
+############################################################
+### Shared cache
+# One cache per process, created on first use; worker processes each get their own.
+_raster_cache = None
+_raster_cache_pid = None
+_raster_cache_lock = threading.Lock()
+
+def get_raster_cache():
+    global _raster_cache, _raster_cache_pid
+    with _raster_cache_lock:
+        if _raster_cache is None or _raster_cache_pid != os.getpid():
+            _raster_cache = RasterCache()
+            _raster_cache_pid = os.getpid()
+        return _raster_cache
+
+
+def open_image(image_path, cache=None):
+    """
+    A figure image as a PIL image: its pixels from the raster cache if this run has them,
+    otherwise decoded from disk and cached.
+
+    The image is shared with the cache; convert or copy it before modifying it.
+    """
+    cache = get_raster_cache() if cache is None else cache
+    key = figure_key(image_path)
+    value = cache.get(key)
+    if isinstance(value, fitz.Pixmap):
+        return pixmap_to_image(value)
+    if value is not None:
+        return value
+    image = Image.open(image_path)
+    image.load()  # Decodes and closes the file
+    return cache.put(key, image)
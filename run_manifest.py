@@ -0,0 +1,155 @@
+"""
+Run manifest: which stages of which documents are complete, so interrupted or repeated runs resume.
+
+Each stage of each document is recorded under the document's content hash and book name (the
+name of its directory in the output directory), so the same PDF under another name is processed
+as a book of its own. The record holds a fingerprint of the stage's code version and
+configuration, and of the fingerprint of the stage before it. A stage is done only if its
+recorded fingerprint matches the current one, so changing a stage's version or config redoes
+that stage and every stage after it, and nothing before it.
+
+Content hashes are remembered by (path, size, mtime), so re-checking an unchanged corpus does
+not re-read every PDF.
+"""
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from layout_cache import hash_file
+
+#################### CONFIG ####################
+
+MANIFEST_FILENAME = "run_manifest.sqlite"
+BUSY_TIMEOUT_SECONDS = 30
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    content_hash TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS stages (
+    content_hash TEXT NOT NULL,
+    book TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    completed_at REAL NOT NULL,
+    outputs TEXT,
+    PRIMARY KEY (content_hash, book, stage)
+);
+"""
+
+
+def manifest_path_for(output_dir):
+    return os.path.join(output_dir, MANIFEST_FILENAME)
+
+
+def stage_fingerprint(stage, version, config, upstream_fingerprint=""):
+    """
+    Fingerprint of a stage's code version and config, chained to the stage before it
+    """
+    payload = json.dumps([stage, version, config, upstream_fingerprint], sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+@contextmanager
+def atomic_output(path):
+    """
+    Yields a temporary path in the same directory; it replaces path only if the block succeeds.
+
+    The temporary name keeps path's extension, so writers that infer the format from it still work.
+    """
+    directory, filename = os.path.split(path)
+    _, extension = os.path.splitext(filename)
+    fd, tmp_path = tempfile.mkstemp(dir=directory or ".", prefix=f".{filename}.", suffix=extension)
+    os.close(fd)
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class RunManifest:
+    """
+    Example usage:
+    manifest = RunManifest(manifest_path_for("output_figures"))
+    content_hash = manifest.content_hash("sample_data/dl15.pdf")
+    if not manifest.is_done(content_hash, "dl15", "extract", fingerprint):
+        ...
+        manifest.mark_done(content_hash, "dl15", "extract", fingerprint, outputs=figure_list_dict)
+    """
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # One connection shared by the pipeline's threads, serialized by a lock
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT_SECONDS, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(stages)")]
+        if columns and "book" not in columns:
+            # Manifests from before stages were kept per book; their stages are redone once
+            self.conn.execute("DROP TABLE stages")
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def content_hash(self, pdf_filepath):
+        path = os.path.abspath(pdf_filepath)
+        stat = os.stat(path)
+        with self._lock:
+            row = self.conn.execute("SELECT size, mtime_ns, content_hash FROM files WHERE path = ?", (path,)).fetchone()
+        if row and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            return row[2]
+        content_hash = hash_file(path)
+        with self._lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO files (path, size, mtime_ns, content_hash) VALUES (?, ?, ?, ?)", (path, stat.st_size, stat.st_mtime_ns, content_hash))
+        return content_hash
+
+    def _record(self, content_hash, book, stage, fingerprint):
+        with self._lock:
+            return self.conn.execute("SELECT outputs FROM stages WHERE content_hash = ? AND book = ? AND stage = ? AND fingerprint = ?", (content_hash, book, stage, fingerprint)).fetchone()
+
+    def is_done(self, content_hash, book, stage, fingerprint):
+        return self._record(content_hash, book, stage, fingerprint) is not None
+
+    def outputs(self, content_hash, book, stage, fingerprint):
+        """
+        The outputs recorded for a completed stage, or None if the stage is missing or stale.
+        """
+        row = self._record(content_hash, book, stage, fingerprint)
+        if row is None or row[0] is None:
+            return None
+        return json.loads(row[0])
+
+    def mark_done(self, content_hash, book, stage, fingerprint, outputs=None):
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO stages (content_hash, book, stage, fingerprint, completed_at, outputs) VALUES (?, ?, ?, ?, ?, ?)",
+                (content_hash, book, stage, fingerprint, time.time(), json.dumps(outputs) if outputs is not None else None),
+            )
+
+    def invalidate(self, content_hash, book=None):
+        """
+        Forget the completed stages of a document, under every book name unless book is given
+        """
+        with self._lock, self.conn:
+            if book is None:
+                self.conn.execute("DELETE FROM stages WHERE content_hash = ?", (content_hash,))
+            else:
+                self.conn.execute("DELETE FROM stages WHERE content_hash = ? AND book = ?", (content_hash, book))
@@ -1 +1,7 @@
-print("hello") 
\ No newline at end of file
+"""
+Entry point of the web process (see Procfile): the HTTP ingestion service in ingestion_service.py.
+"""
+from ingestion_service import main
+
+if __name__ == "__main__":
+    main()
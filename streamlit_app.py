@@ -1,9 +1,8 @@
 import os
-import json
+import math
 import streamlit as st
-from PIL import Image
 
-import glob  # Import glob module
+from figure_catalog import FigureCatalog, catalog_path_for
 
 st.set_page_config(
     layout="wide"
@@ -12,56 +11,78 @@ st.set_page_config(
 # Set the path to the output_figures directory
 output_figures_path = "output_figures"
 
-# Get a list of book folders
-book_folders = [folder for folder in os.listdir(output_figures_path) if os.path.isdir(os.path.join(output_figures_path, folder))]
-
-# Sort the book folders alphabetically
-book_folders.sort()
-
-# Iterate over each book folder
-for book_folder in book_folders:
-    # Create a top-level header for the book
-
-    try: 
-        st.markdown(f"## {book_folder}")
-        
-        # Load the JSON file for the current book
-        json_file = os.path.join(output_figures_path, book_folder, f"{book_folder}_figure_list.json")
-        try:
-            with open(json_file, "r") as file:
-                figure_list = json.load(file)
-        except FileNotFoundError:
-            # If the specific JSON file is not found, load any JSON file in the folder
-            json_files = glob.glob(os.path.join(output_figures_path, book_folder, "*.json"))
-            if json_files:  # Check if there is at least one JSON file
-                with open(json_files[0], "r") as file:  # Open the first JSON file found
-                    figure_list = json.load(file)
-            else:
-                st.error(f"No JSON files found in {book_folder}.")
-                continue  # Skip this iteration if no JSON files are found
-        
-        # Create 5 columns for displaying the images
-        cols = st.columns(4)
-        
-        # Iterate over each figure in the JSON file
-        for i, figure in enumerate(figure_list):
-            # Get the image file path
-            try: 
-                image_file = os.path.join(output_figures_path, book_folder, "diagrams", figure["image_name"] + ".png")
-                
-                # Open the image using PIL
-                image = Image.open(image_file)
-                
-                # Display the image in the corresponding column
-                cols[i % 5].image(image, caption=figure["image_name"], use_column_width=True)
-                
-                # Display the image caption and descriptions
-                cols[i % 5].write(figure["image_caption"])
-                cols[i % 5].write(figure["image_descriptions"])
-            except FileNotFoundError:
-                print(f"Image file not found: {figure['image_name']}.")
-                continue
-
-    except Exception as e:
-        print(f"An error occurred while processing {book_folder}: {e}")
+NUM_COLUMNS = 4
+PAGE_SIZES = [20, 40, 100]
+
+
+def catalog_mtime(catalog_path):
+    """
+    Changes whenever the pipeline commits a book, invalidating the cached queries. WAL commits touch the -wal file.
+    """
+    return max((os.stat(path).st_mtime for path in (catalog_path, catalog_path + "-wal") if os.path.exists(path)), default=None)
+
+
+@st.cache_data
+def list_books(catalog_path, mtime):
+    """
+    (book, figure count) pairs from the figure catalog, sorted by book
+    """
+    with FigureCatalog(catalog_path) as catalog:
+        return catalog.books()
+
+
+@st.cache_data
+def load_figure_page(catalog_path, mtime, books, limit, offset):
+    """
+    One page of figures of the selected books, keeping only the fields the gallery shows
+    """
+    with FigureCatalog(catalog_path) as catalog:
+        return [
+            {
+                "book": figure["book"],
+                "image_name": figure["image_name"],
+                "image_caption": figure["image_caption"],
+                "image_descriptions": figure["image_descriptions"],
+                "image_path": catalog.resolve_path(figure["image_path"]),
+                "thumbnail_path": catalog.resolve_path(figure["thumbnail_path"]),
+            }
+            for figure in catalog.figures(books=list(books), limit=limit, offset=offset)
+        ]
+
+
+catalog_path = catalog_path_for(output_figures_path)
+mtime = catalog_mtime(catalog_path)
+book_counts = dict(list_books(catalog_path, mtime))
+book_names = list(book_counts)
+
+# Filter by book and page through the figures; only the current page is queried and loaded
+selected_books = st.sidebar.multiselect("Books", book_names, default=book_names[:1])
+page_size = st.sidebar.selectbox("Figures per page", PAGE_SIZES)
+
+num_figures = sum(book_counts[book] for book in selected_books)
+num_pages = max(1, math.ceil(num_figures / page_size))
+page = st.sidebar.number_input("Page", min_value=1, max_value=num_pages, value=1, step=1)
+st.sidebar.write(f"{num_figures} figures, page {page} of {num_pages}")
+
+figures = load_figure_page(catalog_path, mtime, tuple(selected_books), page_size, (page - 1) * page_size)
+
+# Create the columns for displaying the images
+cols = st.columns(NUM_COLUMNS)
+
+for i, figure in enumerate(figures):
+    col = cols[i % NUM_COLUMNS]
+    full_path = figure["image_path"]
+    # Books processed before thumbnails existed fall back to the full image
+    thumbnail_path = figure["thumbnail_path"] if os.path.exists(figure["thumbnail_path"]) else full_path
+    if not os.path.exists(thumbnail_path):
+        print(f"Image file not found: {figure['image_name']}.")
         continue
+
+    caption = figure["image_name"] if len(selected_books) == 1 else f"{figure['book']} / {figure['image_name']}"
+    col.image(thumbnail_path, caption=caption, use_column_width=True)
+    col.write(figure["image_caption"])
+
+    # Full-resolution image and descriptions only when asked for
+    if col.checkbox("Details", key=f"details-{figure['book']}-{figure['image_name']}"):
+        col.image(full_path, use_column_width=True)
+        col.write(figure["image_descriptions"])
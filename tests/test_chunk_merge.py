@@ -0,0 +1,55 @@
+import os
+
+import pytest
+
+from image_extraction_pipeline import merge_chunk_responses, split_pdf_into_chunks
+from local_layout import analyze_pdf, element_html
+
+
+SAMPLE_PDF = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "sample_data", "Attention3pg.pdf")
+
+
+def element(element_id, page, category="paragraph", text="text"):
+    return {"id": element_id, "page": page, "category": category, "text": text, "html": element_html(element_id, category, text)}
+
+
+def test_ids_and_pages_are_rebased():
+    chunks = [
+        (0, {"api": "2.0", "billed_pages": 2, "elements": [element(0, 1), element(1, 2, "figure"), element(2, 2, "caption")]}),
+        (2, {"api": "2.0", "billed_pages": 2, "elements": [element(0, 1), element(1, 2)]}),
+        (4, {"api": "2.0", "billed_pages": 1, "elements": [element(0, 1, "figure")]}),
+    ]
+    merged = merge_chunk_responses(chunks)
+    assert [(e["id"], e["page"]) for e in merged["elements"]] == [(0, 1), (1, 2), (2, 2), (3, 3), (4, 4), (5, 5)]
+    # The ids inside the HTML follow the element ids
+    assert [e["html"] for e in merged["elements"]] == [element_html(e["id"], e["category"], e["text"]) for e in merged["elements"]]
+    assert merged["billed_pages"] == 5
+    assert merged["api"] == "2.0"
+
+
+def test_id_gaps_and_empty_chunks():
+    chunks = [
+        (0, {"elements": [element(0, 1), element(5, 1)]}),
+        (1, {"elements": []}),
+        (2, {"elements": [element(3, 1)]}),
+    ]
+    merged = merge_chunk_responses(chunks)
+    # Offsets follow the largest id of each chunk, so ids stay unique and in order
+    assert [(e["id"], e["page"]) for e in merged["elements"]] == [(0, 1), (5, 1), (9, 3)]
+    assert merged["elements"][2]["html"] == element_html(9, "paragraph", "text")
+
+
+def test_inputs_are_not_modified():
+    response = {"elements": [element(0, 1)]}
+    merge_chunk_responses([(0, {"elements": [element(0, 1)]}), (1, response)])
+    assert response == {"elements": [element(0, 1)]}
+
+
+@pytest.mark.parametrize("chunk_pages", [1, 2])
+def test_chunked_analysis_matches_whole_document(tmp_path, chunk_pages):
+    chunk_responses = []
+    for i, (page_offset, chunk_bytes) in enumerate(split_pdf_into_chunks(SAMPLE_PDF, chunk_pages=chunk_pages)):
+        chunk_path = tmp_path / f"chunk_{i}.pdf"
+        chunk_path.write_bytes(chunk_bytes)
+        chunk_responses.append((page_offset, analyze_pdf(str(chunk_path), max_workers=1)))
+    assert merge_chunk_responses(chunk_responses) == analyze_pdf(SAMPLE_PDF, max_workers=1)
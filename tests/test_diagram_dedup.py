@@ -0,0 +1,100 @@
+import itertools
+import os
+import random
+
+import numpy as np
+import pytest
+
+from diagram_dedup import DedupIndex, BAND_BITS, HASH_BANDS, HASHES_FILENAME, SOURCES_FILENAME, hamming_distances
+
+
+BASE = 0x9F3A_5C61_0B7E_D284
+
+
+def flip(value, bits_per_band, seed=0):
+    """
+    value with the given number of bits flipped in each band, the bits chosen at random
+    """
+    rng = random.Random(seed)
+    for band, num_bits in enumerate(bits_per_band):
+        for bit in rng.sample(range(BAND_BITS), num_bits):
+            value ^= 1 << (band * BAND_BITS + bit)
+    return value
+
+
+def figures(*hashes, prefix="Figure"):
+    return [{"image_name": f"{prefix} {i + 1}", "image_caption": f"caption {i}", "page_number": i + 1, "image_phash": f"{value:016x}"} for i, value in enumerate(hashes)]
+
+
+# Every way to spread 7 flipped bits over the bands with at most 2 in each: only one band is left
+# with a single flip, which is the bucket the lookup has to probe
+SPREADS_OF_7 = sorted(set(itertools.permutations([2, 2, 2, 1])))
+
+
+@pytest.mark.parametrize("spread", SPREADS_OF_7)
+def test_near_duplicate_at_distance_7_is_found(tmp_path, spread):
+    near = flip(BASE, spread, seed=sum(spread) * 31 + spread.index(1))
+    assert int(hamming_distances(np.array([BASE], dtype=np.uint64), near)[0]) == 7
+
+    dedup = DedupIndex(str(tmp_path), max_distance=7)
+    dedup.add_book("a", figures(BASE))
+    second = figures(near)
+    assert dedup.add_book("b", second) == 1
+    assert second[0]["canonical_id"] == 0
+    assert len(dedup) == 1
+    assert sorted(source["book"] for source in dedup.sources(0)) == ["a", "b"]
+
+
+@pytest.mark.parametrize("spread, duplicate", [([2, 2, 2, 1], False), ([2, 2, 1, 1], True)])
+def test_default_max_distance_is_6(tmp_path, spread, duplicate):
+    dedup = DedupIndex(str(tmp_path))
+    dedup.add_book("a", figures(BASE))
+    second = figures(flip(BASE, spread, seed=2))
+    assert dedup.add_book("b", second) == int(duplicate)
+    assert second[0]["canonical_id"] == (0 if duplicate else 1)
+
+
+def test_distance_8_is_never_a_duplicate(tmp_path):
+    dedup = DedupIndex(str(tmp_path), max_distance=7)
+    dedup.add_book("a", figures(BASE))
+    assert dedup.add_book("b", figures(flip(BASE, [2, 2, 2, 2]))) == 0
+    assert len(dedup) == 2
+
+
+def test_max_distance_beyond_the_banding_guarantee_is_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        DedupIndex(str(tmp_path), max_distance=2 * HASH_BANDS)
+
+
+def test_nearest_candidate_wins(tmp_path):
+    dedup = DedupIndex(str(tmp_path))
+    # 6 and 1 bits from BASE in different bands, so 7 apart and not merged with each other
+    far, close = flip(BASE, [2, 2, 2, 0], seed=4), flip(BASE, [0, 0, 0, 1], seed=5)
+    dedup.add_book("a", figures(far, close))
+    assert dedup.find(BASE) == 1
+
+
+def test_readding_a_book_replaces_its_sources(tmp_path):
+    dedup = DedupIndex(str(tmp_path))
+    dedup.add_book("a", figures(BASE))
+    # The canonical figure left by the first version is reused, not counted as a duplicate
+    assert dedup.add_book("a", figures(BASE, prefix="Fig.")) == 0
+    assert [source["image_name"] for source in dedup.sources(0)] == ["Fig. 1"]
+    assert dedup.add_book("b", figures(BASE)) == 1
+
+
+def test_other_instances_see_appended_books_and_torn_writes_are_dropped(tmp_path):
+    first = DedupIndex(str(tmp_path))
+    first.add_book("a", figures(BASE))
+    # A crashed writer left half a hash and half a source line
+    with open(os.path.join(tmp_path, HASHES_FILENAME), "ab") as f:
+        f.write(b"\x01\x02\x03")
+    with open(os.path.join(tmp_path, SOURCES_FILENAME), "ab") as f:
+        f.write(b'{"canonical_id": 1, "bo')
+
+    second = DedupIndex(str(tmp_path))
+    assert len(second) == 1
+    assert second.add_book("b", figures(flip(BASE, [1, 1, 0, 0], seed=6))) == 1
+    assert first.add_book("c", figures(BASE)) == 1
+    assert sorted(source["book"] for source in first.sources(0)) == ["a", "b", "c"]
+    assert os.path.getsize(os.path.join(tmp_path, HASHES_FILENAME)) == 8
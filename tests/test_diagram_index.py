@@ -0,0 +1,106 @@
+import os
+
+from diagram_index import DiagramIndex, MERGE_FACTOR
+
+
+def figures(*captions):
+    return [{"image_name": f"Figure {i + 1}", "image_caption": caption, "page_number": 1, "image_file": f"f{i}.png"} for i, caption in enumerate(captions)]
+
+
+def test_search_ignores_deleted_postings_in_document_frequencies(tmp_path):
+    index = DiagramIndex(str(tmp_path))
+    for i in range(MERGE_FACTOR):
+        index.add_book(f"book{i}", figures("attention diagram"))
+    # The books were merged into one segment, so the removals only mark its documents deleted
+    assert len(index._read_manifest()["segments"]) == 1
+    for i in range(MERGE_FACTOR - 1):
+        index.remove_book(f"book{i}")
+
+    assert index.num_docs() == 1
+    results = index.search("attention")
+    assert [result["book"] for result in results] == [f"book{MERGE_FACTOR - 1}"]
+    assert results[0]["score"] > 0
+    index.close()
+
+
+def book_figures(i):
+    # A term shared by every book, one unique to the book, and one shared by the book's figures
+    return figures(f"attention diagram book{i}unique", f"attention encoder layer{i} stack", f"decoder layer{i} residual")
+
+
+def ranking(index, query):
+    return [(result["book"], result["image_name"], round(result["score"], 4)) for result in index.search(query, k=100)]
+
+
+def test_segments_merge_by_tier(tmp_path):
+    index = DiagramIndex(str(tmp_path))
+    for i in range(2 * MERGE_FACTOR + 5):
+        index.add_book(f"book{i}", book_figures(i))
+    # Two merged segments of MERGE_FACTOR books and the 5 books added since
+    assert [len(segment["books"]) for segment in index._read_manifest()["segments"]] == [MERGE_FACTOR, MERGE_FACTOR, 1, 1, 1, 1, 1]
+    assert index.num_docs() == 3 * (2 * MERGE_FACTOR + 5)
+    index.close()
+
+
+def test_merges_and_compaction_keep_results(tmp_path):
+    index = DiagramIndex(str(tmp_path))
+    for i in range(MERGE_FACTOR + 3):
+        index.add_book(f"book{i}", book_figures(i))
+    index.remove_book("book4")
+    index.remove_book("book11")
+    queries = ["attention", "decoder layer7 residual", "book4unique", "book5unique encoder", "layer12"]
+    before = {query: ranking(index, query) for query in queries}
+
+    index.compact()
+    assert len(index._read_manifest()["segments"]) == 1
+    assert {query: ranking(index, query) for query in queries} == before
+    # The merge renumbered documents; each book's own term still finds its own figure
+    for i in range(MERGE_FACTOR + 3):
+        results = index.search(f"book{i}unique")
+        assert [(r["book"], r["image_name"]) for r in results] == ([] if i in (4, 11) else [(f"book{i}", "Figure 1")])
+    assert index.num_docs() == 3 * (MERGE_FACTOR + 1)
+    index.close()
+
+
+def test_readding_a_book_replaces_it(tmp_path):
+    index = DiagramIndex(str(tmp_path))
+    index.add_book("book", figures("transformer attention"))
+    index.add_book("other", figures("convolution kernel"))
+    index.add_book("book", figures("recurrent network", "recurrent cell"))
+    assert index.search("transformer") == []
+    assert sorted((r["book"], r["image_name"]) for r in index.search("recurrent")) == [("book", "Figure 1"), ("book", "Figure 2")]
+    assert index.num_docs() == 3
+    index.close()
+
+
+def test_removing_every_book_deletes_its_segments(tmp_path):
+    index = DiagramIndex(str(tmp_path))
+    index.add_book("a", figures("attention"))
+    index.add_book("b", figures("attention"))
+    index.remove_book("a")
+    index.remove_book("b")
+    assert index._read_manifest()["segments"] == []
+    assert sorted(os.listdir(tmp_path)) == [".lock", "index.json"]
+    assert index.search("attention") == []
+    index.close()
+
+
+def test_near_duplicates_are_returned_once(tmp_path):
+    index = DiagramIndex(str(tmp_path))
+    index.add_book("a", [dict(figure, canonical_id=7) for figure in figures("attention heads")])
+    index.add_book("b", [dict(figure, canonical_id=7) for figure in figures("attention heads diagram")] + figures("attention map"))
+    results = index.search("attention heads")
+    assert [r["canonical_id"] for r in results] == [7, None]
+    index.close()
+
+
+def test_other_instances_see_changes(tmp_path):
+    writer, reader = DiagramIndex(str(tmp_path)), DiagramIndex(str(tmp_path))
+    writer.add_book("a", figures("attention"))
+    assert [r["book"] for r in reader.search("attention")] == ["a"]
+    for i in range(MERGE_FACTOR):
+        writer.add_book(f"b{i}", figures("attention"))
+    # The segments the reader had open were merged away
+    assert len(reader.search("attention", k=100)) == MERGE_FACTOR + 1
+    writer.close()
+    reader.close()
@@ -0,0 +1,69 @@
+import io
+import json
+
+import pytest
+
+from element_stream import iter_elements, iter_file_elements
+
+
+ELEMENTS = [
+    {"id": 0, "category": "figure", "page": 1, "content": {"html": '<img alt="a \\"quoted\\" [caption]"/>'}},
+    {"id": 1, "category": "caption", "page": 1, "content": {"text": "braces } ] { [ and \\\\ backslashes \\\\"}},
+    {"id": 2, "category": "paragraph", "page": 2, "content": {"text": "unicode é中 \U0001f600 and \\u escapes"}},
+    {"id": 3, "category": "equation", "page": 2, "coordinates": [{"x": 0.125, "y": 1e-3}, {"x": -12345678901234, "y": 0}]},
+    {"id": 4, "category": "table", "page": 3, "content": {}, "flags": [True, False, None]},
+]
+RESPONSE = {
+    "api": "2.0",
+    "content": {"html": "<p>\"elements\": [1, 2]</p> \\", "text": "}{][\"\\"},
+    "elements": ELEMENTS,
+    "model": "layout",
+    "usage": {"pages": 3},
+}
+
+
+def read(text, chunk_chars):
+    return list(iter_file_elements(io.StringIO(text), chunk_chars=chunk_chars))
+
+
+@pytest.mark.parametrize("chunk_chars", [1, 2, 3, 5, 7, 64, 1 << 16])
+def test_elements_match_json_load_across_chunk_boundaries(chunk_chars):
+    # ensure_ascii=True writes \uXXXX escapes, including surrogate pairs, that can be split by a chunk
+    for text in (json.dumps(RESPONSE), json.dumps(RESPONSE, ensure_ascii=False, indent=2)):
+        assert read(text, chunk_chars) == json.loads(text)["elements"]
+
+
+@pytest.mark.parametrize("chunk_chars", [1, 4, 1 << 16])
+def test_elements_found_wherever_they_are_in_the_object(chunk_chars):
+    first = json.dumps({"elements": ELEMENTS, "content": RESPONSE["content"]})
+    last = json.dumps({"usage": {"pages": 3}, "count": 12, "ok": True, "none": None, "elements": ELEMENTS})
+    assert read(first, chunk_chars) == ELEMENTS
+    assert read(last, chunk_chars) == ELEMENTS
+
+
+def test_empty_object_and_empty_elements():
+    assert read("{}", 1) == []
+    assert read(' { "elements" : [ ] } ', 1) == []
+    assert read('{"content": {"html": ""}}', 3) == []
+
+
+def test_number_at_chunk_end_is_read_whole():
+    text = '{"elements": [123456789, 0.5e10]}'
+    for chunk_chars in range(1, len(text) + 1):
+        assert read(text, chunk_chars) == [123456789, 0.5e10]
+
+
+@pytest.mark.parametrize("text", ['{"elements": [{"id": 0}', '{"content": "unterminated', '{"elements": [1 2]}', "[]"])
+def test_malformed_response_raises(text):
+    with pytest.raises(json.JSONDecodeError):
+        read(text, 3)
+
+
+def test_iter_elements_accepts_dict_path_and_file(tmp_path):
+    path = tmp_path / "response.json"
+    path.write_text(json.dumps(RESPONSE), encoding="utf-8")
+    assert list(iter_elements(RESPONSE)) == ELEMENTS
+    assert list(iter_elements(str(path))) == ELEMENTS
+    assert list(iter_elements(path)) == ELEMENTS
+    with open(path, "r", encoding="utf-8") as f:
+        assert list(iter_elements(f)) == ELEMENTS
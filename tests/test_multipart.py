@@ -0,0 +1,62 @@
+import pytest
+
+from ingestion_service import MultipartReader
+
+
+BOUNDARY = "----form7MA4YWxkTrZu0gW"
+PDF = b"%PDF-1.7\r\n--not the boundary\r\n\r\n" + bytes(range(256)) * 4 + b"\r\n--" + BOUNDARY.encode()[:-1] + b"\r\n%%EOF"
+
+
+def body(*parts, preamble=b"", epilogue=b"\r\n"):
+    delimiter = b"--" + BOUNDARY.encode()
+    out = preamble
+    for headers, data in parts:
+        out += delimiter + b"\r\n" + headers + b"\r\n" + data + b"\r\n"
+    return out + delimiter + b"--" + epilogue
+
+
+def split(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def read_parts(chunks):
+    return [(headers, b"".join(data)) for headers, data in MultipartReader(chunks, BOUNDARY).parts()]
+
+
+FORM = body(
+    (b'Content-Disposition: form-data; name="title"\r\n', b"Deep Learning"),
+    (b'Content-Disposition: form-data; name="document"; filename="dl.pdf"\r\nContent-Type: application/pdf\r\n', PDF),
+    (b'Content-Disposition: form-data; name="empty"\r\n', b""),
+)
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 64, len(FORM)])
+def test_parts_survive_boundaries_split_across_reads(size):
+    parts = read_parts(split(FORM, size))
+    assert [headers.get_param("name", header="content-disposition") for headers, _ in parts] == ["title", "document", "empty"]
+    assert [data for _, data in parts] == [b"Deep Learning", PDF, b""]
+    assert parts[1][0].get_filename() == "dl.pdf"
+    assert parts[1][0].get_content_type() == "application/pdf"
+
+
+@pytest.mark.parametrize("size", [1, 5, len(FORM) + 100])
+def test_preamble_and_epilogue_are_ignored(size):
+    data = body((b'Content-Disposition: form-data; name="document"\r\n', PDF), preamble=b"preamble\r\n", epilogue=b"\r\nepilogue")
+    assert [data for _, data in read_parts(split(data, size))] == [PDF]
+
+
+def test_part_without_headers():
+    [(headers, data)] = read_parts(split(body((b"", b"payload")), 3))
+    assert len(headers) == 0
+    assert data == b"payload"
+
+
+def test_unread_data_is_skipped_for_the_next_part():
+    names = [headers.get_param("name", header="content-disposition") for headers, _ in MultipartReader(split(FORM, 5), BOUNDARY).parts()]
+    assert names == ["title", "document", "empty"]
+
+
+@pytest.mark.parametrize("cut", [10, len(FORM) // 2, len(FORM) - 10])
+def test_truncated_upload_raises(cut):
+    with pytest.raises(ValueError):
+        read_parts(split(FORM[:cut], 4))
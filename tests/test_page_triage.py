@@ -0,0 +1,67 @@
+import os
+
+import fitz
+
+from local_layout import analyze_pdf, element_html
+from page_triage import PageTriage, triage_pdf
+
+
+SAMPLE_DATA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "sample_data")
+
+
+def uploaded(element_id, page, category, text):
+    return {"id": element_id, "page": page, "category": category, "text": text, "html": element_html(element_id, category, text)}
+
+
+def skipped(page, text):
+    return {"page": page, "category": "paragraph", "text": text}
+
+
+def test_restore_maps_pages_back_and_renumbers_ids():
+    # Pages 2 and 4 of 5 were uploaded as pages 1 and 2
+    triage = PageTriage(5, [1, 3], [skipped(1, "intro"), skipped(3, "prose a"), skipped(3, "prose b"), skipped(5, "outro")])
+    response = {
+        "api": "2.0",
+        "billed_pages": 2,
+        "elements": [uploaded(0, 1, "figure", "fig"), uploaded(1, 1, "caption", "Figure 1: x"), uploaded(2, 2, "paragraph", "see Figure 1")],
+    }
+    restored = triage.restore(response)
+
+    assert [(e["id"], e["page"], e["text"]) for e in restored["elements"]] == [
+        (0, 1, "intro"), (1, 2, "fig"), (2, 2, "Figure 1: x"), (3, 3, "prose a"), (4, 3, "prose b"), (5, 4, "see Figure 1"), (6, 5, "outro"),
+    ]
+    assert [e["html"] for e in restored["elements"]] == [element_html(e["id"], e["category"], e["text"]) for e in restored["elements"]]
+    assert restored["api"] == "2.0" and restored["billed_pages"] == 2
+    # Neither the response nor the triage is modified, so it can restore again
+    assert response["elements"][0]["page"] == 1 and "id" not in triage.skipped_elements[0]
+    assert triage.restore(response) == restored
+
+
+def test_restore_keeps_reading_order_within_a_page():
+    triage = PageTriage(2, [0], [])
+    response = {"elements": [uploaded(0, 1, "paragraph", "b"), uploaded(1, 1, "paragraph", "a")]}
+    assert [e["text"] for e in triage.restore(response)["elements"]] == ["b", "a"]
+    assert triage.is_complete is False
+    assert PageTriage(2, [0, 1], []).is_complete
+
+
+def test_triaged_analysis_restores_the_original_pages(tmp_path):
+    pdf_path = os.path.join(SAMPLE_DATA, "dl15.pdf")
+    triage = triage_pdf(pdf_path)
+    assert not triage.is_complete
+
+    kept_path = tmp_path / "kept.pdf"
+    with fitz.open(pdf_path) as pdf_document:
+        pdf_document.select(triage.pages)
+        pdf_document.save(str(kept_path))
+    restored = triage.restore(analyze_pdf(str(kept_path), max_workers=1))
+    whole = analyze_pdf(pdf_path, max_workers=1)
+
+    # The kept pages read exactly as in a whole-document analysis, apart from the ids
+    kept_pages = {index + 1 for index in triage.pages}
+    strip = lambda elements: [(e["page"], e["category"], e["text"], e["bounding_box"]) for e in elements if e["page"] in kept_pages]
+    assert strip(restored["elements"]) == strip(whole["elements"])
+    # The skipped pages hold their text blocks as paragraphs
+    skipped_text = [(e["page"], e["category"], e["text"]) for e in restored["elements"] if e["page"] not in kept_pages]
+    assert skipped_text and skipped_text == [(e["page"], "paragraph", e["text"]) for e in triage.skipped_elements]
+    assert [e["id"] for e in restored["elements"]] == list(range(len(restored["elements"])))
@@ -0,0 +1,125 @@
+import os
+import sqlite3
+
+import pytest
+
+import image_extraction_pipeline
+from image_extraction_pipeline import stage_fingerprints
+from run_manifest import RunManifest, atomic_output, manifest_path_for, stage_fingerprint
+
+
+def chain(layout_config, extract_config, save_config):
+    layout = stage_fingerprint("layout", 1, layout_config)
+    extract = stage_fingerprint("extract", 1, extract_config, layout)
+    save = stage_fingerprint("save", 1, save_config, extract)
+    return {"layout": layout, "extract": extract, "save": save}
+
+
+@pytest.fixture
+def manifest(tmp_path):
+    with RunManifest(manifest_path_for(str(tmp_path))) as manifest:
+        yield manifest
+
+
+def mark_all(manifest, key, fingerprints):
+    for stage, fingerprint in fingerprints.items():
+        manifest.mark_done(*key, stage, fingerprint, outputs={"stage": stage})
+
+
+def done(manifest, key, fingerprints):
+    return [stage for stage, fingerprint in fingerprints.items() if manifest.is_done(*key, stage, fingerprint)]
+
+
+def test_fingerprint_change_redoes_the_stage_and_every_later_one(manifest):
+    key = ("hash", "book")
+    old = chain({"backend": "remote"}, {"quality": 90}, {"index": True})
+    mark_all(manifest, key, old)
+    assert done(manifest, key, old) == ["layout", "extract", "save"]
+
+    assert done(manifest, key, chain({"backend": "remote"}, {"quality": 90}, {"index": False})) == ["layout", "extract"]
+    assert done(manifest, key, chain({"backend": "remote"}, {"quality": 80}, {"index": True})) == ["layout"]
+    assert done(manifest, key, chain({"backend": "local"}, {"quality": 90}, {"index": True})) == []
+    # Same config, new code version
+    assert stage_fingerprint("extract", 2, {"quality": 90}, old["layout"]) != old["extract"]
+
+
+def test_fingerprints_ignore_config_key_order():
+    assert stage_fingerprint("save", 1, {"a": 1, "b": [1, 2]}) == stage_fingerprint("save", 1, {"b": [1, 2], "a": 1})
+    assert stage_fingerprint("save", 1, {"a": 1}) != stage_fingerprint("extract", 1, {"a": 1})
+
+
+def test_pipeline_fingerprints_follow_stage_versions_and_options(monkeypatch):
+    base = stage_fingerprints()
+    assert stage_fingerprints()["save"] == base["save"]
+    assert stage_fingerprints(write_json=True)["extract"] == base["extract"]
+    assert stage_fingerprints(write_json=True)["save"] != base["save"]
+
+    monkeypatch.setitem(image_extraction_pipeline.STAGE_VERSIONS, "extract", image_extraction_pipeline.STAGE_VERSIONS["extract"] + 1)
+    bumped = stage_fingerprints()
+    assert bumped["layout"] == base["layout"]
+    assert bumped["extract"] != base["extract"] and bumped["save"] != base["save"]
+
+
+def test_stages_are_kept_per_book_and_document(manifest):
+    fingerprints = chain({}, {}, {})
+    mark_all(manifest, ("hash", "book"), fingerprints)
+    assert done(manifest, ("hash", "renamed"), fingerprints) == []
+    assert done(manifest, ("other hash", "book"), fingerprints) == []
+    assert manifest.outputs("hash", "book", "extract", fingerprints["extract"]) == {"stage": "extract"}
+    assert manifest.outputs("hash", "book", "extract", fingerprints["layout"]) is None
+
+
+def test_invalidate(manifest):
+    fingerprints = chain({}, {}, {})
+    for key in [("hash", "a"), ("hash", "b"), ("other", "a")]:
+        mark_all(manifest, key, fingerprints)
+    manifest.invalidate("hash", book="a")
+    assert [done(manifest, key, fingerprints) != [] for key in [("hash", "a"), ("hash", "b"), ("other", "a")]] == [False, True, True]
+    manifest.invalidate("hash")
+    assert done(manifest, ("hash", "b"), fingerprints) == []
+    assert done(manifest, ("other", "a"), fingerprints) == ["layout", "extract", "save"]
+
+
+def test_records_survive_reopening(tmp_path):
+    fingerprints = chain({}, {}, {})
+    with RunManifest(manifest_path_for(str(tmp_path))) as manifest:
+        mark_all(manifest, ("hash", "book"), fingerprints)
+    with RunManifest(manifest_path_for(str(tmp_path))) as manifest:
+        assert done(manifest, ("hash", "book"), fingerprints) == ["layout", "extract", "save"]
+
+
+def test_manifest_without_books_is_redone(tmp_path):
+    path = manifest_path_for(str(tmp_path))
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE stages (content_hash TEXT, stage TEXT, fingerprint TEXT, completed_at REAL, outputs TEXT, PRIMARY KEY (content_hash, stage))")
+    conn.execute("INSERT INTO stages VALUES ('hash', 'layout', 'f', 0, NULL)")
+    conn.commit()
+    conn.close()
+    with RunManifest(path) as manifest:
+        assert not manifest.is_done("hash", "book", "layout", "f")
+
+
+def test_content_hash_follows_file_changes(manifest, tmp_path):
+    pdf_path = tmp_path / "a.pdf"
+    pdf_path.write_bytes(b"%PDF-1.7 one")
+    first = manifest.content_hash(str(pdf_path))
+    assert manifest.content_hash(str(pdf_path)) == first
+    pdf_path.write_bytes(b"%PDF-1.7 two, longer")
+    assert manifest.content_hash(str(pdf_path)) != first
+
+
+def test_atomic_output_replaces_only_on_success(tmp_path):
+    path = tmp_path / "figures.json"
+    path.write_text("old")
+    with pytest.raises(RuntimeError):
+        with atomic_output(str(path)) as tmp:
+            assert tmp.endswith(".json")
+            with open(tmp, "w") as f:
+                f.write("partial")
+            raise RuntimeError
+    assert path.read_text() == "old"
+    with atomic_output(str(path)) as tmp:
+        with open(tmp, "w") as f:
+            f.write("new")
+    assert path.read_text() == "new"
+    assert os.listdir(tmp_path) == ["figures.json"]